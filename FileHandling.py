@@ -6,8 +6,10 @@ import os
 import re
 from multiprocessing import Pool
 import progressbar
-from Segmentation.SegmentationData import ProcessedFrame, load_segmentation
-from Tracking.TrackingSolution import TrackingSolution, load_tracking_solution
+from Segmentation.SegmentationData import ProcessedFrame, FrameMetadata, load_segmentation, load_segmentation_metadata, \
+    convert_segmentation, preferred_segmentation_files
+from Tracking.TrackingSolution import TrackingSolution, TrackingSolutionMetadata, load_tracking_solution, \
+    load_tracking_solution_metadata
 
 
 class FileType(Enum):
@@ -21,8 +23,8 @@ class FileType(Enum):
 FOV_REGEX = "^fov_[0-9]+$"
 REGION_REGEX = "^region_[0-9]+$"
 IMAGE_REGEX = "^frame_[0-9]+_z_[0-9]+_channel_[0-9]+\.tif$"
-SEG_REGEX = "^fov_[0-9]+_region_[0-9]+\.json$"
-CURATED_REGEX = "^fov_[0-9]+_region_[0-9]+_curated\.json$"
+SEG_REGEX = "^fov_[0-9]+_region_[0-9]+\.(json|seg)$"
+CURATED_REGEX = "^fov_[0-9]+_region_[0-9]+_curated\.(json|seg)$"
 TRACKING_REGEX = "^fov_[0-9]+_region_[0-9]+_tracking\.json$"
 
 regex_dict = {FileType.SEGMENTATION: SEG_REGEX,
@@ -51,7 +53,7 @@ def iterate_regions(root_directory: str, filetype: FileType):
                 files: list[str] = [file for file in os.listdir(region_path) if
                                     re.search(regex_dict[filetype], file) is not None]
 
-                for file in files:
+                for file in preferred_segmentation_files(files):
                     yield os.path.join(region_path, file)
 
 
@@ -89,3 +91,47 @@ def load_all_segmentation_results(root_path: str, processes=12) -> list[list[Pro
                 results.append(res)
                 bar += 1
     return results
+
+
+def load_all_tracking_metadata(root_path: str, processes=12) -> list[TrackingSolutionMetadata]:
+    """Multi-threaded function that loads the per-cell metadata of tracking results from every region in a dataset,
+    without any segment masks"""
+    tracking_count = count_files(root_path, FileType.TRACKING)
+    print("Total tracked regions: {}".format(tracking_count))
+
+    results = []
+    with progressbar.ProgressBar(max_value=tracking_count) as bar:
+        with Pool(processes=processes) as pool:
+            for res in pool.imap(load_tracking_solution_metadata, iterate_regions(root_path, FileType.TRACKING)):
+                results.append(res)
+                bar += 1
+    return results
+
+
+def load_all_segmentation_metadata(root_path: str, processes=12) -> list[list[FrameMetadata]]:
+    """Multi-threaded function that loads the per-segment metadata of curated segmentation data from every region in a
+    dataset, without any masks"""
+    segmentation_count = count_files(root_path, FileType.CURATED_SEGMENTATION)
+    print("Total curated segmented regions: {}".format(segmentation_count))
+
+    results = []
+    with progressbar.ProgressBar(max_value=segmentation_count) as bar:
+        with Pool(processes=processes) as pool:
+            for res in pool.imap(load_segmentation_metadata, iterate_regions(root_path, FileType.CURATED_SEGMENTATION)):
+                results.append(res)
+                bar += 1
+    return results
+
+
+def convert_all_segmentation_results(root_path: str, filetype: FileType = FileType.CURATED_SEGMENTATION, processes=12) -> list[str]:
+    """Multi-threaded function that converts json segmentation data from every region in a dataset to the binary format"""
+    json_files = [file for file in iterate_regions(root_path, filetype) if os.path.splitext(file)[1] == ".json"]
+    print("Total json segmentation files: {}".format(len(json_files)))
+
+    results = []
+    with progressbar.ProgressBar(max_value=len(json_files)) as bar:
+        with Pool(processes=processes) as pool:
+            for res in pool.imap(convert_segmentation, json_files):
+                results.append(res)
+                bar += 1
+    return results
@@ -1,7 +1,7 @@
 import gi
 import multiprocessing
 import os
-from typing import Union, Dict, Tuple
+from typing import Union, Dict, Tuple, Optional
 
 import numpy as np
 
@@ -11,7 +11,10 @@ from GUI.Widgets.ResizingImage import ResizingImage
 from GUI.Widgets.ImageViewControls import ImageViewControls
 from GUI.Widgets.RunningDialog import RunningDialog
 from GUI.Widgets.ImagePreviewDialog import ImagePreviewDialog
-from Preprocessing.ImageCropper import ImageCropper, CropParameters
+from Preprocessing.ImageCropper import ImageCropper, CropParameters, save_crop_parameters
+from Preprocessing.CropRunner import run_crop_process
+from Preprocessing.PlaneCache import PlaneCache
+from Preprocessing.OverviewPyramid import OverviewPyramid, open_overview_pyramid
 
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, Gdk  # noqa: E402
@@ -23,6 +26,11 @@ class CroppingTool(Gtk.Grid):
         super(CroppingTool, self).__init__()
 
         self.cropper: ImageCropper = ImageCropper(images, defaults)
+        # Preview planes are cached here rather than in the cropper, as the cropper is copied into the crop process
+        self.plane_cache: PlaneCache = PlaneCache(images)
+        # Previews are drawn from the overview pyramid, if one has been built, unless the image is shown larger than it
+        self.overview: Optional[OverviewPyramid] = open_overview_pyramid(images)
+        self.overview_level: Optional[int] = None
         self.channel_id: int = brightfield_channel
 
         self.output_folder_chooser: Gtk.FileChooserNative = Gtk.FileChooserNative(action=Gtk.FileChooserAction.SELECT_FOLDER)
@@ -39,7 +47,9 @@ class CroppingTool(Gtk.Grid):
                                             "trap_detection_channel": (0, images.num_channels),
                                             "trap_detection_z_position": (0, images.num_zstack),
                                             "min_trap_size": (0, None),
-                                            "max_trap_size": (0, None)}
+                                            "max_trap_size": (0, None),
+                                            "drift_downsample": (1, None),
+                                            "focus_channel": (0, images.num_channels)}
         self.crop_controls: CroppingControls = CroppingControls(self.cropper.parameters, control_limits)
 
         self.open_folder_button: Gtk.Button = Gtk.Button(label="Choose output folder")
@@ -47,6 +57,8 @@ class CroppingTool(Gtk.Grid):
         self.run_crop_button: Gtk.Button = Gtk.Button(label="Run crop")
         self.run_crop_button.set_valign(Gtk.Align.CENTER)
         self.preview_trap_button: Gtk.Button = Gtk.Button(label="View trap detection")
+        self.save_parameters_button: Gtk.Button = Gtk.Button(label="Save parameters")
+        self.save_parameters_button.set_valign(Gtk.Align.CENTER)
         self.run_crop_button.set_valign(Gtk.Align.CENTER)
 
         self.image: ResizingImage = ResizingImage()
@@ -66,6 +78,7 @@ class CroppingTool(Gtk.Grid):
         self.control_box.pack_start(self.fov_controls, True, False, 0)
         self.control_box.pack_start(self.z_controls, True, False, 0)
         self.control_box.pack_start(self.preview_trap_button, True, False, 0)
+        self.control_box.pack_start(self.save_parameters_button, True, False, 0)
         self.control_box.pack_start(self.open_folder_button, True, False, 0)
         self.control_box.pack_start(self.run_crop_button, True, False, 0)
 
@@ -97,8 +110,11 @@ class CroppingTool(Gtk.Grid):
         self.open_folder_button.connect("clicked", self._open_folder)
         self.run_crop_button.connect("clicked", self._run_crop)
         self.preview_trap_button.connect("clicked", self._view_traps)
+        self.save_parameters_button.connect("clicked", self._save_parameters)
         self.image.connect("button_press_event", self._on_click)
+        self.image.connect("size-allocate", self._check_overview_level)
         self.connect("size-allocate", self._pad_label)
+        self.connect("destroy", lambda _: self.plane_cache.close())
         self._update_image()
 
     def _pad_label(self, _, __):
@@ -113,15 +129,30 @@ class CroppingTool(Gtk.Grid):
     def _on_click(self, image: ResizingImage, event: Gdk.EventButton) -> None:
         if event.type == Gdk.EventType.BUTTON_PRESS:
             image_x, image_y = image.adjust_coords(event.x, event.y)
+            if self.overview_level is not None:
+                scale_x, scale_y = self.overview.level_scale(self.overview_level)
+                image_x, image_y = int(image_x * scale_x), int(image_y * scale_y)
             self.cropper.flag_region((image_y, image_x))
             self._update_image()
 
     def _update_image(self) -> None:
+        self.overview_level = self._overview_level_for(self.image.get_allocation())
         preview: np.ndarray = self.cropper.generate_preview(self.frame_controls.frame_number,
                                                             self.fov_controls.frame_number,
-                                                            self.channel_id, self.z_controls.frame_number)
+                                                            self.channel_id, self.z_controls.frame_number, self.plane_cache,
+                                                            self.overview, self.overview_level)
         self.image.set_image(preview)
 
+    def _overview_level_for(self, allocation: Gdk.Rectangle) -> Optional[int]:
+        if self.overview is None:
+            return None
+        return self.overview.level_for_size(allocation.width, allocation.height)
+
+    # Redraw the preview at a different level if the image has been resized past the current one
+    def _check_overview_level(self, image: ResizingImage, allocation: Gdk.Rectangle) -> None:
+        if self._overview_level_for(allocation) != self.overview_level:
+            self._update_image()
+
     def _change_frame(self, controls: ImageViewControls, frame_id: int) -> None:
         self._update_image()
 
@@ -147,11 +178,25 @@ class CroppingTool(Gtk.Grid):
         print("viewing traps")
         ImagePreviewDialog("Detected Traps", self.cropper.preview_trap_image(self.frame_controls.frame_number, self.fov_controls.frame_number))
 
+    # Save parameters for cropping with run_crop.py. Ignored regions are per FOV, so are printed in run_crop.py's format.
+    def _save_parameters(self, button: Gtk.Button) -> None:
+        chooser: Gtk.FileChooserNative = Gtk.FileChooserNative(action=Gtk.FileChooserAction.SAVE)
+        chooser.set_do_overwrite_confirmation(True)
+        chooser.set_current_name("crop_parameters.json")
+
+        if chooser.run() == Gtk.ResponseType.ACCEPT and chooser.get_filename() is not None:
+            save_crop_parameters(self.cropper.parameters, chooser.get_filename())
+            ignored = [str(region_id) for region_id, region in enumerate(self.cropper.crop_regions) if region.ignored]
+            print("Saved crop parameters to {}, ignored regions: --ignore {}:{}".format(chooser.get_filename(),
+                                                                                       self.fov_controls.frame_number,
+                                                                                       ",".join(ignored)))
+
     def _run_crop(self, button: Gtk.Button) -> None:
         parent_conn, child_conn = multiprocessing.Pipe()
-        crop_thread = multiprocessing.Process(target=self.cropper.crop_all, args=(self.fov_controls.frame_number,
-                                                                                  self.output_folder_path,
-                                                                                  parent_conn))
+        crop_thread = multiprocessing.Process(target=run_crop_process, args=(self.cropper,
+                                                                             [self.fov_controls.frame_number],
+                                                                             self.output_folder_path,
+                                                                             parent_conn))
         self.running_dialog = RunningDialog("Running crop", child_conn, crop_thread.terminate)
         crop_thread.start()
 
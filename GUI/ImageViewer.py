@@ -3,8 +3,11 @@ import numpy as np
 from GUI.Widgets.ResizingImage import ResizingImage
 from GUI.Widgets.ImageViewControls import ImageViewControls
 from Preprocessing.ND2Frames import ND2Frames
+from Preprocessing.PlaneCache import PlaneCache
+from Preprocessing.OverviewPyramid import OverviewPyramid, open_overview_pyramid
 from Segmentation.Utilities import increase_contrast
 import os
+from typing import Optional
 
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, Gdk  # noqa: E402
@@ -15,6 +18,10 @@ class ImageViewer(Gtk.Grid):
         super(ImageViewer, self).__init__()
 
         self.frames = frames
+        self.plane_cache: PlaneCache = PlaneCache(frames)
+        # Images are read from the overview pyramid, if one has been built, unless the image is shown larger than it
+        self.overview: Optional[OverviewPyramid] = open_overview_pyramid(frames)
+        self.overview_level: Optional[int] = None
         self.frame_id = 0
         self.fov_id = 0
         self.channel_id = 0
@@ -64,6 +71,8 @@ class ImageViewer(Gtk.Grid):
         self.z_controls.connect("update_frame", self._change_zstack)
 
         self.connect("size-allocate", self.pad_label)
+        self.image.connect("size-allocate", self._check_overview_level)
+        self.connect("destroy", lambda _: self.plane_cache.close())
         self.set_margin_top(5)
         self.set_margin_bottom(5)
         self.set_margin_start(5)
@@ -101,17 +110,25 @@ class ImageViewer(Gtk.Grid):
         self._update_images()
 
     def _update_images(self) -> None:
+        self.overview_level = self._overview_level_for(self.image.get_allocation())
         self.image.set_image(self._lookup_image(self.frame_id, self.fov_id, self.channel_id, self.zstack_id), True)
 
     def _lookup_image(self, frame_id: int, fov_id: int, channel_id: int, zstack_id: int) -> np.ndarray:
-        # Frame axis iteration order: t m c z
-        pos = (frame_id * self.frames.num_fovs * self.frames.num_channels * self.frames.num_zstack) + \
-              (fov_id * self.frames.num_channels * self.frames.num_zstack) + \
-              (channel_id * self.frames.num_zstack) +\
-              zstack_id
-        image = increase_contrast(self.frames[pos])
+        if self.overview_level is not None:
+            return increase_contrast(self.overview.read_plane(self.overview_level, frame_id, fov_id, channel_id, zstack_id))
+        image = increase_contrast(self.plane_cache.get_plane(frame_id, fov_id, channel_id, zstack_id))
         return image
 
+    def _overview_level_for(self, allocation: Gdk.Rectangle) -> Optional[int]:
+        if self.overview is None:
+            return None
+        return self.overview.level_for_size(allocation.width, allocation.height)
+
+    # Reload the image at a different level if it has been resized past the current one
+    def _check_overview_level(self, image: ResizingImage, allocation: Gdk.Rectangle) -> None:
+        if self._overview_level_for(allocation) != self.overview_level:
+            self._update_images()
+
 
 if __name__ == '__main__':
     class MyWindow(Gtk.Window):
@@ -1,7 +1,6 @@
 import gi
 from typing import List, Union, Optional
 import os
-import cv2
 
 from GUI.Widgets.SegmentInfoBox import SegmentInfoBox
 from GUI.Widgets.SegmentViewControls import SegmentViewControls
@@ -11,6 +10,7 @@ from Segmentation.SegmentationData import ProcessedFrame, Segmentation, Segment,
 from Segmentation.SegmentationEditor import SegmentationEditor
 from Segmentation.Measurement import calculate_intensity
 from Segmentation.Utilities import find_segmented_background
+from Preprocessing.RegionStack import read_image
 
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, Gdk  # noqa: E402
@@ -194,19 +194,12 @@ class SegmentationCurator(Gtk.Grid):
     def on_remove_edge_segments(self, _button: Gtk.Button) -> None:
         print("Removing edge segments")
         for frame in self.segmentations:
+            # Read each frame's images once, for all of its segmentations
+            images = [read_image(os.path.join(frame.root_directory, img_name)) for img_name in frame.image_names]
             for segmentation in frame.segmentations:
                 to_remove: list[Segment] = []
                 for segment in segmentation.segments:
-                    seg_mask = segment.mask_image
-
-                    mask_x0 = seg_mask[0, :].tolist()
-                    mask_y0 = seg_mask[:, 0].tolist()
-                    mask_x1 = seg_mask[frame.frame_shape[0] - 1, :].tolist()
-                    mask_y1 = seg_mask[:, frame.frame_shape[1] - 1].tolist()
-
-                    is_edge = any(mask_x0 + mask_x1 + mask_y0 + mask_y1)
-
-                    if is_edge:
+                    if segment.touches_frame_edge():
                         print("Frame {} seg {} is on edge".format(frame.frame_no, segment.seg_id))
                         to_remove.append(segment)
 
@@ -218,7 +211,6 @@ class SegmentationCurator(Gtk.Grid):
                     segmentation.segments[new_segment_id].seg_id = new_segment_id
 
                 # Recalculate segmentation background
-                images = [cv2.imread(os.path.join(frame.root_directory, img_name), flags=(cv2.IMREAD_GRAYSCALE + cv2.IMREAD_UNCHANGED)) for img_name in frame.image_names]
                 segmentation.background_mask = find_segmented_background(images[frame.segmentations[0].segmentation_channel_id], segmentation.segments, frame.frame_shape)
                 segmentation.background_intensities = [calculate_intensity(image, segmentation.background_mask) for image in images]
 
@@ -288,10 +280,10 @@ if __name__ == '__main__':
     if result == Gtk.ResponseType.ACCEPT and segmentation_file_chooser.get_filename() is not None:
         input_filepath = segmentation_file_chooser.get_filename()
 
-        if os.path.splitext(input_filepath)[-1] != '.json':
-            print("Error: selected file is not a segmentation json file!")
+        if os.path.splitext(input_filepath)[-1] not in ('.json', '.seg'):
+            print("Error: selected file is not a segmentation file!")
             exit(1)
         else:
             print("Opening {}".format(input_filepath))
-            all_segmentations: List[ProcessedFrame] = load_segmentation(input_filepath)
+            all_segmentations: List[ProcessedFrame] = load_segmentation(input_filepath, lazy=True)
             run_viewer(all_segmentations)
@@ -169,7 +169,7 @@ def run_editor(segmentation_file: str, starting_frame_id: int = 0, starting_segm
             super(MyWindow, self).__init__(title="Tracking Editor")
             self.set_default_size(550, 400)
 
-            segmentations: List[ProcessedFrame] = load_segmentation(filename)
+            segmentations: List[ProcessedFrame] = load_segmentation(filename, lazy=True)
 
             self.viewer: TrackingEditor = TrackingEditor(segmentations, start_frame_id, start_segmentation_id)
             self.connect("key-press-event", self.handle_keypress)
@@ -207,8 +207,8 @@ if __name__ == '__main__':
 
         # input_filepath = "/data/cropped/2021-04-23_CMOS_40x_broken_5'utr_EDF/fov_{0}/region_{1}/fov_{0}_region_{1}_curated.json".format(fov, region)
 
-        if os.path.splitext(input_filepath)[-1] != '.json':
-            print("Error: selected file is not a segmentation json file!")
+        if os.path.splitext(input_filepath)[-1] not in ('.json', '.seg'):
+            print("Error: selected file is not a segmentation file!")
         else:
             print("Opening {}".format(input_filepath))
             run_editor(input_filepath)
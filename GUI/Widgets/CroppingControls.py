@@ -1,6 +1,7 @@
 import gi
 from typing import List, Optional, Dict, Tuple
 from dataclasses import asdict
+from enum import Enum
 
 from Preprocessing.ImageCropper import CropParameters
 gi.require_version("Gtk", "3.0")  # noqa: E402
@@ -31,6 +32,19 @@ class ParameterToggle(Gtk.Switch):
         self.cropparameter_key = cropparameter_key
 
 
+class ParameterChoice(Gtk.ComboBoxText):
+    """Wrapper class for ComboBoxText listing the members of an enum, adding key for linking back to CropParameter class"""
+    def __init__(self, cropparameter_key: str, initial_value: Enum):
+        super(ParameterChoice, self).__init__()
+        self.cropparameter_key = cropparameter_key
+        self.enum_type = type(initial_value)
+
+        for member in self.enum_type:
+            self.append(member.name, member.name.capitalize().replace("_", " "))
+        self.set_active_id(initial_value.name)
+        self.set_valign(Gtk.Align.CENTER)
+
+
 class CroppingControls(Gtk.Grid):
     """Widget containing all editable parameters used for cropping images"""
     def __init__(self, defaults: CropParameters, limits: Dict[str, Tuple]) -> None:
@@ -53,6 +67,10 @@ class CroppingControls(Gtk.Grid):
                 control: ParameterToggle = ParameterToggle(key, val)
                 control.connect("state-set", self._on_toggle)
 
+            elif isinstance(val, Enum):
+                control: ParameterChoice = ParameterChoice(key, val)
+                control.connect("changed", self._on_choose)
+
             elif isinstance(val, (float, int)):
                 if key in limits:
                     control = ParameterEntry(key, None, val, limits[key][0], limits[key][1])
@@ -91,6 +109,10 @@ class CroppingControls(Gtk.Grid):
         setattr(self.crop_parameters, switch.cropparameter_key, state)
         self.emit("update_parameters", self.crop_parameters)
 
+    def _on_choose(self, choice: ParameterChoice):
+        setattr(self.crop_parameters, choice.cropparameter_key, choice.enum_type[choice.get_active_id()])
+        self.emit("update_parameters", self.crop_parameters)
+
     def _on_edit(self, entry: ParameterEntry) -> None:
         text = entry.get_text()
 
@@ -1,5 +1,4 @@
 import gi
-import cv2
 import os
 import numpy as np
 from typing import Optional, Tuple, List
@@ -8,6 +7,7 @@ from Segmentation.SegmentFrameImage import SegmentFrameImage
 from Segmentation.Utilities import increase_contrast
 from GUI.Widgets.OverlayImage import OverlayImage
 from Segmentation.SegmentationData import ProcessedFrame, Segment
+from Preprocessing.RegionStack import read_image
 from Visualisation.Visualisation import generate_border_mask
 from Tracking.CellFrameImage import CellFrameImage
 from Tracking.Cell import Cell
@@ -46,7 +46,7 @@ class SegmentOverlayImage(Gtk.Overlay):
         if frame_id is not None:
             frame_segmentation = self.frame_segmentations[frame_id]
             file_path = os.path.join(frame_segmentation.root_directory, frame_segmentation.image_names[0])
-            image = cv2.imread(file_path, flags=cv2.IMREAD_UNCHANGED)
+            image = read_image(file_path)
             self.image.set_image(increase_contrast(image))
 
             if self.cell_image is not None:
@@ -95,9 +95,10 @@ class SegmentOverlayImage(Gtk.Overlay):
 
     def draw_border(self, segment: Segment, colour: Tuple[int, int, int], thickness: int = 1) -> None:
         """Draw a 1-pixel border around the provided segment"""
-        border_img = generate_border_mask(segment.mask_image, thickness)
+        padded_mask, (rows, cols) = segment.padded_mask(thickness)
+        border_img = generate_border_mask(padded_mask, thickness)
         result = self.image.image_data
-        result[border_img != 0] = colour
+        result[rows, cols][border_img != 0] = colour
         super(OverlayImage, self.image).set_image(result)
 
     def label_segments(self, frame_id: Optional[int]) -> None:
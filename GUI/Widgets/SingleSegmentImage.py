@@ -1,11 +1,11 @@
 import gi
 from typing import List, Optional
 import os
-import cv2
 
 from GUI.Widgets.OverlayImage import OverlayImage
 from Segmentation.SegmentationData import Segment, ProcessedFrame
-from Visualisation.Visualisation import colourise_binary_mask
+from Preprocessing.RegionStack import read_image
+from Visualisation.Visualisation import colourise_segment
 from Segmentation.Utilities import increase_contrast
 
 gi.require_version("Gtk", "3.0")  # noqa: E402
@@ -25,7 +25,7 @@ class SingleSegmentImage(OverlayImage):
     def set_segment(self, segment: Optional[Segment]) -> None:
         self.segment = segment
         if segment is not None:
-            self.set_overlay(colourise_binary_mask(segment.mask_image, (255, 0, 0), (255, 0, 0)))
+            self.set_overlay(colourise_segment(segment, (255, 0, 0), (255, 0, 0)))
         else:
             self.set_overlay(None)
 
@@ -36,6 +36,6 @@ class SingleSegmentImage(OverlayImage):
         frame_segmentation = self.frame_segmentations[frame_id]
 
         file_path = os.path.join(frame_segmentation.root_directory, frame_segmentation.image_names[frame_segmentation.segmentations[0].segmentation_channel_id])
-        image = cv2.imread(file_path, flags=cv2.IMREAD_UNCHANGED)
+        image = read_image(file_path)
         self.set_image(increase_contrast(image))
         self.set_segment(self.segment)
@@ -0,0 +1,62 @@
+import os
+import json
+from typing import Tuple, Dict, Any
+import numpy as np
+
+# Record of the progress of cropping a FOV, so that an interrupted crop can be resumed. CROP_MANIFEST_FILENAME
+# describes the crop (input, parameters, ignored regions and plane counts), and CROP_PROGRESS_FILENAME holds one byte per
+# (frame, z, channel) plane, set once that plane has been written to every region. Each plane has its own byte, so crop
+# processes can mark planes in any order without coordinating, and a resumed crop can use any number of processes.
+
+CROP_MANIFEST_FILENAME = "crop_manifest.json"
+CROP_PROGRESS_FILENAME = "crop_progress.bin"
+
+
+class CropProgress:
+    def __init__(self, fov_output_path: str, shape: Tuple[int, int, int], writable: bool = False) -> None:
+        # (frames, z positions, channels)
+        self.shape = shape
+        self.completed: np.memmap = np.memmap(os.path.join(fov_output_path, CROP_PROGRESS_FILENAME), dtype=np.uint8,
+                                              mode="r+" if writable else "r", shape=shape)
+
+    def is_complete(self, frame_id: int, zstack_id: int, channel_id: int) -> bool:
+        return bool(self.completed[frame_id, zstack_id, channel_id])
+
+    def is_frame_complete(self, frame_id: int) -> bool:
+        return bool(np.all(self.completed[frame_id]))
+
+    def mark_complete(self, frame_id: int, zstack_id: int, channel_id: int) -> None:
+        self.completed[frame_id, zstack_id, channel_id] = 1
+
+    def count_complete(self) -> int:
+        return int(np.count_nonzero(self.completed))
+
+    def flush(self) -> None:
+        self.completed.flush()
+
+
+def has_crop_manifest(fov_output_path: str) -> bool:
+    return os.path.isfile(os.path.join(fov_output_path, CROP_MANIFEST_FILENAME))
+
+
+def load_crop_manifest(fov_output_path: str) -> Dict[str, Any]:
+    with open(os.path.join(fov_output_path, CROP_MANIFEST_FILENAME), "r") as handle:
+        return json.load(handle)
+
+
+# Start recording a new crop, with no planes complete. The manifest is written last, so a crop only counts as
+# resumable once its progress file exists.
+def create_crop_manifest(fov_output_path: str, description: Dict[str, Any], shape: Tuple[int, int, int]) -> None:
+    os.makedirs(fov_output_path, exist_ok=True)
+    with open(os.path.join(fov_output_path, CROP_PROGRESS_FILENAME), "wb") as progress_file:
+        progress_file.truncate(int(np.prod(shape)))
+
+    manifest_filename = os.path.join(fov_output_path, CROP_MANIFEST_FILENAME)
+    with open(manifest_filename + ".tmp", "w") as handle:
+        json.dump({"description": description, "shape": list(shape)}, handle)
+    os.replace(manifest_filename + ".tmp", manifest_filename)
+
+
+# Whether an existing manifest describes the same crop. Descriptions are compared as JSON, so tuples match lists.
+def manifest_matches(manifest: Dict[str, Any], description: Dict[str, Any], shape: Tuple[int, int, int]) -> bool:
+    return manifest["description"] == json.loads(json.dumps(description)) and manifest["shape"] == list(shape)
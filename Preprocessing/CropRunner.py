@@ -0,0 +1,133 @@
+import os
+import sys
+import signal
+from multiprocessing import Pool
+from multiprocessing.connection import Connection
+from typing import List, Tuple, Optional, Dict
+import numpy as np
+from Preprocessing.ND2Frames import ND2Frames
+from Preprocessing.ImageCropper import ImageCropper, CropParameters, DRIFT_FILENAME
+
+# Headless crop runner, dividing the cropping of one or more FOVs between a pool of processes.
+# Drift trajectories are calculated (or loaded) first with one task per FOV, then frames are cropped in chunks of
+# FRAMES_PER_TASK, with each task given its FOV's precomputed trajectory and writing into its FOV's region stacks.
+# Progress is reported with the RunningDialog protocol: (completed, total) tuples, or a string on error.
+
+FRAMES_PER_TASK = 5
+CROP_PROCESSES = os.cpu_count() or 1
+
+# Each worker process opens its own reader for the ND2 file, as readers can't be shared between processes
+_worker_cropper: Optional[ImageCropper] = None
+_worker_ignored_regions: Dict[int, List[int]] = {}
+
+
+def _init_worker(filename: str, parameters: CropParameters, ignored_regions: Dict[int, List[int]]) -> None:
+    global _worker_cropper, _worker_ignored_regions
+    _worker_cropper = ImageCropper(ND2Frames(filename), parameters)
+    _worker_ignored_regions = ignored_regions
+
+
+def _set_ignored_regions(cropper: ImageCropper, ignored_region_ids: List[int]) -> None:
+    for region_id, region in enumerate(cropper.crop_regions):
+        region.ignored = region_id in ignored_region_ids
+
+
+def _prepare_drift(task: Tuple[int, str]) -> Tuple[int, List[Tuple[float, float]], Optional[str]]:
+    fov_id, fov_output_path = task
+    # FOVs are already processed in parallel, so trap detection within a FOV uses a single thread
+    error = _worker_cropper.prepare_drift_trajectory(fov_id, fov_output_path, threads=1)
+    return fov_id, _worker_cropper.drift_trajectories.get(fov_id, []), error
+
+
+def _crop_chunk(task: Tuple[int, range, str, List[Tuple[float, float]], int]) -> Tuple[int, Optional[str]]:
+    fov_id, frame_ids, fov_output_path, trajectory, threads = task
+    _worker_cropper.drift_trajectories[fov_id] = trajectory
+    _set_ignored_regions(_worker_cropper, _worker_ignored_regions[fov_id])
+    planes_completed = 0
+
+    def plane_completed() -> None:
+        nonlocal planes_completed
+        planes_completed += 1
+
+    error = _worker_cropper.crop_frames(fov_id, frame_ids, fov_output_path, plane_completed, threads=threads)
+    return planes_completed, error
+
+
+# Drift trajectory of each FOV in fov_ids, calculated by a pool of processes with one task per FOV, skipping those the
+# cropper already has in full. Trajectories are saved in each FOV's output folder, given by fov_paths. Returns the
+# trajectories (empty if drift isn't corrected), and an error message on failure.
+def prepare_drift_trajectories(cropper: ImageCropper, fov_ids: List[int], fov_paths: Dict[int, str], processes: int = CROP_PROCESSES) \
+        -> Tuple[Dict[int, List[Tuple[float, float]]], Optional[str]]:
+    trajectories: Dict[int, List[Tuple[float, float]]] = {}
+    drift_tasks: List[Tuple[int, str]] = []
+    for fov_id in fov_ids:
+        if not cropper.parameters.correct_drift:
+            trajectories[fov_id] = []
+        elif len(cropper.drift_trajectories.get(fov_id, [])) >= cropper.frames.num_frames:
+            trajectories[fov_id] = cropper.drift_trajectories[fov_id]
+            try:
+                os.makedirs(fov_paths[fov_id], exist_ok=True)
+                cropper.save_drift_trajectory(fov_id, fov_paths[fov_id] + "/" + DRIFT_FILENAME)
+            except OSError:
+                return trajectories, "Can't save drift trajectory for FOV {}".format(fov_id)
+        else:
+            drift_tasks.append((fov_id, fov_paths[fov_id]))
+
+    if len(drift_tasks) > 0:
+        with Pool(processes=min(processes, len(drift_tasks)), initializer=_init_worker,
+                  initargs=(cropper.frames.filename, cropper.parameters, {})) as pool:
+            for fov_id, trajectory, error in pool.imap_unordered(_prepare_drift, drift_tasks):
+                if error is not None:
+                    return trajectories, error
+                trajectories[fov_id] = trajectory
+    return trajectories, None
+
+
+# Crop all frames, channels and z positions of each FOV in fov_ids, using the cropper's parameters and any drift
+# trajectories it has already calculated. Regions to ignore can be given for each FOV, otherwise the cropper's ignored
+# regions are used for all FOVs.
+def run_crop(cropper: ImageCropper, fov_ids: List[int], output_path: str, progress_callback: Connection,
+             processes: int = CROP_PROCESSES, frames_per_task: int = FRAMES_PER_TASK,
+             ignored_regions: Optional[Dict[int, List[int]]] = None) -> None:
+    frames: ND2Frames = cropper.frames
+    if ignored_regions is None:
+        cropper_ignored: List[int] = [region_id for region_id, region in enumerate(cropper.crop_regions) if region.ignored]
+        ignored_regions = {fov_id: cropper_ignored for fov_id in fov_ids}
+    fov_paths: Dict[int, str] = {fov_id: cropper.fov_output_path(output_path, fov_id) for fov_id in fov_ids}
+
+    total_images: int = len(fov_ids) * int(np.prod(cropper.output_shape()))
+    images_completed: int = 0
+
+    trajectories, error = prepare_drift_trajectories(cropper, fov_ids, fov_paths, processes)
+    if error is not None:
+        progress_callback.send(error)
+        return
+
+    with Pool(processes=processes, initializer=_init_worker, initargs=(frames.filename, cropper.parameters, ignored_regions)) as pool:
+        # Output is set up before cropping, so that tasks for different frames can fill region stacks in parallel.
+        # Resumed crops skip planes already recorded as complete, however many processes the earlier run used.
+        for fov_id in fov_ids:
+            _set_ignored_regions(cropper, ignored_regions[fov_id])
+            error = cropper.prepare_crop_output(fov_id, fov_paths[fov_id])
+            if error is not None:
+                progress_callback.send(error)
+                return
+
+        # Each process encodes regions with its share of the CPUs
+        threads: int = max(1, (os.cpu_count() or 1) // processes)
+        crop_tasks = [(fov_id, range(start, min(start + frames_per_task, frames.num_frames)), fov_paths[fov_id], trajectories[fov_id], threads)
+                      for fov_id in fov_ids for start in range(0, frames.num_frames, frames_per_task)]
+
+        for planes_completed, error in pool.imap_unordered(_crop_chunk, crop_tasks):
+            if error is not None:
+                progress_callback.send(error)
+                return
+
+            images_completed += planes_completed
+            progress_callback.send((images_completed, total_images))
+
+
+# Target for running run_crop in its own process. Terminating that process also stops its pool of workers.
+def run_crop_process(cropper: ImageCropper, fov_ids: List[int], output_path: str, progress_callback: Connection) -> None:
+    signal.signal(signal.SIGTERM, lambda _signal, _frame: sys.exit(1))
+    run_crop(cropper, fov_ids, output_path, progress_callback)
@@ -1,11 +1,22 @@
-from dataclasses import dataclass
-from typing import Tuple, List, Optional
+from dataclasses import dataclass, asdict, fields
+from typing import Tuple, List, Optional, Dict, Iterable, Callable, Any
 from multiprocessing.connection import Connection
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import cv2
 import os
+import json
+from enum import Enum
 from Preprocessing.ND2Frames import ND2Frames
-from Segmentation.Utilities import find_holes, fill_holes, find_background, increase_contrast, rotate_image
+from Preprocessing.PlaneCache import PlaneCache
+from Preprocessing.OverviewPyramid import OverviewPyramid
+from Preprocessing.RegionStack import RegionStack, create_region_stack, image_name, is_region_stack, list_region_images
+from Preprocessing.CropManifest import CropProgress, has_crop_manifest, load_crop_manifest, create_crop_manifest, manifest_matches
+from Preprocessing.VirtualCrop import VirtualCropManifest, save_virtual_crop_manifest, VIRTUAL_CROP_FILENAME
+from Preprocessing.StackCodec import OutputCodec, tiff_parameters
+from Preprocessing.RawTiff import write_raw_tiff
+from Preprocessing.ZReduction import ZReduction, FocusMetric, reduce_zstack
+from Segmentation.Utilities import find_holes, fill_holes, find_background, increase_contrast, rotate_image, rotate_crop
 
 
 @dataclass
@@ -23,6 +34,62 @@ class CropParameters:
     min_trap_size: int
     max_trap_size: int
     alternate_trap_detection: bool
+    # Estimate drift by phase correlation of frames downsampled by drift_downsample, rather than by matching traps
+    phase_correlation_drift: bool = False
+    drift_downsample: int = 4
+    # Save each region as a single image stack, rather than as one TIFF per plane
+    stack_output: bool = True
+    # Reduce each region's z-stack to one plane per channel, saved as z position 0 (see ZReduction). Focus is judged in
+    # focus_channel.
+    z_reduction: ZReduction = ZReduction.NONE
+    focus_metric: FocusMetric = FocusMetric.LOWEST_VARIANCE
+    focus_channel: int = 0
+    # Lossless compression of saved regions (see StackCodec)
+    output_codec: OutputCodec = OutputCodec.NONE
+
+
+# Number of threads used to detect traps when calculating a drift trajectory. Frames are read in batches of this size.
+DRIFT_DETECTION_THREADS = os.cpu_count() or 1
+DRIFT_FILENAME = "drift.json"
+# Phase correlations with a weaker peak than this fall back to trap matching for that pair of frames
+MIN_PHASE_CORRELATION_RESPONSE = 0.05
+# Size of the full resolution patch used to refine the downsampled phase correlation estimate
+PHASE_CORRELATION_PATCH_SIZE = 256
+# Number of threads cropping and encoding regions in crop_frames
+ENCODING_THREADS = os.cpu_count() or 1
+
+
+# Parameters as JSON-compatible values, with enums saved by name
+def crop_parameters_to_dict(parameters: CropParameters) -> Dict[str, Any]:
+    return {name: value.name if isinstance(value, Enum) else value for name, value in asdict(parameters).items()}
+
+
+def save_crop_parameters(parameters: CropParameters, filename: str) -> None:
+    with open(filename, 'w') as handle:
+        json.dump(crop_parameters_to_dict(parameters), handle, indent=4)
+
+
+# Load parameters saved by save_crop_parameters. Parameters added since the file was saved take their default values.
+def load_crop_parameters(filename: str) -> CropParameters:
+    with open(filename, 'r') as handle:
+        saved: Dict[str, Any] = json.load(handle)
+
+    names = [field.name for field in fields(CropParameters)]
+    unknown = [name for name in saved if name not in names]
+    if len(unknown) > 0:
+        raise ValueError("Unknown crop parameters in {}: {}".format(filename, ", ".join(unknown)))
+
+    # JSON has no tuples, so lists are converted back, and enums are looked up by name
+    types: Dict[str, Any] = {field.name: field.type for field in fields(CropParameters)}
+    for name, value in saved.items():
+        if isinstance(value, list):
+            saved[name] = tuple(value)
+        elif isinstance(types[name], type) and issubclass(types[name], Enum):
+            try:
+                saved[name] = types[name][value]
+            except KeyError:
+                raise ValueError("Unknown value {} for crop parameter {} in {}".format(value, name, filename))
+    return CropParameters(**saved)
 
 
 @dataclass()
@@ -46,14 +113,14 @@ class ImageCropper(object):
     def __init__(self, frames: ND2Frames, parameters: CropParameters) -> None:
         self.frames: ND2Frames = frames
         self.parameters: CropParameters = parameters
-        self.current_offset: Tuple[float, float] = (0, 0)
 
-        self.prev_frame_traps: Optional[List[Tuple[float, float]]] = None
+        # Cumulative drift of each frame relative to the first frame, per FOV, calculated up to the latest frame needed.
+        # Drift features (see _find_drift_features) of the last frame of each trajectory are kept to allow it to be extended.
+        self.drift_trajectories: Dict[int, List[Tuple[float, float]]] = {}
+        self.trajectory_end_features: Dict[int, Any] = {}
         self.crop_regions: List[CropRegion] = self._calculate_crop_regions()
 
     def reset_offset(self) -> None:
-        self.current_offset = (0, 0)
-        self.prev_frame_traps = None
         for region in self.crop_regions:
             region.ignored = False
 
@@ -62,6 +129,132 @@ class ImageCropper(object):
         self.parameters = parameters
         self.crop_regions = self._calculate_crop_regions()
 
+        # Trap detection may have changed, so drift has to be recalculated
+        self.drift_trajectories = {}
+        self.trajectory_end_features = {}
+
+    # Cumulative drift of a frame relative to the first frame of the FOV
+    def get_offset(self, frame_id: int, fov_id: int) -> Tuple[float, float]:
+        if not self.parameters.correct_drift:
+            return 0, 0
+
+        self.calculate_drift_trajectory(fov_id, frame_id + 1)
+        return self.drift_trajectories[fov_id][frame_id]
+
+    # Extend the drift trajectory of a FOV to cover its first num_frames frames, finding drift features in each frame once
+    def calculate_drift_trajectory(self, fov_id: int, num_frames: Optional[int] = None, threads: int = DRIFT_DETECTION_THREADS) -> None:
+        if num_frames is None:
+            num_frames = self.frames.num_frames
+
+        offsets = self.drift_trajectories.setdefault(fov_id, [])
+        if len(offsets) >= num_frames:
+            return
+        # Frames are read and searched for features in batches of one per thread
+        threads = max(1, threads)
+
+        def read_frame(frame_id: int) -> np.ndarray:
+            return self.frames.read_planes(frame_id, fov_id, [self.parameters.trap_detection_channel],
+                                           [self.parameters.trap_detection_z_position])[0, 0]
+
+        # A trajectory loaded from file doesn't have the features of its last frame
+        if len(offsets) > 0 and fov_id not in self.trajectory_end_features:
+            self.trajectory_end_features[fov_id] = self._find_drift_features(read_frame(len(offsets) - 1))
+
+        pool = ThreadPool(threads) if threads > 1 else None
+        try:
+            for batch_start in range(len(offsets), num_frames, threads):
+                batch_frames = [read_frame(frame_id) for frame_id in range(batch_start, min(batch_start + threads, num_frames))]
+                if pool is not None:
+                    batch_features = pool.map(self._find_drift_features, batch_frames)
+                else:
+                    batch_features = [self._find_drift_features(frame) for frame in batch_frames]
+
+                for features in batch_features:
+                    if len(offsets) == 0:
+                        offsets.append((0, 0))
+                    else:
+                        offset: Tuple[float, float] = self._calculate_drift_offset(features, self.trajectory_end_features[fov_id])
+                        offsets.append((offsets[-1][0] + offset[0], offsets[-1][1] + offset[1]))
+                    self.trajectory_end_features[fov_id] = features
+        finally:
+            if pool is not None:
+                pool.close()
+
+    def save_drift_trajectory(self, fov_id: int, filename: str) -> None:
+        with open(filename, 'w') as handle:
+            json.dump({"parameters": self._drift_parameters(), "offsets": self.drift_trajectories[fov_id]}, handle)
+
+    # Load a previously saved trajectory, if it was calculated with the current trap detection parameters
+    def load_drift_trajectory(self, fov_id: int, filename: str) -> bool:
+        if not os.path.isfile(filename):
+            return False
+
+        with open(filename, 'r') as handle:
+            saved = json.load(handle)
+
+        if saved["parameters"] != self._drift_parameters():
+            print("Ignoring drift trajectory {}, calculated with different trap detection parameters".format(filename))
+            return False
+
+        if len(saved["offsets"]) > len(self.drift_trajectories.get(fov_id, [])):
+            self.drift_trajectories[fov_id] = [tuple(offset) for offset in saved["offsets"]]
+            self.trajectory_end_features.pop(fov_id, None)
+        return True
+
+    def _drift_parameters(self) -> Dict:
+        parameters = asdict(self.parameters)
+        return {key: parameters[key] for key in ["trap_detection_channel", "trap_detection_z_position", "min_trap_size",
+                                                 "max_trap_size", "alternate_trap_detection", "phase_correlation_drift",
+                                                 "drift_downsample"]}
+
+    # Per-frame data used to estimate drift between consecutive frames: trap centroids, or for phase correlation the
+    # windowed downsampled frame along with the full frame, kept in case trap matching is needed as a fallback
+    def _find_drift_features(self, image: np.ndarray) -> Any:
+        if not self.parameters.phase_correlation_drift:
+            return self._find_trap_locations(image)
+
+        downsample: int = max(1, self.parameters.drift_downsample)
+        size = (max(1, image.shape[1] // downsample), max(1, image.shape[0] // downsample))
+        small = cv2.resize(image.astype(np.float32), size, interpolation=cv2.INTER_AREA)
+        # Remove the mean and taper the edges, so that the frame borders don't dominate the correlation
+        small = (small - np.mean(small)) * cv2.createHanningWindow(size, cv2.CV_32F)
+        return small, image
+
+    # Offset of the image 1 frame relative to the image 2 frame, in the same convention as _calculate_xy_offset
+    def _calculate_drift_offset(self, image_1_features: Any, image_2_features: Any) -> Tuple[float, float]:
+        if not self.parameters.phase_correlation_drift:
+            return self._calculate_xy_offset(image_1_features, image_2_features)
+
+        (small_1, image_1), (small_2, image_2) = image_1_features, image_2_features
+        (shift_x, shift_y), response = cv2.phaseCorrelate(small_1, small_2)
+
+        if response < MIN_PHASE_CORRELATION_RESPONSE:
+            print("Warning: weak phase correlation ({:.3f}), using trap matching instead".format(response))
+            return self._calculate_xy_offset(self._find_trap_locations(image_1), self._find_trap_locations(image_2))
+
+        # Scale back up, allowing for frame sizes that aren't a multiple of the downsampling factor
+        coarse_x = int(round(shift_x * image_1.shape[1] / small_1.shape[1]))
+        coarse_y = int(round(shift_y * image_1.shape[0] / small_1.shape[0]))
+
+        # Refine to sub-pixel precision by correlating a full resolution patch from the centre of image 1 with the patch
+        # at the coarse shift in image 2
+        half_size = PHASE_CORRELATION_PATCH_SIZE // 2
+        min_y, max_y = half_size + max(0, -coarse_y), image_1.shape[0] - half_size - max(0, coarse_y)
+        min_x, max_x = half_size + max(0, -coarse_x), image_1.shape[1] - half_size - max(0, coarse_x)
+        if min_y > max_y or min_x > max_x:
+            return coarse_x, coarse_y
+        centre_y = min(max(image_1.shape[0] // 2, min_y), max_y)
+        centre_x = min(max(image_1.shape[1] // 2, min_x), max_x)
+
+        patch_1 = image_1[centre_y - half_size:centre_y + half_size, centre_x - half_size:centre_x + half_size]
+        patch_2 = image_2[centre_y + coarse_y - half_size:centre_y + coarse_y + half_size,
+                          centre_x + coarse_x - half_size:centre_x + coarse_x + half_size]
+        window = cv2.createHanningWindow((2 * half_size, 2 * half_size), cv2.CV_32F)
+        patch_1 = patch_1.astype(np.float32)
+        patch_2 = patch_2.astype(np.float32)
+        (residual_x, residual_y), _ = cv2.phaseCorrelate((patch_1 - np.mean(patch_1)) * window, (patch_2 - np.mean(patch_2)) * window)
+        return coarse_x + residual_x, coarse_y + residual_y
+
     # Toggle region located at point to be ignored during crop process
     def flag_region(self, point: Tuple[int, int]) -> None:
         for region in self.crop_regions:
@@ -70,9 +263,19 @@ class ImageCropper(object):
                 break
 
     # Calculates grid locations and overlays them on image
-    def generate_preview(self, frame_id: int, fov_id: int, channel_id: int, zstack_id: int) -> np.ndarray:
-        # Generate colour image for grid display
-        frame = self.frames[self.frames.calculate_position(frame_id, fov_id, channel_id, zstack_id)]
+    def generate_preview(self, frame_id: int, fov_id: int, channel_id: int, zstack_id: int,
+                         plane_cache: Optional[PlaneCache] = None, overview: Optional[OverviewPyramid] = None,
+                         overview_level: Optional[int] = None) -> np.ndarray:
+        # Generate colour image for grid display, from an overview level if given, in which case the grid is drawn scaled
+        # down to the level's size
+        scale_x, scale_y = 1.0, 1.0
+        if overview is not None and overview_level is not None:
+            frame = overview.read_plane(overview_level, frame_id, fov_id, channel_id, zstack_id)
+            scale_x, scale_y = overview.level_scale(overview_level)
+        elif plane_cache is not None:
+            frame = plane_cache.get_plane(frame_id, fov_id, channel_id, zstack_id)
+        else:
+            frame = self.frames[self.frames.calculate_position(frame_id, fov_id, channel_id, zstack_id)]
         scaled_frame = (frame / 256).astype(np.uint8)
         output: np.ndarray = np.stack((scaled_frame, scaled_frame, scaled_frame), axis=2)
 
@@ -80,91 +283,287 @@ class ImageCropper(object):
             output = rotate_image(output, self.parameters.angle)
         output = increase_contrast(output)
 
-        # Calculate offset from previous frame
+        # Look up offset from the first frame
+        offset: Tuple[float, float] = self.get_offset(frame_id, fov_id)
         if self.parameters.correct_drift:
-            new_frame = self.frames[self.frames.calculate_position(frame_id, fov_id, self.parameters.trap_detection_channel, self.parameters.trap_detection_z_position)]
-            new_traps: List[Tuple[float, float]] = self._find_trap_locations(new_frame)
-
-            if self.prev_frame_traps is not None:
-                offset: Tuple[float, float] = self._calculate_xy_offset(new_traps, self.prev_frame_traps)
-                print("New offset: {}".format(offset))
-                self.current_offset = (self.current_offset[0] + offset[0], self.current_offset[1] + offset[1])
-                print("Cumulative offset: {}".format(self.current_offset))
-            self.prev_frame_traps = new_traps
-        else:
-            self.current_offset = (0, 0)
+            print("Cumulative offset: {}".format(offset))
 
         # Adjust region locations by offset
+        thickness = max(1, round(5 / scale_x))
         for rect in self.crop_regions:
-            x = rect.x - round(self.current_offset[0])
-            y = rect.y - round(self.current_offset[1])
-            output = cv2.line(output, (x, y), (x + rect.width, y), (255, 0, 0), 5)
-            output = cv2.line(output, (x, y), (x, y + rect.height), (255, 0, 0), 5)
-            output = cv2.line(output, (x + rect.width, y), (x + rect.width, y + rect.height), (255, 0, 0), 5)
-            output = cv2.line(output, (x, y + rect.height), (x + rect.width, y + rect.height), (255, 0, 0), 5)
+            x = round((rect.x - round(offset[0])) / scale_x)
+            y = round((rect.y - round(offset[1])) / scale_y)
+            width = round(rect.width / scale_x)
+            height = round(rect.height / scale_y)
+            output = cv2.line(output, (x, y), (x + width, y), (255, 0, 0), thickness)
+            output = cv2.line(output, (x, y), (x, y + height), (255, 0, 0), thickness)
+            output = cv2.line(output, (x + width, y), (x + width, y + height), (255, 0, 0), thickness)
+            output = cv2.line(output, (x, y + height), (x + width, y + height), (255, 0, 0), thickness)
 
             if rect.ignored:
-                output = cv2.line(output, (x, y), (x + rect.width, y + rect.height), (255, 0, 0), 5)
-                output = cv2.line(output, (x + rect.width, y), (x, y + rect.height), (255, 0, 0), 5)
+                output = cv2.line(output, (x, y), (x + width, y + height), (255, 0, 0), thickness)
+                output = cv2.line(output, (x + width, y), (x, y + height), (255, 0, 0), thickness)
         return output
 
     # Crop images at all timepoints, all channels and all z positions for a given FOV
     def crop_all(self, fov_id: int, output_path: str, progress_callback: Connection) -> None:
-        total_images: int = self.frames.num_frames * self.frames.num_channels * self.frames.num_zstack
+        total_images: int = int(np.prod(self.output_shape()))
         images_completed: int = 0
 
-        input_name = os.path.basename(self.frames.filename).split(".")[0]
-        output_path += "/" + input_name + "/fov_{}".format(fov_id)
+        output_path = self.fov_output_path(output_path, fov_id)
 
-        cumulative_offset: Tuple[float, float] = (0, 0)
+        error: Optional[str] = self.prepare_drift_trajectory(fov_id, output_path)
+        if error is None:
+            error = self.prepare_crop_output(fov_id, output_path)
+        if error is not None:
+            progress_callback.send(error)
+            return
 
-        for frame_id in range(self.frames.num_frames):
-            if frame_id > 0 and self.parameters.correct_drift:
-                prev_frame = self.frames[self.frames.calculate_position(frame_id - 1, fov_id, self.parameters.trap_detection_channel, self.parameters.trap_detection_z_position)]
-                frame = self.frames[self.frames.calculate_position(frame_id, fov_id, self.parameters.trap_detection_channel, self.parameters.trap_detection_z_position)]
+        def plane_completed() -> None:
+            nonlocal images_completed
+            images_completed += 1
+            progress_callback.send((images_completed, total_images))
 
-                traps_1: List[Tuple[float, float]] = self._find_trap_locations(prev_frame)
-                traps_2: List[Tuple[float, float]] = self._find_trap_locations(frame)
-                offset: Tuple[float, float] = self._calculate_xy_offset(traps_2, traps_1)
-                cumulative_offset = (cumulative_offset[0] + offset[0], cumulative_offset[1] + offset[1])
+        error = self.crop_frames(fov_id, range(self.frames.num_frames), output_path, plane_completed)
+        if error is not None:
+            progress_callback.send(error)
 
-            for zstack_id in range(self.frames.num_zstack):
-                for channel_id in range(self.frames.num_channels):
-                    frame = self.frames[self.frames.calculate_position(frame_id, fov_id, channel_id, zstack_id)]
+    # (frames, z positions, channels) saved for each region, with one z position if z-stacks are reduced
+    def output_shape(self) -> Tuple[int, int, int]:
+        num_zstack: int = 1 if self.parameters.z_reduction != ZReduction.NONE else self.frames.num_zstack
+        return self.frames.num_frames, num_zstack, self.frames.num_channels
 
-                    if self.parameters.angle != 0:
-                        rotated = rotate_image(frame, self.parameters.angle)
-                    else:
-                        rotated = frame
-
-                    for region_id in range(len(self.crop_regions)):
-                        region = self.crop_regions[region_id]
-
-                        if not region.ignored:
-                            full_output_path: str = output_path + "/region_{}/".format(region_id)
-
-                            try:
-                                os.makedirs(full_output_path, exist_ok=True)
-                            except OSError:
-                                progress_callback.send("Can't create output folder: {}".format(full_output_path))
-                                return
-
-                            filename: str = full_output_path + "frame_{}_z_{}_channel_{}.tif".format(frame_id, zstack_id, channel_id)
-                            if not os.path.isfile(filename):
-                                x = region.x - round(cumulative_offset[0])
-                                y = region.y - round(cumulative_offset[1])
-                                output = rotated[y: y + region.height, x:x + region.width]
-                                result = cv2.imwrite(filename, output)
-
-                                if not result:
-                                    progress_callback.send("Error saving image: {}".format(filename))
-                                    return
-                            else:
-                                progress_callback.send("Can't save image: {} already exists".format(filename))
-                                return
+    # Output folder for a FOV: <output_path>/<nd2 name>/fov_<fov_id>
+    def fov_output_path(self, output_path: str, fov_id: int) -> str:
+        input_name = os.path.basename(self.frames.filename).split(".")[0]
+        return output_path + "/" + input_name + "/fov_{}".format(fov_id)
 
-                    images_completed += 1
-                    progress_callback.send((images_completed, total_images))
+    # Calculate drift for the whole time-lapse up front, reusing a trajectory saved by an earlier crop of this FOV.
+    # Returns an error message on failure.
+    def prepare_drift_trajectory(self, fov_id: int, fov_output_path: str, threads: int = DRIFT_DETECTION_THREADS) -> Optional[str]:
+        if self.parameters.correct_drift:
+            drift_filename: str = fov_output_path + "/" + DRIFT_FILENAME
+            if not self.load_drift_trajectory(fov_id, drift_filename):
+                self.calculate_drift_trajectory(fov_id, threads=threads)
+
+                try:
+                    os.makedirs(fov_output_path, exist_ok=True)
+                    self.save_drift_trajectory(fov_id, drift_filename)
+                except OSError:
+                    return "Can't save drift trajectory: {}".format(drift_filename)
+        return None
+
+    # Save a virtual crop of a FOV (see VirtualCrop), for which region images are read directly from the ND2 file rather
+    # than saved. Returns an error message on failure.
+    def save_virtual_crop(self, fov_id: int, output_path: str) -> Optional[str]:
+        fov_output_path: str = self.fov_output_path(output_path, fov_id)
+
+        error: Optional[str] = self.prepare_drift_trajectory(fov_id, fov_output_path)
+        if error is not None:
+            return error
+
+        manifest = VirtualCropManifest(nd2_filename=os.path.abspath(self.frames.filename),
+                                       fov_id=fov_id,
+                                       angle=self.parameters.angle,
+                                       num_frames=self.frames.num_frames,
+                                       num_zstack=self.frames.num_zstack,
+                                       num_channels=self.frames.num_channels,
+                                       regions={region_id: (region.x, region.y, region.width, region.height)
+                                                for region_id, region in enumerate(self.crop_regions) if not region.ignored},
+                                       offsets=[self.get_offset(frame_id, fov_id) for frame_id in range(self.frames.num_frames)])
+
+        manifest_filename: str = fov_output_path + "/" + VIRTUAL_CROP_FILENAME
+        try:
+            for region_id in manifest.regions:
+                os.makedirs(fov_output_path + "/region_{}".format(region_id), exist_ok=True)
+            save_virtual_crop_manifest(manifest, manifest_filename)
+        except OSError:
+            return "Can't save virtual crop: {}".format(manifest_filename)
+        return None
+
+    # Set up the output folder of a FOV for crop_frames. A new crop starts a crop manifest, while a crop with a manifest
+    # is resumed if it was started with the same parameters and ignored regions. Any missing region folders or image
+    # stacks are then created. Returns an error message on failure.
+    def prepare_crop_output(self, fov_id: int, fov_output_path: str) -> Optional[str]:
+        shape: Tuple[int, int, int] = self.output_shape()
+        description: Dict = self._crop_description(fov_id)
+        region_paths: Dict[int, str] = {region_id: fov_output_path + "/region_{}".format(region_id)
+                                        for region_id, region in enumerate(self.crop_regions) if not region.ignored}
+
+        try:
+            if has_crop_manifest(fov_output_path):
+                if not manifest_matches(load_crop_manifest(fov_output_path), description, shape):
+                    return "Can't resume crop: {} was cropped with different parameters".format(fov_output_path)
+            else:
+                # Images without a manifest weren't cropped by a resumable crop, so aren't overwritten
+                for region_path in region_paths.values():
+                    if is_region_stack(region_path) or (os.path.isdir(region_path) and len(list_region_images(region_path)) > 0):
+                        return "Can't save images: {} already exists".format(region_path)
+                create_crop_manifest(fov_output_path, description, shape)
+
+            dtype: Optional[np.dtype] = None
+            for region_id, region_path in region_paths.items():
+                if not self.parameters.stack_output:
+                    os.makedirs(region_path, exist_ok=True)
+                elif not is_region_stack(region_path):
+                    if dtype is None:
+                        dtype = self.frames[self.frames.calculate_position(0, fov_id, 0, 0)].dtype
+                    region = self.crop_regions[region_id]
+                    create_region_stack(region_path, shape + (region.height, region.width), dtype, self.parameters.output_codec)
+        except OSError:
+            return "Can't create crop output: {}".format(fov_output_path)
+        return None
+
+    # What a crop manifest records about a crop of a FOV, to check that a resumed crop matches the original
+    def _crop_description(self, fov_id: int) -> Dict:
+        return {"input": os.path.basename(self.frames.filename),
+                "fov": fov_id,
+                "parameters": crop_parameters_to_dict(self.parameters),
+                "ignored_regions": [region_id for region_id, region in enumerate(self.crop_regions) if region.ignored]}
+
+    # Crop the given frames at all channels and z positions, calling plane_completed after each plane is written, or
+    # found already complete in the crop manifest. prepare_crop_output must have been called for the FOV first.
+    # Regions are cropped, encoded and saved by a pool of threads, one region per task, as OpenCV and zlib release the
+    # GIL while they work. Returns an error message on failure.
+    def crop_frames(self, fov_id: int, frame_ids: Iterable[int], fov_output_path: str, plane_completed: Callable[[], None],
+                    threads: int = ENCODING_THREADS) -> Optional[str]:
+        shape: Tuple[int, int, int] = self.output_shape()
+        try:
+            progress: CropProgress = CropProgress(fov_output_path, shape, writable=True)
+        except OSError:
+            return "Can't open crop progress: {}".format(fov_output_path)
+
+        region_ids: List[int] = [region_id for region_id, region in enumerate(self.crop_regions) if not region.ignored]
+        stacks: Dict[int, RegionStack] = {}
+        if self.parameters.stack_output:
+            for region_id in region_ids:
+                region_path: str = fov_output_path + "/region_{}".format(region_id)
+                try:
+                    stacks[region_id] = RegionStack(region_path, writable=True)
+                except OSError:
+                    return "Can't open image stack: {}".format(region_path)
+
+        # All planes of a frame are read together, into one buffer reused for every frame
+        planes: Optional[np.ndarray] = None
+
+        pool = ThreadPool(threads) if threads > 1 else None
+        map_tasks = pool.map if pool is not None else lambda function, tasks: list(map(function, tasks))
+        try:
+            for frame_id in frame_ids:
+                if progress.is_frame_complete(frame_id):
+                    for _ in range(shape[1] * shape[2]):
+                        plane_completed()
+                    continue
+
+                cumulative_offset: Tuple[float, float] = self.get_offset(frame_id, fov_id)
+                planes = self.frames.read_planes(frame_id, fov_id, out=planes)
+
+                # Reduced z-stacks are written a whole frame at a time, so a frame is only complete once all its
+                # channels are
+                if self.parameters.z_reduction != ZReduction.NONE:
+                    plane_ids: List[Tuple[int, int]] = [(0, channel_id) for channel_id in range(shape[2])]
+                    errors = map_tasks(lambda region_id: self._crop_reduced_region(region_id, frame_id, planes, cumulative_offset,
+                                                                                   fov_output_path, stacks), region_ids)
+                else:
+                    plane_ids = []
+                    for zstack_id in range(shape[1]):
+                        for channel_id in range(shape[2]):
+                            if progress.is_complete(frame_id, zstack_id, channel_id):
+                                plane_completed()
+                            else:
+                                plane_ids.append((zstack_id, channel_id))
+
+                    # Regions in stacks are rotated individually, while TIFF output crops from rotated full planes
+                    sources: Dict[Tuple[int, int], np.ndarray] = {(zstack_id, channel_id): planes[channel_id, zstack_id]
+                                                                  for zstack_id, channel_id in plane_ids}
+                    if not self.parameters.stack_output and self.parameters.angle != 0:
+                        sources = dict(zip(plane_ids, map_tasks(lambda image: rotate_image(image, self.parameters.angle),
+                                                                list(sources.values()))))
+
+                    errors = map_tasks(lambda region_id: self._crop_region(region_id, frame_id, sources, cumulative_offset,
+                                                                           fov_output_path, stacks), region_ids)
+
+                error: Optional[str] = next((error for error in errors if error is not None), None)
+                if error is not None:
+                    return error
+
+                for zstack_id, channel_id in plane_ids:
+                    progress.mark_complete(frame_id, zstack_id, channel_id)
+                    plane_completed()
+        finally:
+            if pool is not None:
+                pool.close()
+
+        for stack in stacks.values():
+            stack.flush()
+        progress.flush()
+        return None
+
+    # Crop one region from each of the given (z position, channel) planes of a frame, and save it
+    def _crop_region(self, region_id: int, frame_id: int, sources: Dict[Tuple[int, int], np.ndarray],
+                     cumulative_offset: Tuple[float, float], fov_output_path: str, stacks: Dict[int, RegionStack]) -> Optional[str]:
+        region = self.crop_regions[region_id]
+        x = region.x - round(cumulative_offset[0])
+        y = region.y - round(cumulative_offset[1])
+
+        for (zstack_id, channel_id), source in sources.items():
+            if region_id in stacks:
+                output = rotate_crop(source, self.parameters.angle, x, y, region.width, region.height)
+            else:
+                output = source[y: y + region.height, x:x + region.width]
+
+            error: Optional[str] = self._save_region_plane(region_id, frame_id, zstack_id, channel_id, output, fov_output_path, stacks)
+            if error is not None:
+                return error
+        return None
+
+    # Crop a region from a (channel, z, y, x) block of planes, as a (channel, z, y, x) array
+    def _crop_region_planes(self, region_id: int, planes: np.ndarray, cumulative_offset: Tuple[float, float]) -> np.ndarray:
+        region = self.crop_regions[region_id]
+        x = region.x - round(cumulative_offset[0])
+        y = region.y - round(cumulative_offset[1])
+        return np.stack([[rotate_crop(planes[channel_id, zstack_id], self.parameters.angle, x, y, region.width, region.height)
+                          for zstack_id in range(planes.shape[1])] for channel_id in range(planes.shape[0])])
+
+    # Crop a frame's (channel, z, y, x) block of planes for every region that isn't ignored, in memory rather than
+    # saving them, as a new (channel, z, y, x) array per region ID
+    def crop_frame_regions(self, fov_id: int, frame_id: int, planes: np.ndarray) -> Dict[int, np.ndarray]:
+        cumulative_offset: Tuple[float, float] = self.get_offset(frame_id, fov_id)
+        return {region_id: self._crop_region_planes(region_id, planes, cumulative_offset)
+                for region_id, region in enumerate(self.crop_regions) if not region.ignored}
+
+    # Crop all planes of a frame for a region, and save the region's z-stack reduced to one plane per channel
+    def _crop_reduced_region(self, region_id: int, frame_id: int, planes: np.ndarray, cumulative_offset: Tuple[float, float],
+                             fov_output_path: str, stacks: Dict[int, RegionStack]) -> Optional[str]:
+        reduced = reduce_zstack(self._crop_region_planes(region_id, planes, cumulative_offset), self.parameters.z_reduction,
+                                self.parameters.focus_metric, self.parameters.focus_channel)
+
+        for channel_id in range(len(reduced)):
+            error: Optional[str] = self._save_region_plane(region_id, frame_id, 0, channel_id, reduced[channel_id], fov_output_path, stacks)
+            if error is not None:
+                return error
+        return None
+
+    # Save a cropped plane to its region's stack, or as a TIFF. Region folders already exist, and an incomplete plane may
+    # have been partly written by an interrupted crop, so is overwritten.
+    def _save_region_plane(self, region_id: int, frame_id: int, zstack_id: int, channel_id: int, image: np.ndarray,
+                           fov_output_path: str, stacks: Dict[int, RegionStack]) -> Optional[str]:
+        if region_id in stacks:
+            try:
+                stacks[region_id].write_plane(frame_id, zstack_id, channel_id, image)
+            except OSError:
+                return "Error saving image: {}".format(stacks[region_id].region_path)
+            return None
+
+        filename: str = fov_output_path + "/region_{}/".format(region_id) + image_name(frame_id, zstack_id, channel_id)
+        if self.parameters.output_codec == OutputCodec.NONE:
+            try:
+                write_raw_tiff(filename, image)
+            except OSError:
+                return "Error saving image: {}".format(filename)
+        elif not cv2.imwrite(filename, image, tiff_parameters(self.parameters.output_codec)):
+            return "Error saving image: {}".format(filename)
+        return None
 
     def _calculate_crop_regions(self) -> List[CropRegion]:
         img_width = self.frames.sizes['x']
@@ -194,53 +593,7 @@ class ImageCropper(object):
         return regions
 
     def _calculate_xy_offset(self, image_1_trap_centroids: List[Tuple[float, float]], image_2_trap_centroids: List[Tuple[float, float]]) -> Tuple[float, float]:
-        @dataclass
-        class TrapMapping:
-            id_1: int
-            id_2: int
-            distance: float
-
-            def __lt__(self, other) -> bool:
-                return self.distance < other.distance
-        trap_mappings: List[TrapMapping] = []
-
-        # Prevent crash when no traps can be found
-        if len(image_1_trap_centroids) == 0 or len(image_2_trap_centroids) == 0:
-            print("Warning: no traps located in image")
-            return 0, 0
-
-        # Calculate closest object in image 2 to each object in image 1
-        for id_1 in range(len(image_1_trap_centroids)):
-            point_1 = image_1_trap_centroids[id_1]
-            distances: List[float] = []
-
-            for id_2 in range(len(image_2_trap_centroids)):
-                point_2 = image_2_trap_centroids[id_2]
-                distances.append((point_1[0] - point_2[0]) ** 2. + (point_1[1] - point_2[1]) ** 2.)
-
-            trap_mappings.append(TrapMapping(id_1, int(np.argmin(distances)), np.min(distances)))
-
-        # Filter out duplicate mappings to image 2 objects
-        final_maps = []
-        for id_2 in range(len(image_2_trap_centroids)):
-            img_2_trap_maps = [mapping for mapping in trap_mappings if mapping.id_2 == id_2]
-            if len(img_2_trap_maps) > 0:
-                final_maps.append(min(img_2_trap_maps))
-
-        # Calculate xy shift, excluding any maps of distance > 1 SD from average
-        average_distance: float = np.average([mapping.distance for mapping in final_maps])
-        sd_distance: float = float(np.std([mapping.distance for mapping in final_maps]))
-        xy_shifts: List[Tuple[float, float]] = []
-
-        for mapping in final_maps:
-            if average_distance - sd_distance <= mapping.distance <= average_distance + sd_distance:
-                point_1 = image_1_trap_centroids[mapping.id_1]
-                point_2 = image_2_trap_centroids[mapping.id_2]
-
-                shift = (point_2[0] - point_1[0], point_2[1] - point_1[1])
-                xy_shifts.append(shift)
-
-        return tuple(np.average(xy_shifts, axis=0))
+        return calculate_xy_offset(image_1_trap_centroids, image_2_trap_centroids)
 
     def _generate_trap_image(self, image: np.ndarray) -> np.ndarray:
         val, thresh = cv2.threshold(image, 0, 1, cv2.THRESH_OTSU)
@@ -277,3 +630,38 @@ class ImageCropper(object):
 
         trap_image = (5 * trap_image - 4 * (labels != 0)).astype(np.uint8)
         return trap_image
+
+
+# Average shift between matching traps in two images. Each trap in image 1 is mapped to its closest trap in image 2,
+# keeping only the closest mapping to each image 2 trap, and excluding mappings more than 1 SD from the average distance
+def calculate_xy_offset(image_1_trap_centroids: List[Tuple[float, float]], image_2_trap_centroids: List[Tuple[float, float]]) -> Tuple[float, float]:
+    # Prevent crash when no traps can be found
+    if len(image_1_trap_centroids) == 0 or len(image_2_trap_centroids) == 0:
+        print("Warning: no traps located in image")
+        return 0, 0
+
+    points_1 = np.asarray(image_1_trap_centroids, dtype=float).reshape(-1, 2)
+    points_2 = np.asarray(image_2_trap_centroids, dtype=float).reshape(-1, 2)
+
+    # Squared distance between every pair of traps, and the closest image 2 trap to each image 1 trap
+    differences = points_1[:, np.newaxis, :] - points_2[np.newaxis, :, :]
+    distances = differences[:, :, 0] ** 2. + differences[:, :, 1] ** 2.
+    ids_1 = np.arange(len(points_1))
+    closest_ids_2 = np.argmin(distances, axis=1)
+    closest_distances = distances[ids_1, closest_ids_2]
+
+    # Filter out duplicate mappings to image 2 objects, keeping the closest (then lowest image 1 id) for each, in order
+    # of image 2 id
+    order = np.lexsort((ids_1, closest_distances, closest_ids_2))
+    first_of_id_2 = np.ones(len(order), dtype=bool)
+    first_of_id_2[1:] = closest_ids_2[order][1:] != closest_ids_2[order][:-1]
+    final_ids_1 = order[first_of_id_2]
+    final_distances = closest_distances[final_ids_1]
+
+    # Calculate xy shift, excluding any maps of distance > 1 SD from average
+    average_distance: float = np.average(final_distances)
+    sd_distance: float = float(np.std(final_distances))
+    within_sd = (average_distance - sd_distance <= final_distances) & (final_distances <= average_distance + sd_distance)
+
+    xy_shifts = points_2[closest_ids_2[final_ids_1[within_sd]]] - points_1[final_ids_1[within_sd]]
+    return tuple(np.average(xy_shifts, axis=0))
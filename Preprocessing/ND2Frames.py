@@ -1,5 +1,6 @@
 from pims import ND2Reader_SDK
-from typing import List
+from typing import List, Optional, Sequence, Dict
+import numpy as np
 
 
 # Small wrapper class to handle configuration of ND2 reader
@@ -52,3 +53,26 @@ class ND2Frames(ND2Reader_SDK):
         else:
             print("Warning! ND2 position out of bounds: frame {} FOV {} channel {} z {}".format(frame_id, fov_id, channel_id, zstack_id))
             return 0
+
+    # Read several planes of one frame and FOV as a (channel, z, y, x) array, by fetching each plane from the reader
+    # directly rather than through __getitem__ and the iteration axes. Defaults to all channels and z positions.
+    # Planes are written into out if given, which must have shape (channels, z positions, y, x), so that callers reading
+    # many frames can reuse one buffer.
+    def read_planes(self, frame_id: int, fov_id: int, channel_ids: Optional[Sequence[int]] = None,
+                    zstack_ids: Optional[Sequence[int]] = None, out: Optional[np.ndarray] = None) -> np.ndarray:
+        if channel_ids is None:
+            channel_ids = range(self.num_channels)
+        if zstack_ids is None:
+            zstack_ids = range(self.num_zstack)
+        if out is None:
+            out = np.empty((len(channel_ids), len(zstack_ids), self.sizes['y'], self.sizes['x']), dtype=self.pixel_type)
+
+        coords: Dict[str, int] = {axis: position for axis, position in (('t', frame_id), ('m', fov_id)) if axis in self.axes}
+        for channel_index, channel_id in enumerate(channel_ids):
+            if 'c' in self.axes:
+                coords['c'] = channel_id
+            for zstack_index, zstack_id in enumerate(zstack_ids):
+                if 'z' in self.axes:
+                    coords['z'] = zstack_id
+                out[channel_index, zstack_index] = self.get_frame_2D(**coords)
+        return out
@@ -0,0 +1,144 @@
+import os
+import json
+from dataclasses import dataclass, asdict
+from typing import Tuple, List, Optional, Callable
+import numpy as np
+import cv2
+from Preprocessing.ND2Frames import ND2Frames
+
+# On-disk pyramid of downsampled planes of an ND2 file, so that viewers showing a whole FOV in a small window don't have
+# to read and scale full resolution planes. The pyramid is a folder next to the ND2 file, holding one file per level
+# with every (frame, FOV, channel, z) plane of that level, uncompressed in that order, and a JSON index of the level
+# sizes, OVERVIEW_INDEX_FILENAME. Each level is half the size of the one before, from the largest level no bigger than
+# OVERVIEW_MAX_SIZE down to OVERVIEW_MIN_SIZE, so levels are read as slices of a memory map. The index is written last,
+# so an interrupted build leaves no pyramid.
+
+OVERVIEW_SUFFIX = ".overview"
+OVERVIEW_INDEX_FILENAME = "overview.json"
+OVERVIEW_LEVEL_FILENAME = "level_{}.bin"
+OVERVIEW_VERSION = 1
+
+OVERVIEW_MAX_SIZE = 1024
+OVERVIEW_MIN_SIZE = 256
+
+
+@dataclass
+class OverviewIndex:
+    # (frames, FOVs, channels, z positions, height, width) of the ND2 file
+    sizes: Tuple[int, int, int, int, int, int]
+    dtype: str
+    # (height, width) of each level, largest first
+    levels: List[Tuple[int, int]]
+    version: int = OVERVIEW_VERSION
+
+
+def overview_path(nd2_filename: str) -> str:
+    return os.path.splitext(nd2_filename)[0] + OVERVIEW_SUFFIX
+
+
+def _frame_sizes(frames: ND2Frames) -> Tuple[int, int, int, int, int, int]:
+    return frames.num_frames, frames.num_fovs, frames.num_channels, frames.num_zstack, frames.sizes['y'], frames.sizes['x']
+
+
+# (height, width) of each level for planes of the given size. There's always at least one level, even if max_size is
+# below OVERVIEW_MIN_SIZE.
+def _level_sizes(height: int, width: int, max_size: int) -> List[Tuple[int, int]]:
+    levels: List[Tuple[int, int]] = []
+    while True:
+        height, width = max(1, height // 2), max(1, width // 2)
+        if max(height, width) <= max_size:
+            levels.append((height, width))
+        if max(height, width) <= OVERVIEW_MIN_SIZE and len(levels) > 0:
+            return levels
+
+
+# Build the pyramid of every plane in frames, replacing any existing pyramid. Planes are read a frame and FOV at a time,
+# and each level is downsampled from the one above it. progress_callback is called with (completed, total) frames and
+# FOVs. Raises ValueError if max_size is less than 1.
+def build_overview_pyramid(frames: ND2Frames, pyramid_path: str, max_size: int = OVERVIEW_MAX_SIZE,
+                           progress_callback: Optional[Callable[[int, int], None]] = None) -> None:
+    if max_size < 1:
+        raise ValueError("Overview size must be at least 1, not {}".format(max_size))
+    sizes = _frame_sizes(frames)
+    index = OverviewIndex(sizes=sizes, dtype=np.dtype(frames.pixel_type).str, levels=_level_sizes(sizes[4], sizes[5], max_size))
+
+    os.makedirs(pyramid_path, exist_ok=True)
+    index_filename = os.path.join(pyramid_path, OVERVIEW_INDEX_FILENAME)
+    if os.path.exists(index_filename):
+        os.remove(index_filename)
+
+    level_planes: List[np.memmap] = [np.memmap(os.path.join(pyramid_path, OVERVIEW_LEVEL_FILENAME.format(level_id)),
+                                               dtype=np.dtype(index.dtype), mode="w+", shape=sizes[:4] + level_size)
+                                     for level_id, level_size in enumerate(index.levels)]
+
+    planes: Optional[np.ndarray] = None
+    total = sizes[0] * sizes[1]
+    for frame_id in range(sizes[0]):
+        for fov_id in range(sizes[1]):
+            planes = frames.read_planes(frame_id, fov_id, out=planes)
+            for channel_id in range(sizes[2]):
+                for zstack_id in range(sizes[3]):
+                    image = planes[channel_id, zstack_id]
+                    height, width = image.shape
+                    for level_id, level_size in enumerate(index.levels):
+                        # Halve down to each level in turn, including any levels above OVERVIEW_MAX_SIZE that aren't saved
+                        while (height, width) != level_size:
+                            height, width = max(1, height // 2), max(1, width // 2)
+                            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+                        level_planes[level_id][frame_id, fov_id, channel_id, zstack_id] = image
+
+            if progress_callback is not None:
+                progress_callback(frame_id * sizes[1] + fov_id + 1, total)
+
+    for planes_map in level_planes:
+        planes_map.flush()
+
+    with open(index_filename + ".tmp", "w") as index_file:
+        json.dump(asdict(index), index_file)
+    os.replace(index_filename + ".tmp", index_filename)
+
+
+class OverviewPyramid:
+    def __init__(self, pyramid_path: str) -> None:
+        with open(os.path.join(pyramid_path, OVERVIEW_INDEX_FILENAME), "r") as index_file:
+            index = json.load(index_file)
+
+        if index["version"] > OVERVIEW_VERSION:
+            raise ValueError("Unsupported overview version {} in {}".format(index["version"], pyramid_path))
+        self.index = OverviewIndex(sizes=tuple(index["sizes"]), dtype=index["dtype"],
+                                   levels=[tuple(level) for level in index["levels"]], version=index["version"])
+        self.levels: List[np.memmap] = [np.memmap(os.path.join(pyramid_path, OVERVIEW_LEVEL_FILENAME.format(level_id)),
+                                                  dtype=np.dtype(self.index.dtype), mode="r",
+                                                  shape=self.index.sizes[:4] + level_size)
+                                        for level_id, level_size in enumerate(self.index.levels)]
+
+    # Smallest level at least as large as the given display size, or None if the display is larger than every level, in
+    # which case full resolution planes should be shown
+    def level_for_size(self, width: int, height: int) -> Optional[int]:
+        for level_id in reversed(range(len(self.index.levels))):
+            level_height, level_width = self.index.levels[level_id]
+            if level_width >= width and level_height >= height:
+                return level_id
+        return None
+
+    # (x, y) scale of full resolution coordinates relative to a level
+    def level_scale(self, level_id: int) -> Tuple[float, float]:
+        level_height, level_width = self.index.levels[level_id]
+        return self.index.sizes[5] / level_width, self.index.sizes[4] / level_height
+
+    # Read-only view of a plane, in the same argument order as PlaneCache.get_plane
+    def read_plane(self, level_id: int, frame_id: int, fov_id: int, channel_id: int, zstack_id: int) -> np.ndarray:
+        return np.asarray(self.levels[level_id][frame_id, fov_id, channel_id, zstack_id])
+
+
+# Pyramid built for an ND2 file, or None if it hasn't been built or was built for a different file
+def open_overview_pyramid(frames: ND2Frames) -> Optional[OverviewPyramid]:
+    pyramid_path = overview_path(frames.filename)
+    if not os.path.isfile(os.path.join(pyramid_path, OVERVIEW_INDEX_FILENAME)):
+        return None
+
+    pyramid = OverviewPyramid(pyramid_path)
+    if pyramid.index.sizes != _frame_sizes(frames):
+        print("Warning: overview {} doesn't match {}, showing full resolution images".format(pyramid_path, frames.filename))
+        return None
+    return pyramid
@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict
+from typing import Tuple, List, Optional
+import numpy as np
+from Preprocessing.ND2Frames import ND2Frames
+
+# Thread-safe LRU cache of planes read from an ND2 file, for interactive viewers. Planes are keyed by
+# (frame, FOV, channel, z) and the cache is limited to PLANE_CACHE_BYTES. After each lookup, the next PREFETCH_PLANES
+# planes along the axis the user last moved in are read by a background thread, so that they're ready when the user
+# steps on. The cache opens its own reader for the file, so that the background thread never shares a reader with the
+# rest of the program. That reader isn't thread-safe either, so all reads from it are made while holding reader_lock.
+
+PLANE_CACHE_BYTES = 512 * 1024 * 1024
+PREFETCH_PLANES = 8
+
+PlaneKey = Tuple[int, int, int, int]
+
+
+class PlaneCache:
+    def __init__(self, frames: ND2Frames, cache_bytes: int = PLANE_CACHE_BYTES, prefetch_planes: int = PREFETCH_PLANES) -> None:
+        self.frames: ND2Frames = ND2Frames(frames.filename)
+        self.cache_bytes = cache_bytes
+        self.prefetch_planes = prefetch_planes
+        self.axis_sizes: PlaneKey = (frames.num_frames, frames.num_fovs, frames.num_channels, frames.num_zstack)
+
+        self.planes: "OrderedDict[PlaneKey, np.ndarray]" = OrderedDict()
+        self.cached_bytes = 0
+        self.last_key: Optional[PlaneKey] = None
+
+        # cache_lock guards the cache and prefetch queue, and is never held while reading from the ND2 file
+        self.cache_lock = threading.Lock()
+        self.reader_lock = threading.Lock()
+        self.prefetch_ready = threading.Condition(self.cache_lock)
+        self.prefetch_queue: List[PlaneKey] = []
+        self.closed = False
+
+        self.prefetch_thread = threading.Thread(target=self._run_prefetch, daemon=True)
+        self.prefetch_thread.start()
+
+    # Plane at the given position. Cached planes are shared, so are returned read-only.
+    def get_plane(self, frame_id: int, fov_id: int, channel_id: int, zstack_id: int) -> np.ndarray:
+        key: PlaneKey = (frame_id, fov_id, channel_id, zstack_id)
+        plane = self._lookup(key)
+        if plane is None:
+            plane = self._read(key)
+
+        with self.cache_lock:
+            self.prefetch_queue = self._prefetch_keys(key)
+            self.last_key = key
+            self.prefetch_ready.notify()
+        return plane
+
+    def close(self) -> None:
+        with self.cache_lock:
+            self.closed = True
+            self.prefetch_ready.notify()
+        self.prefetch_thread.join()
+        self.frames.close()
+
+    def _lookup(self, key: PlaneKey) -> Optional[np.ndarray]:
+        with self.cache_lock:
+            plane = self.planes.get(key)
+            if plane is not None:
+                self.planes.move_to_end(key)
+            return plane
+
+    # Read a plane into the cache, unless another thread read it while this one was waiting for the reader
+    def _read(self, key: PlaneKey) -> np.ndarray:
+        with self.reader_lock:
+            plane = self._lookup(key)
+            if plane is not None:
+                return plane
+
+            plane = np.asarray(self.frames[self.frames.calculate_position(*key)])
+            plane.setflags(write=False)
+
+        with self.cache_lock:
+            if key not in self.planes:
+                self.planes[key] = plane
+                self.cached_bytes += plane.nbytes
+                while self.cached_bytes > self.cache_bytes and len(self.planes) > 1:
+                    self.cached_bytes -= self.planes.popitem(last=False)[1].nbytes
+        return plane
+
+    # Planes following key along the axis that changed since the last lookup, or along the frame axis if the user jumped
+    # to a new position
+    def _prefetch_keys(self, key: PlaneKey) -> List[PlaneKey]:
+        axis, step = 0, 1
+        if self.last_key is not None:
+            changed = [axis_id for axis_id in range(len(key)) if key[axis_id] != self.last_key[axis_id]]
+            if len(changed) == 1:
+                axis = changed[0]
+                step = 1 if key[axis] > self.last_key[axis] else -1
+
+        keys: List[PlaneKey] = []
+        for distance in range(1, self.prefetch_planes + 1):
+            position = key[axis] + step * distance
+            if 0 <= position < self.axis_sizes[axis]:
+                keys.append(key[:axis] + (position,) + key[axis + 1:])
+        return keys
+
+    def _run_prefetch(self) -> None:
+        while True:
+            with self.cache_lock:
+                while not self.closed and len(self.prefetch_queue) == 0:
+                    self.prefetch_ready.wait()
+                if self.closed:
+                    return
+
+                key = self.prefetch_queue.pop(0)
+                if key in self.planes:
+                    continue
+
+            try:
+                self._read(key)
+            except Exception as error:
+                print("Warning: failed to prefetch plane {}: {}".format(key, error))
@@ -0,0 +1,87 @@
+import mmap
+import struct
+from typing import Optional, Tuple
+import numpy as np
+
+# Uncompressed TIFFs with a fixed layout, written for cropped regions saved as individual files without a codec. Each
+# file is a little-endian baseline TIFF holding one greyscale plane as a single strip, with a header that depends only
+# on the plane's shape and dtype, and the pixel data starting at RAW_TIFF_DATA_OFFSET. Readers that recognise the
+# header map the pixel data straight into memory rather than decoding the file, so reading a plane is a page cache hit
+# without a copy. Other readers see an ordinary TIFF.
+
+RAW_TIFF_DATA_OFFSET = 256
+
+# TIFF SampleFormat values for numpy dtype kinds
+_SAMPLE_FORMATS = {'u': 1, 'i': 2, 'f': 3}
+_SHORT = 3
+_LONG = 4
+# Byte order, magic number, offset of the first IFD and its number of entries
+_HEADER_START = b"II*\x00" + struct.pack("<IH", 8, 10)
+
+
+def _raw_tiff_header(height: int, width: int, dtype: np.dtype) -> bytes:
+    entries = [(256, _LONG, width),  # ImageWidth
+               (257, _LONG, height),  # ImageLength
+               (258, _SHORT, dtype.itemsize * 8),  # BitsPerSample
+               (259, _SHORT, 1),  # Compression: none
+               (262, _SHORT, 1),  # PhotometricInterpretation: black is zero
+               (273, _LONG, RAW_TIFF_DATA_OFFSET),  # StripOffsets
+               (277, _SHORT, 1),  # SamplesPerPixel
+               (278, _LONG, height),  # RowsPerStrip
+               (279, _LONG, height * width * dtype.itemsize),  # StripByteCounts
+               (339, _SHORT, _SAMPLE_FORMATS[dtype.kind])]  # SampleFormat
+
+    header = _HEADER_START
+    for tag, value_type, value in entries:
+        packed_value = struct.pack("<HH", value, 0) if value_type == _SHORT else struct.pack("<I", value)
+        header += struct.pack("<HHI", tag, value_type, 1) + packed_value
+    header += struct.pack("<I", 0)
+    return header.ljust(RAW_TIFF_DATA_OFFSET, b"\x00")
+
+
+def write_raw_tiff(filename: str, image: np.ndarray) -> None:
+    image = np.ascontiguousarray(image, dtype=image.dtype.newbyteorder("<"))
+    with open(filename, "wb") as file:
+        file.write(_raw_tiff_header(image.shape[0], image.shape[1], image.dtype) + image.tobytes())
+
+
+# Read-only view of the memory mapped plane in a TIFF written by write_raw_tiff, or None if the file doesn't have the fixed layout
+def map_raw_tiff(filename: str) -> Optional[np.ndarray]:
+    try:
+        with open(filename, "rb", buffering=0) as file:
+            header = file.read(RAW_TIFF_DATA_OFFSET)
+            layout = _raw_tiff_layout(header)
+            if layout is None:
+                return None
+
+            height, width, dtype = layout
+            # The map stays open after the file is closed, for as long as the returned view refers to it
+            file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    if len(file_map) != RAW_TIFF_DATA_OFFSET + height * width * dtype.itemsize:
+        return None
+    return np.frombuffer(file_map, dtype=dtype, count=height * width, offset=RAW_TIFF_DATA_OFFSET).reshape((height, width))
+
+
+# (height, width, dtype) of a header written by write_raw_tiff, or None for any other header. Shape and dtype are read
+# from the ImageWidth, ImageLength, BitsPerSample and SampleFormat entries, then the whole header is checked against
+# the one write_raw_tiff would write for them.
+def _raw_tiff_layout(header: bytes) -> Optional[Tuple[int, int, np.dtype]]:
+    if len(header) != RAW_TIFF_DATA_OFFSET or header[:10] != _HEADER_START:
+        return None
+
+    width, height = struct.unpack_from("<I", header, 18)[0], struct.unpack_from("<I", header, 30)[0]
+    bits, sample_format = struct.unpack_from("<H", header, 42)[0], struct.unpack_from("<H", header, 126)[0]
+    kinds = [kind for kind, value in _SAMPLE_FORMATS.items() if value == sample_format]
+    if len(kinds) == 0 or bits not in (8, 16, 32, 64):
+        return None
+
+    try:
+        dtype = np.dtype("<{}{}".format(kinds[0], bits // 8))
+    except TypeError:
+        return None
+    if header != _raw_tiff_header(height, width, dtype):
+        return None
+    return height, width, dtype
@@ -0,0 +1,244 @@
+import os
+import re
+import json
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Tuple, List, Optional, Union, TYPE_CHECKING
+import numpy as np
+import cv2
+from Preprocessing.RawTiff import map_raw_tiff
+from Preprocessing.StackCodec import OutputCodec, encode_plane, decode_plane
+from Preprocessing.VirtualCrop import virtual_crop_manifest
+
+# Virtual crops read from the ND2 file, which needs the Nikon SDK, so they're only opened for regions that are part of
+# one. Everything else that reads images through this module works without the SDK.
+if TYPE_CHECKING:
+    from Preprocessing.VirtualCrop import VirtualRegion
+
+# Per-region image stack store, holding every frame, z position and channel of a cropped region in a single file rather
+# than one TIFF per plane. Planes are stored uncompressed in (frame, z, channel, y, x) order in STACK_FILENAME, with
+# the stack's shape and dtype held in a small JSON index, STACK_INDEX_FILENAME. Each plane is one chunk at a fixed
+# offset, so cropping processes can write planes in any order, and reading a plane is a slice of a memory map.
+#
+# Stacks can instead be compressed with a codec (see StackCodec). Each plane is then compressed on its own and appended
+# to STACK_FILENAME, with the (offset, length) of each plane's chunk held in a chunk table, STACK_CHUNKS_FILENAME, in
+# (frame, z, channel) order. The data file is opened for appending, so every chunk is written after all others, even
+# with several cropping processes writing the same stack, and a chunk only counts as written once its table entry is set.
+# A plane rewritten by a resumed crop leaves its earlier chunk unused. Compressed stacks have version 2.
+#
+# Images are still addressed by their TIFF name (frame_<t>_z_<z>_channel_<c>.tif) within the region folder, so
+# read_image loads a plane from either a stack or an individual file, and saved segmentations work with both.
+# read_image also serves the regions of a virtual crop (see VirtualCrop), whose folders hold no images.
+
+STACK_FILENAME = "stack.bin"
+STACK_INDEX_FILENAME = "stack.json"
+STACK_CHUNKS_FILENAME = "stack_chunks.bin"
+STACK_VERSION = 2
+UNCOMPRESSED_STACK_VERSION = 1
+
+IMAGE_NAME_FORMAT = "frame_{}_z_{}_channel_{}.tif"
+IMAGE_NAME_REGEX = re.compile(r"^frame_([0-9]+)_z_([0-9]+)_channel_([0-9]+)\.tif$")
+REGION_FOLDER_REGEX = re.compile(r"^region_([0-9]+)$")
+
+# Stacks opened by read_image are kept mapped, as consumers read many planes from the same few regions
+OPEN_STACK_LIMIT = 32
+_open_stacks: "OrderedDict[str, RegionStack]" = OrderedDict()
+
+
+@dataclass
+class StackIndex:
+    # (frames, z positions, channels, height, width)
+    shape: Tuple[int, int, int, int, int]
+    dtype: str
+    version: int = UNCOMPRESSED_STACK_VERSION
+    # Name of the stack's OutputCodec
+    codec: str = OutputCodec.NONE.name
+
+
+def image_name(frame_id: int, zstack_id: int, channel_id: int) -> str:
+    return IMAGE_NAME_FORMAT.format(frame_id, zstack_id, channel_id)
+
+
+# Frame, z position and channel of an image name, or None if it doesn't follow the naming convention
+def parse_image_name(name: str) -> Optional[Tuple[int, int, int]]:
+    match = IMAGE_NAME_REGEX.search(name)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2)), int(match.group(3))
+
+
+def is_region_stack(region_path: str) -> bool:
+    return os.path.isfile(os.path.join(region_path, STACK_INDEX_FILENAME))
+
+
+# Allocate an empty stack in region_path. The index is written last, so a region only counts as a stack once its data
+# file (or chunk table, if compressed) has been allocated in full. Raises FileExistsError if the region already has a
+# stack.
+def create_region_stack(region_path: str, shape: Tuple[int, int, int, int, int], dtype: np.dtype,
+                        codec: OutputCodec = OutputCodec.NONE) -> None:
+    index_filename = os.path.join(region_path, STACK_INDEX_FILENAME)
+    if os.path.exists(index_filename):
+        raise FileExistsError(index_filename)
+
+    os.makedirs(region_path, exist_ok=True)
+    index = StackIndex(shape=tuple(int(size) for size in shape), dtype=np.dtype(dtype).str,
+                       version=UNCOMPRESSED_STACK_VERSION if codec == OutputCodec.NONE else STACK_VERSION, codec=codec.name)
+
+    with open(os.path.join(region_path, STACK_FILENAME), "wb") as data_file:
+        if codec == OutputCodec.NONE:
+            data_file.truncate(int(np.prod(index.shape)) * np.dtype(dtype).itemsize)
+
+    if codec != OutputCodec.NONE:
+        with open(os.path.join(region_path, STACK_CHUNKS_FILENAME), "wb") as chunks_file:
+            chunks_file.truncate(int(np.prod(index.shape[:3])) * 2 * np.dtype(np.int64).itemsize)
+
+    with open(index_filename + ".tmp", "w") as index_file:
+        json.dump(asdict(index), index_file)
+    os.replace(index_filename + ".tmp", index_filename)
+
+    # A stack previously opened from this folder was replaced along with its files
+    _open_stacks.pop(os.path.abspath(region_path), None)
+
+
+def read_stack_index(region_path: str) -> StackIndex:
+    with open(os.path.join(region_path, STACK_INDEX_FILENAME), "r") as index_file:
+        index = json.load(index_file)
+
+    if index["version"] > STACK_VERSION:
+        raise ValueError("Unsupported image stack version {} in {}".format(index["version"], region_path))
+    return StackIndex(shape=tuple(index["shape"]), dtype=index["dtype"], version=index["version"],
+                      codec=index.get("codec", OutputCodec.NONE.name))
+
+
+class RegionStack:
+    def __init__(self, region_path: str, writable: bool = False) -> None:
+        self.region_path = region_path
+        self.index: StackIndex = read_stack_index(region_path)
+        self.codec: OutputCodec = OutputCodec[self.index.codec]
+
+        if self.codec == OutputCodec.NONE:
+            self.planes: np.memmap = np.memmap(os.path.join(region_path, STACK_FILENAME), dtype=np.dtype(self.index.dtype),
+                                               mode="r+" if writable else "r", shape=self.index.shape)
+        else:
+            # (offset, length) of each plane's chunk, with a length of 0 for planes not yet written
+            self.chunks: np.memmap = np.memmap(os.path.join(region_path, STACK_CHUNKS_FILENAME), dtype=np.int64,
+                                               mode="r+" if writable else "r", shape=self.index.shape[:3] + (2,))
+            self.data_file = open(os.path.join(region_path, STACK_FILENAME), "ab" if writable else "rb", buffering=0)
+
+    @property
+    def num_frames(self) -> int:
+        return self.index.shape[0]
+
+    @property
+    def num_zstack(self) -> int:
+        return self.index.shape[1]
+
+    @property
+    def num_channels(self) -> int:
+        return self.index.shape[2]
+
+    @property
+    def plane_shape(self) -> Tuple[int, int]:
+        return self.index.shape[3], self.index.shape[4]
+
+    # Views into the memory map, without copying. Views of a read-only stack can't be modified. Planes of compressed
+    # stacks are decoded into new read-only arrays, with planes not yet written read as zeros.
+    def read_plane(self, frame_id: int, zstack_id: int, channel_id: int) -> np.ndarray:
+        if self.codec == OutputCodec.NONE:
+            return np.asarray(self.planes[frame_id, zstack_id, channel_id])
+
+        offset, length = self.chunks[frame_id, zstack_id, channel_id]
+        if length == 0:
+            return np.zeros(self.plane_shape, dtype=np.dtype(self.index.dtype))
+        return decode_plane(os.pread(self.data_file.fileno(), int(length), int(offset)), self.codec, self.plane_shape,
+                            np.dtype(self.index.dtype))
+
+    # All channels of a frame at one z position, as a (channel, y, x) array
+    def read_channels(self, frame_id: int, zstack_id: int) -> np.ndarray:
+        if self.codec == OutputCodec.NONE:
+            return np.asarray(self.planes[frame_id, zstack_id])
+        return np.stack([self.read_plane(frame_id, zstack_id, channel_id) for channel_id in range(self.num_channels)])
+
+    # All z positions of a frame in one channel, as a (z, y, x) array
+    def read_zstack(self, frame_id: int, channel_id: int) -> np.ndarray:
+        if self.codec == OutputCodec.NONE:
+            return np.asarray(self.planes[frame_id, :, channel_id])
+        return np.stack([self.read_plane(frame_id, zstack_id, channel_id) for zstack_id in range(self.num_zstack)])
+
+    # Planes can be written from several threads at once, as long as each thread writes to a different stack
+    def write_plane(self, frame_id: int, zstack_id: int, channel_id: int, image: np.ndarray) -> None:
+        if self.codec == OutputCodec.NONE:
+            self.planes[frame_id, zstack_id, channel_id] = image
+            return
+
+        data: bytes = encode_plane(image, self.codec)
+        if os.write(self.data_file.fileno(), data) != len(data):
+            raise OSError("Short write to image stack: {}".format(self.region_path))
+        # Appending leaves the file position at the end of this chunk, whatever other processes have appended
+        end: int = os.lseek(self.data_file.fileno(), 0, os.SEEK_CUR)
+        self.chunks[frame_id, zstack_id, channel_id] = (end - len(data), len(data))
+
+    def flush(self) -> None:
+        if self.codec == OutputCodec.NONE:
+            self.planes.flush()
+        else:
+            self.chunks.flush()
+
+
+# Read-only stack for a region, shared between readers in this process
+def open_region_stack(region_path: str) -> RegionStack:
+    key = os.path.abspath(region_path)
+    stack = _open_stacks.get(key)
+
+    if stack is None:
+        stack = RegionStack(region_path)
+        _open_stacks[key] = stack
+        if len(_open_stacks) > OPEN_STACK_LIMIT:
+            _open_stacks.popitem(last=False)
+    else:
+        _open_stacks.move_to_end(key)
+    return stack
+
+
+# Source of a region folder's images: its image stack, or its region of a virtual crop. Returns None for a region saved
+# as individual files.
+def open_region(region_path: str) -> Optional[Union[RegionStack, "VirtualRegion"]]:
+    # Stacks already open are used without checking the region folder again
+    if os.path.abspath(region_path) in _open_stacks or is_region_stack(region_path):
+        return open_region_stack(region_path)
+
+    manifest_filename = virtual_crop_manifest(region_path)
+    match = REGION_FOLDER_REGEX.search(os.path.basename(os.path.abspath(region_path)))
+    if manifest_filename is not None and match is not None:
+        from Preprocessing.VirtualCrop import open_virtual_crop
+        return open_virtual_crop(manifest_filename).region(int(match.group(1)))
+    return None
+
+
+# Load a cropped image given its path, i.e. its region folder joined with its TIFF name. Images in a region stack are
+# returned as read-only views of the stack, and images in a virtual crop are cropped from the ND2 file. Other images
+# are read from their own file as greyscale, as read-only views of the file if it's an uncompressed TIFF written by
+# the cropper (see RawTiff).
+def read_image(path: str) -> np.ndarray:
+    region_path, name = os.path.split(path)
+    plane_id = parse_image_name(name)
+
+    if plane_id is not None:
+        region = open_region(region_path)
+        if region is not None:
+            return region.read_plane(*plane_id)
+
+    image: Optional[np.ndarray] = map_raw_tiff(path)
+    if image is not None:
+        return image
+    return cv2.imread(path, flags=(cv2.IMREAD_GRAYSCALE + cv2.IMREAD_UNCHANGED))
+
+
+# Names of all images in a region, whether stored as a stack, as individual files or as part of a virtual crop
+def list_region_images(region_path: str) -> List[str]:
+    region = open_region(region_path)
+    if region is None:
+        return [file for file in os.listdir(region_path) if parse_image_name(file) is not None]
+
+    return [image_name(frame_id, zstack_id, channel_id) for frame_id in range(region.num_frames)
+            for zstack_id in range(region.num_zstack) for channel_id in range(region.num_channels)]
@@ -0,0 +1,56 @@
+import zlib
+from enum import Enum, auto
+from typing import List, Tuple
+import numpy as np
+import cv2
+
+# Lossless codecs for cropped region output. Region stacks compress each plane as its own chunk (see RegionStack), while
+# TIFF output passes the codec on to OpenCV's TIFF encoder, so both are decoded transparently by read_image. Without a
+# codec, TIFFs are written uncompressed with a fixed layout by RawTiff instead.
+#
+# SHUFFLE_DEFLATE splits each plane into byte planes before compressing, i.e. all the low bytes of the pixels followed
+# by all the high bytes. The high bytes of 16 bit images vary slowly, so compress far better on their own, which lets
+# a fast deflate level match or beat a slow one on the unshuffled plane.
+
+DEFLATE_LEVEL = 6
+SHUFFLE_DEFLATE_LEVEL = 1
+
+# TIFF compression tag value for deflate. OpenCV can't set a TIFF predictor, so TIFFs are deflated without shuffling.
+TIFF_DEFLATE = 8
+TIFF_NO_COMPRESSION = 1
+
+
+class OutputCodec(Enum):
+    NONE = auto()
+    DEFLATE = auto()
+    SHUFFLE_DEFLATE = auto()
+
+
+def encode_plane(image: np.ndarray, codec: OutputCodec) -> bytes:
+    image = np.ascontiguousarray(image)
+    if codec == OutputCodec.DEFLATE:
+        return zlib.compress(image.tobytes(), DEFLATE_LEVEL)
+    if codec == OutputCodec.SHUFFLE_DEFLATE:
+        shuffled = image.reshape(-1).view(np.uint8).reshape((-1, image.itemsize)).T
+        return zlib.compress(shuffled.tobytes(), SHUFFLE_DEFLATE_LEVEL)
+    return image.tobytes()
+
+
+# Decoded planes are read-only, in the same way as planes read from an uncompressed stack
+def decode_plane(data: bytes, codec: OutputCodec, shape: Tuple[int, int], dtype: np.dtype) -> np.ndarray:
+    if codec == OutputCodec.NONE:
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+    decoded = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    if codec == OutputCodec.SHUFFLE_DEFLATE:
+        decoded = np.ascontiguousarray(decoded.reshape((np.dtype(dtype).itemsize, -1)).T)
+    image = decoded.view(dtype).reshape(shape)
+    image.setflags(write=False)
+    return image
+
+
+# cv2.imwrite parameters for saving a TIFF with a codec
+def tiff_parameters(codec: OutputCodec) -> List[int]:
+    if codec == OutputCodec.NONE:
+        return [cv2.IMWRITE_TIFF_COMPRESSION, TIFF_NO_COMPRESSION]
+    return [cv2.IMWRITE_TIFF_COMPRESSION, TIFF_DEFLATE]
@@ -0,0 +1,168 @@
+import os
+import json
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Tuple, Optional, TYPE_CHECKING
+import numpy as np
+from Segmentation.Utilities import rotate_crop
+
+# The ND2 reader needs the Nikon SDK, so it's only imported once a virtual crop is opened. RegionStack imports this
+# module, and the segmentation tools reading images through RegionStack don't need the SDK.
+if TYPE_CHECKING:
+    from Preprocessing.ND2Frames import ND2Frames
+
+# Virtual crop of a FOV, for exploratory runs where cropped images aren't saved. The FOV folder holds a manifest of the
+# crop: its ND2 file, rotation angle, region rectangles and the drift offset of each frame, alongside an empty folder
+# for each region's results. Region planes are cropped on demand from the ND2 file, which is read through a byte-limited
+# LRU cache of full planes, so a plane read for one region is shared with all other regions of the FOV.
+
+VIRTUAL_CROP_FILENAME = "virtual_crop.json"
+VIRTUAL_CROP_VERSION = 1
+PLANE_CACHE_BYTES = 512 * 1024 * 1024
+
+# Each open virtual crop holds an ND2 reader and a plane cache, so only the most recently used few are kept open
+OPEN_VIRTUAL_CROP_LIMIT = 2
+
+
+@dataclass
+class VirtualCropManifest:
+    nd2_filename: str
+    fov_id: int
+    angle: int
+    num_frames: int
+    num_zstack: int
+    num_channels: int
+    # (x, y, width, height) of each region that wasn't ignored, by region ID
+    regions: Dict[int, Tuple[int, int, int, int]]
+    # Cumulative drift of each frame, relative to the first frame
+    offsets: List[Tuple[float, float]]
+    version: int = VIRTUAL_CROP_VERSION
+
+
+def save_virtual_crop_manifest(manifest: VirtualCropManifest, filename: str) -> None:
+    with open(filename + ".tmp", "w") as handle:
+        json.dump(asdict(manifest), handle)
+    os.replace(filename + ".tmp", filename)
+
+
+def load_virtual_crop_manifest(filename: str) -> VirtualCropManifest:
+    with open(filename, "r") as handle:
+        manifest = json.load(handle)
+
+    if manifest["version"] > VIRTUAL_CROP_VERSION:
+        raise ValueError("Unsupported virtual crop version {} in {}".format(manifest["version"], filename))
+
+    # JSON object keys are always strings
+    manifest["regions"] = {int(region_id): tuple(region) for region_id, region in manifest["regions"].items()}
+    manifest["offsets"] = [tuple(offset) for offset in manifest["offsets"]]
+    return VirtualCropManifest(**manifest)
+
+
+class VirtualCrop:
+    def __init__(self, manifest_filename: str, frames: Optional["ND2Frames"] = None, cache_bytes: int = PLANE_CACHE_BYTES) -> None:
+        self.manifest: VirtualCropManifest = load_virtual_crop_manifest(manifest_filename)
+        # A reader opened here is closed with the crop, while one that was passed in belongs to the caller
+        self.owns_frames: bool = frames is None
+        if frames is None:
+            from Preprocessing.ND2Frames import ND2Frames
+            frames = ND2Frames(self.manifest.nd2_filename)
+        self.frames: "ND2Frames" = frames
+
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self.planes: "OrderedDict[Tuple[int, int, int], np.ndarray]" = OrderedDict()
+
+    # Full plane of the FOV, before rotation
+    def full_plane(self, frame_id: int, zstack_id: int, channel_id: int) -> np.ndarray:
+        key = (frame_id, zstack_id, channel_id)
+        plane = self.planes.get(key)
+
+        if plane is not None:
+            self.planes.move_to_end(key)
+            return plane
+
+        plane = self.frames[self.frames.calculate_position(frame_id, self.manifest.fov_id, channel_id, zstack_id)]
+        self.planes[key] = plane
+        self.cached_bytes += plane.nbytes
+        while self.cached_bytes > self.cache_bytes and len(self.planes) > 1:
+            self.cached_bytes -= self.planes.popitem(last=False)[1].nbytes
+        return plane
+
+    # Region plane, cropped in the same way as ImageCropper.crop_frames
+    def read_plane(self, region_id: int, frame_id: int, zstack_id: int, channel_id: int) -> np.ndarray:
+        x, y, width, height = self.manifest.regions[region_id]
+        offset = self.manifest.offsets[frame_id]
+        return rotate_crop(self.full_plane(frame_id, zstack_id, channel_id), self.manifest.angle, x - round(offset[0]),
+                           y - round(offset[1]), width, height)
+
+    def close(self) -> None:
+        self.planes.clear()
+        self.cached_bytes = 0
+        if self.owns_frames:
+            self.frames.close()
+
+    def region(self, region_id: int) -> "VirtualRegion":
+        if region_id not in self.manifest.regions:
+            raise KeyError("Region {} is not part of the virtual crop of FOV {}".format(region_id, self.manifest.fov_id))
+        return VirtualRegion(self, region_id)
+
+
+# A single region of a virtual crop, read in the same way as a RegionStack
+class VirtualRegion:
+    def __init__(self, crop: VirtualCrop, region_id: int) -> None:
+        self.crop = crop
+        self.region_id = region_id
+
+    @property
+    def num_frames(self) -> int:
+        return self.crop.manifest.num_frames
+
+    @property
+    def num_zstack(self) -> int:
+        return self.crop.manifest.num_zstack
+
+    @property
+    def num_channels(self) -> int:
+        return self.crop.manifest.num_channels
+
+    @property
+    def plane_shape(self) -> Tuple[int, int]:
+        x, y, width, height = self.crop.manifest.regions[self.region_id]
+        return height, width
+
+    def read_plane(self, frame_id: int, zstack_id: int, channel_id: int) -> np.ndarray:
+        return self.crop.read_plane(self.region_id, frame_id, zstack_id, channel_id)
+
+    # All channels of a frame at one z position, as a (channel, y, x) array
+    def read_channels(self, frame_id: int, zstack_id: int) -> np.ndarray:
+        return np.stack([self.read_plane(frame_id, zstack_id, channel_id) for channel_id in range(self.num_channels)])
+
+    # All z positions of a frame in one channel, as a (z, y, x) array
+    def read_zstack(self, frame_id: int, channel_id: int) -> np.ndarray:
+        return np.stack([self.read_plane(frame_id, zstack_id, channel_id) for zstack_id in range(self.num_zstack)])
+
+
+_open_virtual_crops: "OrderedDict[str, VirtualCrop]" = OrderedDict()
+
+
+# Virtual crop for a manifest, shared by all regions of its FOV in this process
+def open_virtual_crop(manifest_filename: str) -> VirtualCrop:
+    key = os.path.abspath(manifest_filename)
+    crop = _open_virtual_crops.get(key)
+
+    if crop is None:
+        crop = VirtualCrop(manifest_filename)
+        _open_virtual_crops[key] = crop
+        if len(_open_virtual_crops) > OPEN_VIRTUAL_CROP_LIMIT:
+            _open_virtual_crops.popitem(last=False)[1].close()
+    else:
+        _open_virtual_crops.move_to_end(key)
+    return crop
+
+
+# Manifest that a region folder belongs to, if it's part of a virtual crop
+def virtual_crop_manifest(region_path: str) -> Optional[str]:
+    manifest_filename = os.path.join(os.path.dirname(os.path.abspath(region_path)), VIRTUAL_CROP_FILENAME)
+    if os.path.isfile(manifest_filename):
+        return manifest_filename
+    return None
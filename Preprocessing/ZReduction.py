@@ -0,0 +1,69 @@
+from enum import Enum, auto
+import numpy as np
+import cv2
+
+# Reduction of each region's z-stack to a single plane per channel at crop time, so that regions are saved, and later
+# read, with one z position rather than all of them. Either the best focused z position is kept, or the stack is fused
+# into an extended depth of field image, taking each pixel from the z position that's sharpest around it. Both choose
+# z positions using one channel, and apply the same choice to all channels so that they stay aligned.
+#
+# z-stacks are held as (z, y, x) arrays. OpenCV filters treat the last axis as channels, so a whole stack is filtered
+# in one call by moving z to the last axis.
+
+# Size of the window over which sharpness is averaged when fusing, in pixels
+FUSION_WINDOW_SIZE = 9
+
+
+class ZReduction(Enum):
+    NONE = auto()
+    BEST_FOCUS = auto()
+    FUSION = auto()
+
+
+class FocusMetric(Enum):
+    # Lowest variance of intensity, as used by run_segmentation.pick_z_image for brightfield images
+    LOWEST_VARIANCE = auto()
+    # Highest variance of the Laplacian
+    LAPLACIAN_VARIANCE = auto()
+    # Highest mean squared Sobel gradient
+    TENENGRAD = auto()
+
+
+def _channels_last(zstack: np.ndarray) -> np.ndarray:
+    return np.ascontiguousarray(np.moveaxis(zstack, 0, -1), dtype=np.float32)
+
+
+# Focus score of each z position of a (z, y, x) stack, higher for better focus
+def focus_scores(zstack: np.ndarray, metric: FocusMetric) -> np.ndarray:
+    if metric == FocusMetric.LOWEST_VARIANCE:
+        return -np.var(zstack.reshape((len(zstack), -1)).astype(np.float32), axis=1)
+
+    image = _channels_last(zstack)
+    if metric == FocusMetric.LAPLACIAN_VARIANCE:
+        laplacian = cv2.Laplacian(image, cv2.CV_32F).reshape((-1, len(zstack)))
+        return np.var(laplacian, axis=0)
+
+    gradient_x = cv2.Sobel(image, cv2.CV_32F, 1, 0).reshape((-1, len(zstack)))
+    gradient_y = cv2.Sobel(image, cv2.CV_32F, 0, 1).reshape((-1, len(zstack)))
+    return np.mean(gradient_x ** 2 + gradient_y ** 2, axis=0)
+
+
+def best_focus_index(zstack: np.ndarray, metric: FocusMetric) -> int:
+    return int(np.argmax(focus_scores(zstack, metric)))
+
+
+# z position to take each pixel from when fusing a (z, y, x) stack: the one with the most Laplacian energy around it
+def fusion_index(zstack: np.ndarray) -> np.ndarray:
+    energy = np.abs(cv2.Laplacian(_channels_last(zstack), cv2.CV_32F))
+    energy = cv2.blur(energy, (FUSION_WINDOW_SIZE, FUSION_WINDOW_SIZE)).reshape(zstack.shape[1:] + (len(zstack),))
+    return np.argmax(energy, axis=-1)
+
+
+# Reduce a (channel, z, y, x) block of planes to (channel, y, x), choosing z positions using focus_channel
+def reduce_zstack(planes: np.ndarray, reduction: ZReduction, metric: FocusMetric, focus_channel: int) -> np.ndarray:
+    if reduction == ZReduction.BEST_FOCUS:
+        return planes[:, best_focus_index(planes[focus_channel], metric)]
+    if reduction == ZReduction.FUSION:
+        index = fusion_index(planes[focus_channel])
+        return np.take_along_axis(planes, index[np.newaxis, np.newaxis], axis=1)[:, 0]
+    return planes[:, 0]
@@ -1,33 +1,47 @@
 import subprocess
-import pickle
 import os
+import re
 from typing import List, Tuple, Optional
 import time
 import shutil
 import numpy as np
 import cv2
+from scipy.ndimage import find_objects
 from Segmentation.SegmentationData import Segment, Segmentation, ProcessedFrame, save_segmentation
-from Segmentation.Measurement import calculate_centroid, calculate_compactness, calculate_intensity
+from Segmentation.Measurement import calculate_intensity, measure_regions, RegionMeasurements
 from Segmentation.Utilities import find_segmented_background
+from Segmentation.run_cellpose import read_array, write_array, read_message, write_message
+from Preprocessing.RegionStack import read_image, open_region, list_region_images, parse_image_name
+
+
+FOV_REGEX = "^fov_[0-9]+$"
+REGION_REGEX = "^region_[0-9]+$"
 
 
 class CellPoseSegmenter:
-    def __init__(self, image_names: List[List[str]], image_root_path: str, segmentation_channel_id: int, cellpose_path: str) -> None:
+    def __init__(self, image_names: List[List[str]], image_root_path: str, segmentation_channel_id: int, cellpose_path: str,
+                 worker: Optional["CellPoseWorker"] = None) -> None:
         self.image_names = image_names
         self.image_root_path = image_root_path
         self.segmentation_channel_id = segmentation_channel_id
         self.cellpose_path = cellpose_path
+        # Shared worker, so that the CellPose model is only loaded once for many regions
+        self.worker = worker
 
     def run_segmentation(self) -> List[ProcessedFrame]:
         image_paths = self._generate_filepaths()
         pre_cellpose: float = time.time()
-        cell_masks = _run_cellpose(image_paths, self.cellpose_path)
+        if self.worker is not None:
+            cell_masks = self._segment(self.worker, image_paths)
+        else:
+            with CellPoseWorker(self.cellpose_path) as worker:
+                cell_masks = self._segment(worker, image_paths)
         post_cellpose: float = time.time()
         print("CellPose completed in {}s".format(post_cellpose - pre_cellpose))
         processed_frames: List[ProcessedFrame] = []
 
         for frame_id in range(len(cell_masks)):
-            frame_images = [cv2.imread(self.image_root_path + img_name, flags=(cv2.IMREAD_GRAYSCALE + cv2.IMREAD_UNCHANGED)) for img_name in self.image_names[frame_id]]
+            frame_images = [read_image(self.image_root_path + img_name) for img_name in self.image_names[frame_id]]
 
             background_image = find_segmented_background(frame_images[self.segmentation_channel_id], cell_masks[frame_id], cell_masks[frame_id].shape)
             background_intensities = [calculate_intensity(image, background_image) for image in frame_images]
@@ -38,36 +52,24 @@ class CellPoseSegmenter:
                                                       background_intensities=background_intensities,
                                                       segments=[])
 
-            for segment_id in range(np.amax(cell_masks[frame_id])):
-                segment_img = (cell_masks[frame_id] == segment_id + 1).astype(np.uint8)
-
-                # Handle rare cases where CellPose generates a disconnected region
-                num_parts, labels = cv2.connectedComponents(segment_img)
-
-                if num_parts > 2:
-                    print("Warning: segment {} in frame {} contains {} disconnected regions".format(segment_id, frame_id, num_parts - 1))
-
-                    sizes = []
-                    for i in range(num_parts):
-                        sizes.append(np.count_nonzero(labels == i))
-
-                    sorted_sizes = np.argsort(sizes)
-                    print("Using largest region, size {}".format(sizes[sorted_sizes[-2]]))
-
-                    for i in sorted_sizes[0:-2]:
-                        print("Discarding region size {}".format(sizes[i]))
+            num_segments: int = int(np.amax(cell_masks[frame_id]))
+            frame_masks: np.ndarray = _remove_disconnected_regions(cell_masks[frame_id], frame_id)
+            measurements: RegionMeasurements = measure_regions(frame_masks, frame_images, num_segments)
 
-                    segment_img = (labels == sorted_sizes[-2]).astype(np.uint8)
+            for segment_id in range(num_segments):
+                segment_img, segment_offset = measurements.cropped_mask(frame_masks, segment_id + 1)
 
                 name = "f{}".format(frame_id)
-                area = np.count_nonzero(segment_img)
-                compactness = calculate_compactness(segment_img)
-                centroid = calculate_centroid(segment_img)
-                intensities: List[float] = [calculate_intensity(image, segment_img) for image in frame_images]
+                area = int(measurements.sizes[segment_id + 1])
+                compactness = measurements.compactness[segment_id + 1]
+                centroid = measurements.centroid(segment_id + 1)
+                intensities: List[float] = measurements.intensities(segment_id + 1)
 
                 new_segment = Segment(seg_id=segment_id,
                                       frame_id=frame_id,
                                       mask_image=segment_img,
+                                      mask_offset=segment_offset,
+                                      frame_shape=frame_masks.shape,
                                       name=name,
                                       centroid=centroid,
                                       size=area,
@@ -85,6 +87,12 @@ class CellPoseSegmenter:
             processed_frames.append(processed_frame)
         return processed_frames
 
+    # Images in a region stack or virtual crop have no file of their own for CellPose to read, so are sent to it as arrays
+    def _segment(self, worker: "CellPoseWorker", image_paths: List[str]) -> List[np.ndarray]:
+        if open_region(self.image_root_path) is not None:
+            return worker.segment_images([read_image(path) for path in image_paths])
+        return worker.segment_files(image_paths)
+
     def _generate_filepaths(self) -> List[str]:
         image_filepaths: List[str] = []
 
@@ -94,19 +102,72 @@ class CellPoseSegmenter:
         return image_filepaths
 
 
-def _run_cellpose(image_filepaths: List[str], cellpose_path: str, cellpose_script_name: str = "run_cellpose.py") -> List[np.ndarray]:
-    file_path = os.path.dirname(os.path.realpath(__file__)) + "/" + cellpose_script_name
+# Handle rare cases where CellPose generates a disconnected region, by keeping only the largest part of each segment.
+# Each segment is checked within its own bounding box, rather than across the full frame.
+def _remove_disconnected_regions(masks: np.ndarray, frame_id: int) -> np.ndarray:
+    cleaned_masks = masks.copy()
+
+    for segment_id, bounding_box in enumerate(find_objects(masks)):
+        if bounding_box is None:
+            continue
+
+        mask_crop = cleaned_masks[bounding_box]
+        num_parts, labels = cv2.connectedComponents((mask_crop == segment_id + 1).astype(np.uint8))
+
+        if num_parts > 2:
+            print("Warning: segment {} in frame {} contains {} disconnected regions".format(segment_id, frame_id, num_parts - 1))
+
+            sizes = np.bincount(labels.ravel(), minlength=num_parts)
+            sorted_parts = np.argsort(sizes[1:]) + 1
+            print("Using largest region, size {}".format(sizes[sorted_parts[-1]]))
+
+            for i in sorted_parts[0:-1]:
+                print("Discarding region size {}".format(sizes[i]))
+                mask_crop[labels == i] = 0
 
-    script: str = "cd {0}; source venv/bin/activate; cp {1} {2}; python {2} ".format(cellpose_path, file_path,
-                                                                                     cellpose_script_name)
+    return cleaned_masks
 
-    for path in image_filepaths:
-        script += "\"{}\" ".format(path)
 
-    process = subprocess.run(script, shell=True, stdout=subprocess.PIPE, executable='/bin/bash')
+# Long-lived CellPose process, running run_cellpose.py within CellPose's own venv. Images are sent in batches, either as
+# file paths or as arrays, with masks returned as raw binary arrays over the process's STDOUT.
+class CellPoseWorker:
+    def __init__(self, cellpose_path: str, cellpose_script_name: str = "run_cellpose.py") -> None:
+        file_path = os.path.dirname(os.path.realpath(__file__)) + "/" + cellpose_script_name
+        script: str = "cd {0}; source venv/bin/activate; cp {1} {2}; exec python {2}".format(cellpose_path, file_path,
+                                                                                           cellpose_script_name)
+        self.process = subprocess.Popen(script, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        executable='/bin/bash')
 
-    masks = pickle.loads(process.stdout)
-    return masks
+    def segment_files(self, image_filepaths: List[str]) -> List[np.ndarray]:
+        write_message(self.process.stdin, {"paths": image_filepaths})
+        return self._read_masks()
+
+    def segment_images(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        write_message(self.process.stdin, {"arrays": len(images)})
+        for image in images:
+            write_array(self.process.stdin, image)
+        return self._read_masks()
+
+    def close(self) -> None:
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+    def __enter__(self) -> "CellPoseWorker":
+        return self
+
+    def __exit__(self, *_args) -> None:
+        self.close()
+
+    def _read_masks(self) -> List[np.ndarray]:
+        self.process.stdin.flush()
+        response = read_message(self.process.stdout)
+        if response is None:
+            raise RuntimeError("CellPose worker exited with code {}".format(self.process.wait()))
+        if "error" in response:
+            raise RuntimeError("CellPose worker failed: {}".format(response["error"]))
+
+        return [read_array(self.process.stdout) for _ in range(response["count"])]
 
 
 def run_full_segmentation(input_path: str, cellpose_location: str = "/home/alan/Programming/cellpose", z_position: int = 1, seg_channel_id: int = 0, start_fov: int = 0, start_region: int = 0, output_root: Optional[str] = None) -> None:
@@ -126,81 +187,91 @@ def run_full_segmentation(input_path: str, cellpose_location: str = "/home/alan/
     def sort_folders(folder: str) -> int:
         return int(folder.split('_')[1])
 
+    # FOV folders also hold files, such as drift trajectories and virtual crop manifests
+    def list_folders(path: str, regex: str) -> List[str]:
+        return sorted([folder for folder in os.listdir(path) if re.search(regex, folder) is not None], key=sort_folders)
+
     fov_count: int = 0
     region_count: int = 0
-    for fov_folder in sorted(os.listdir(input_path), key=sort_folders):
+    for fov_folder in list_folders(input_path, FOV_REGEX):
         fov_count += 1
-        for region_folder in sorted(os.listdir(input_path + '/' + fov_folder), key=sort_folders):
+        for region_folder in list_folders(input_path + '/' + fov_folder, REGION_REGEX):
             region_count += 1
 
     print("Total {} FOVs, {} regions".format(fov_count, region_count))
 
-    for fov_folder in sorted(os.listdir(input_path), key=sort_folders):
-        fov_id: int = int(fov_folder.split('_')[1])
-        print("FOV {}".format(fov_id))
-        if fov_id >= start_fov:
-            for region_folder in sorted(os.listdir(input_path + '/' + fov_folder), key=sort_folders):
-                region_id = int(region_folder.split('_')[1])
+    # Start CellPose once for the whole dataset, closing it however segmentation ends
+    with CellPoseWorker(cellpose_location) as worker:
+        for fov_folder in list_folders(input_path, FOV_REGEX):
+            fov_id: int = int(fov_folder.split('_')[1])
+            print("FOV {}".format(fov_id))
+            if fov_id >= start_fov:
+                for region_folder in list_folders(input_path + '/' + fov_folder, REGION_REGEX):
+                    region_id = int(region_folder.split('_')[1])
 
-                if fov_id == start_fov and region_id < start_region:
-                    continue
+                    if fov_id == start_fov and region_id < start_region:
+                        continue
 
-                print("FOV {} Region {}".format(fov_id, region_id))
+                    print("FOV {} Region {}".format(fov_id, region_id))
 
-                region_dir = input_path + '/' + fov_folder + '/' + region_folder + '/'
-                files = os.listdir(region_dir)
+                    region_dir = input_path + '/' + fov_folder + '/' + region_folder + '/'
+                    files = list_region_images(region_dir)
 
-                start_time: float = time.time()
+                    start_time: float = time.time()
 
-                # Remove all z positions other than the one chosen for segmentation, as well as invalid filenames
-                filtered_files: List[str] = []
-                for file in files:
-                    split_name = split_filename(file)
-                    if len(split_name) != NUM_FILENAME_PARTS:
-                        print("Warning: file {} does not fit naming convention".format(file))
-                        continue
-                    elif int(split_name[Z_POS]) != z_position:
-                        continue
-                    else:
-                        filtered_files.append(file)
-
-                filtered_files.sort(key=sort_files)
-
-                if len(filtered_files) > 0:
-                    filenames = [split_filename(file) for file in filtered_files]
-
-                    num_frames = len(np.unique([file[FRAME_POS] for file in filenames]))
-                    num_channels = len(np.unique([file[CHAN_POS] for file in filenames]))
-
-                    # Group image names by frame:
-                    # List[ List[frame_x_channel_1, frame_x_channel_2], List[frame_x+1_channel_1, frame_x+1_channel_2], ...]
-                    image_filenames = []
-                    for frame_no in range(num_frames):
-                        frame_image_names = []
-                        for channel_id in range(num_channels):
-                            frame_image_names.append(filtered_files[frame_no * num_channels + channel_id])
-                        image_filenames.append(frame_image_names)
-
-                    segmenter = CellPoseSegmenter(image_filenames, region_dir, seg_channel_id, cellpose_location)
-
-                    region_segmentation: List[ProcessedFrame] = segmenter.run_segmentation()
-                    output_path = region_dir + fov_folder + '_' + region_folder
-                    save_segmentation(region_segmentation, output_path)
-
-                    # Save a copy to disk as well as RAM
-                    if output_root is not None:
-                        src_file = output_path + ".json"
-                        if os.path.exists(src_file):
-                            dest_file = os.path.join(output_root, fov_folder, region_folder, os.path.split(src_file)[-1])
-                            print("Copying \n {} \n to \n {}".format(src_file, dest_file))
-                            shutil.copy2(src_file, dest_file)
+                    # Remove all z positions other than the one chosen for segmentation, as well as invalid filenames.
+                    # Regions whose z-stacks were reduced when cropping only have z position 0, which is used instead.
+                    region_z_position: int = z_position
+                    if {plane_id[1] for plane_id in map(parse_image_name, files) if plane_id is not None} == {0}:
+                        region_z_position = 0
+
+                    filtered_files: List[str] = []
+                    for file in files:
+                        split_name = split_filename(file)
+                        if len(split_name) != NUM_FILENAME_PARTS:
+                            print("Warning: file {} does not fit naming convention".format(file))
+                            continue
+                        elif int(split_name[Z_POS]) != region_z_position:
+                            continue
                         else:
-                            print("File copy failed - no segmentation saved!")
-                else:
-                    print("Warning: no suitable image files found")
+                            filtered_files.append(file)
+
+                    filtered_files.sort(key=sort_files)
+
+                    if len(filtered_files) > 0:
+                        filenames = [split_filename(file) for file in filtered_files]
+
+                        num_frames = len(np.unique([file[FRAME_POS] for file in filenames]))
+                        num_channels = len(np.unique([file[CHAN_POS] for file in filenames]))
+
+                        # Group image names by frame:
+                        # List[ List[frame_x_channel_1, frame_x_channel_2], List[frame_x+1_channel_1, frame_x+1_channel_2], ...]
+                        image_filenames = []
+                        for frame_no in range(num_frames):
+                            frame_image_names = []
+                            for channel_id in range(num_channels):
+                                frame_image_names.append(filtered_files[frame_no * num_channels + channel_id])
+                            image_filenames.append(frame_image_names)
+
+                        segmenter = CellPoseSegmenter(image_filenames, region_dir, seg_channel_id, cellpose_location, worker)
+
+                        region_segmentation: List[ProcessedFrame] = segmenter.run_segmentation()
+                        output_path = region_dir + fov_folder + '_' + region_folder
+                        src_file = save_segmentation(region_segmentation, output_path)
+
+                        # Save a copy to disk as well as RAM
+                        if output_root is not None:
+                            if os.path.exists(src_file):
+                                dest_file = os.path.join(output_root, fov_folder, region_folder, os.path.split(src_file)[-1])
+                                print("Copying \n {} \n to \n {}".format(src_file, dest_file))
+                                shutil.copy2(src_file, dest_file)
+                            else:
+                                print("File copy failed - no segmentation saved!")
+                    else:
+                        print("Warning: no suitable image files found")
 
-                end_time: float = time.time()
-                print("Region completed in {}s".format(end_time - start_time))
+                    end_time: float = time.time()
+                    print("Region completed in {}s".format(end_time - start_time))
 
 
 if __name__ == '__main__':
@@ -7,10 +7,72 @@ from typing import List, Union, Tuple
 from Segmentation.Utilities import fill_holes, find_holes, increase_contrast
 
 
+# Pre-processed copy of an image for histogram thresholding. Contrast adjustment, blurring and the search for the
+# histogram background peak only depend on the image, so are calculated once and shared by every threshold adjustment.
+
+# Arguments:
+# - raw_image: array containing image to be segmented
+# - blur_sd: standard deviation of the Gaussian blur to be applied to the image during pre-processing
+# - smoothing: width of the moving box average applied to the histogram and its derivative
+class HistogramThresholder:
+    def __init__(self, raw_image: np.ndarray, blur_sd: float, smoothing: int = 10) -> None:
+        self.blur_sd: float = blur_sd
+        self.image: np.ndarray = preprocess_image(raw_image, blur_sd)
+        self.histogram_peaks: Tuple[int, int] = find_histogram_peaks(self.image, smoothing)
+
+    def peak_edges(self, threshold: float) -> (int, int):
+        return adjust_peak_edges(self.histogram_peaks[0], self.histogram_peaks[1], threshold)
+
+    def threshold(self, threshold: float, erode_background: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Use identified peak to perform two-level threshold on image
+        # Lower threshold gives borders
+        peak_lower, peak_upper = self.peak_edges(threshold)
+        lower_threshold = self.image <= peak_lower
+        # Mid threshold gives background
+        mid_threshold = (self.image > peak_lower) & (self.image < peak_upper)
+        # Upper threshold gives cell and trap interior
+        upper_threshold = self.image >= peak_upper
+
+        borders: np.ndarray = lower_threshold.astype(np.uint8)
+        background: np.ndarray = mid_threshold.astype(np.uint8)
+        interior: np.ndarray = upper_threshold.astype(np.uint8)
+
+        # Identify pixels definitely in background via aggressive erosion
+        if erode_background:
+            background = cv2.erode(background, disk(5), iterations=1)
+
+        return borders, background, interior
+
+    def gap_fill(self, threshold: float, max_gap_size: int, mask_interior: bool = True, mask_holes: bool = True,
+                 combine_gap_fills: bool = True) -> (List[np.ndarray], List[np.ndarray]):
+        borders, background, interior = self.threshold(threshold)
+        background = cv2.erode(background, disk(5), iterations=1)
+
+        # Flip to convert from (row, column) to (column, row) for cv2 (x, y) format
+        background_points = np.flip(np.transpose(np.nonzero(background)), 1)
+        background_tuple = tuple(background_points[0])
+
+        return sequential_gap_fill(borders, interior, background_tuple, max_gap_size, mask_interior, mask_holes,
+                                   combine_gap_fills)
+
+    def find_background(self, threshold: float, min_region_size=1500) -> np.ndarray:
+        borders, background, interior = self.threshold(threshold)
+        background = cv2.erode(background, disk(5), iterations=1)
+
+        label_count, labels, stats, centroids = cv2.connectedComponentsWithStats(background.astype(np.uint8), connectivity=4)
+
+        for label in range(label_count):
+            if stats[label, cv2.CC_STAT_AREA] < min_region_size:
+                labels[labels == label] = 0
+
+        return labels != 0
+
+
 # Generate a binary image containing discrete regions, each corresponding to a unique segment in the input image.
 # Segmentation is carried out by running a two-level threshold, with the threshold values identified from the image's
 # histogram and modified by the supplied threshold adjustment. Identified object borders then undergo successively
 # larger gap fills, followed by hole identification to find segments.
+# When segmenting the same image with several threshold adjustments, use a single HistogramThresholder instead.
 
 # Arguments:
 # - image: array containing image to be segmented
@@ -23,17 +85,16 @@ from Segmentation.Utilities import fill_holes, find_holes, increase_contrast
 def histogram_threshold_gap_fill(raw_image: np.ndarray, blur_sd: float, threshold: float, max_gap_size: int,
                                  mask_interior: bool = True, mask_holes: bool = True,
                                  combine_gap_fills: bool = True) -> (List[np.ndarray], List[np.ndarray]):
-    borders, background, interior = histogram_threshold(raw_image, blur_sd, threshold)
-    background = cv2.erode(background, disk(5), iterations=1)
+    return HistogramThresholder(raw_image, blur_sd).gap_fill(threshold, max_gap_size, mask_interior, mask_holes,
+                                                             combine_gap_fills)
 
-    # Flip to convert from (row, column) to (column, row) for cv2 (x, y) format
-    background_points = np.flip(np.transpose(np.nonzero(background)), 1)
-    background_tuple = tuple(background_points[0])
 
-    return sequential_gap_fill(borders, interior, background_tuple, max_gap_size, mask_interior, mask_holes, combine_gap_fills)
+def histogram_threshold(raw_image: np.ndarray, blur_sd: float, threshold: float, erode_background: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    return HistogramThresholder(raw_image, blur_sd).threshold(threshold, erode_background)
 
 
-def histogram_threshold(raw_image: np.ndarray, blur_sd: float, threshold: float, erode_background: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+# Contrast adjust, convert to uint8 and blur an image ready for histogram thresholding
+def preprocess_image(raw_image: np.ndarray, blur_sd: float) -> np.ndarray:
     # Improve image contrast
     raw_image = increase_contrast(raw_image)
 
@@ -42,29 +103,9 @@ def histogram_threshold(raw_image: np.ndarray, blur_sd: float, threshold: float,
 
     # Blur image
     if blur_sd > 0:
-        gaussian_img = cv2.GaussianBlur(raw_image, (0, 0), blur_sd)
-        my_image = gaussian_img
+        return cv2.GaussianBlur(raw_image, (0, 0), blur_sd)
     else:
-        my_image = raw_image
-
-    # Use identified peak to perform two-level threshold on image
-    # Lower threshold gives borders
-    peak_lower, peak_upper = find_histogram_peak_edges(my_image, threshold)
-    lower_threshold = my_image <= peak_lower
-    # Mid threshold gives background
-    mid_threshold = (my_image > peak_lower) & (my_image < peak_upper)
-    # Upper threshold gives cell and trap interior
-    upper_threshold = my_image >= peak_upper
-
-    borders: np.ndarray = lower_threshold.astype(np.uint8)
-    background: np.ndarray = mid_threshold.astype(np.uint8)
-    interior: np.ndarray = upper_threshold.astype(np.uint8)
-
-    # Identify pixels definitely in background via aggressive erosion
-    if erode_background:
-        background = cv2.erode(background, disk(5), iterations=1)
-
-    return borders, background, interior
+        return raw_image
 
 
 def sequential_gap_fill(borders: np.ndarray, interior: np.ndarray, background_point: Tuple,
@@ -101,6 +142,15 @@ def sequential_gap_fill(borders: np.ndarray, interior: np.ndarray, background_po
 # Determines the upper and lower edges of the largest peak in the histogram of the supplied image, adjusted by the
 # threshold value.
 def find_histogram_peak_edges(image: np.ndarray, threshold: float, smoothing: int = 10) -> (int, int):
+    peaks = find_histogram_peaks(image, smoothing)
+    if peaks is None:
+        return
+    return adjust_peak_edges(peaks[0], peaks[1], threshold)
+
+
+# Locates the unadjusted edges of the largest histogram peak, as the highest maxima of the histogram's second
+# derivative either side of its minimum.
+def find_histogram_peaks(image: np.ndarray, smoothing: int = 10) -> (int, int):
     if len(image.shape) != 2:
         print("Error! image is not greyscale")
         return
@@ -140,7 +190,11 @@ def find_histogram_peak_edges(image: np.ndarray, threshold: float, smoothing: in
     lh_max_peak_index = lh_peak_indices[lh_peaks_sorted[-1]]
     rh_max_peak_index = rh_peak_indices[rh_peaks_sorted[-1]]
 
-    # Adjust lower and upper bounds of histogram peak according to threshold
+    return lh_max_peak_index, rh_max_peak_index
+
+
+# Adjust lower and upper bounds of histogram peak according to threshold
+def adjust_peak_edges(lh_max_peak_index: int, rh_max_peak_index: int, threshold: float) -> (int, int):
     peak_separation = rh_max_peak_index - lh_max_peak_index
     peak_lower = math.floor(lh_max_peak_index + (0.5 * threshold * peak_separation))
     peak_upper = math.ceil(rh_max_peak_index - (0.5 * threshold * peak_separation))
@@ -148,75 +202,115 @@ def find_histogram_peak_edges(image: np.ndarray, threshold: float, smoothing: in
     return peak_lower, peak_upper
 
 
-def clamp(x: float, minimum: float, maximum: float) -> float:
-    return max(minimum, min(x, maximum))
-
-
 # Fills gaps in an image as detected using supplied structuring element. Optional mask can be supplied, preventing
 # gap fills that intersect with the mask. Accepts an array of structuring elements to calculate different gap fills in
-# paralle;, returning results in an array.
+# parallel, returning results in an array.
+# For every contour pixel, the structuring element is placed over the image and, if it covers more than one separate
+# region, a line is drawn between the centroids of the first two regions. Rather than labelling each element window
+# separately, all windows are tiled into a single mosaic image (separated by empty gutters) and labelled in one pass.
 def gap_fill_mask(image: np.ndarray, struct_elements: List[np.ndarray],
                   mask: Union[None, np.ndarray] = None) -> np.ndarray:
-    contours, hierarchy = cv2.findContours(image, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-    num_contours = len(hierarchy[0])
-
-    output_images = np.zeros((len(struct_elements),) + image.shape)
-
-    for contour_id in range(num_contours):
-        contour_img = np.zeros(image.shape)
-        contour_img = cv2.drawContours(contour_img, contours, contour_id, 1)
-        points = np.transpose(np.nonzero(contour_img))
-
-        for point in points:
-            for element_id in range(len(struct_elements)):
-                element_image = np.zeros(image.shape)
+    output_images = np.zeros((len(struct_elements),) + image.shape, dtype=bool)
 
-                im_y, im_x = element_image.shape
-                el_y, el_x = struct_elements[element_id].shape
-
-                el_centre_x = math.floor((el_x - 1) / 2)
-                el_centre_y = math.floor((el_y - 1) / 2)
-
-                y_min = clamp(point[0] - el_centre_y, 0, im_y)
-                y_max = clamp(point[0] - el_centre_y + el_y, 0, im_y)
-                x_min = clamp(point[1] - el_centre_x, 0, im_x)
-                x_max = clamp(point[1] - el_centre_x + el_x, 0, im_x)
-
-                el_x_max = x_max - x_min
-                el_y_max = y_max - y_min
-
-                element_image[y_min:y_max, x_min:x_max] = struct_elements[element_id][0:el_y_max, 0:el_x_max]
-
-                # Use image instead of contours for AND, to avoid "filling gap" between borders of solids
-                # Only look at pixels overlapping with element to reduce computational load
-                and_img = np.logical_and(struct_elements[element_id][0:el_y_max, 0:el_x_max],
-                                         image[y_min:y_max, x_min:x_max])
-                ret, labels, stats, centroids = cv2.connectedComponentsWithStats(and_img.astype(np.uint8))
+    contours, hierarchy = cv2.findContours(image, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0:
+        return np.logical_or(output_images, image)
 
-                # If there's more than 2 regions then a gap has been crossed.
-                if ret > 2:
-                    cv2.line(labels, tuple(np.round(centroids[1]).astype(np.int)),
-                             tuple(np.round(centroids[2]).astype(np.int)), 1, 1)
+    contour_img = np.zeros(image.shape, dtype=np.uint8)
+    cv2.drawContours(contour_img, contours, -1, 1)
+    points = np.transpose(np.nonzero(contour_img))
 
-                    if mask is None:
-                        output_images[element_id][y_min:y_max, x_min:x_max] = np.logical_or(
-                            output_images[element_id][y_min:y_max, x_min:x_max], labels)
-                    else:
-                        if not np.any(labels[mask[y_min:y_max, x_min:x_max] == 1]):
-                            output_images[element_id][y_min:y_max, x_min:x_max] = np.logical_or(
-                                output_images[element_id][y_min:y_max, x_min:x_max], labels)
+    for element_id in range(len(struct_elements)):
+        lines = _gap_fill_lines(image, points, struct_elements[element_id], mask)
+        output_images[element_id][lines] = True
 
     return np.logical_or(output_images, image)
 
 
-def find_background(raw_image: np.ndarray, blur_sd: float, threshold: float, min_region_size=1500) -> np.ndarray:
-    borders, background, interior = histogram_threshold(raw_image, blur_sd, threshold)
-    background = cv2.erode(background, disk(5), iterations=1)
-
-    label_count, labels, stats, centroids = cv2.connectedComponentsWithStats(background.astype(np.uint8), connectivity=4)
+# Calculates the pixels of every gap-filling line for a single structuring element, centred on each of the supplied
+# points. Returns a tuple of (row, column) index arrays.
+def _gap_fill_lines(image: np.ndarray, points: np.ndarray, struct_element: np.ndarray,
+                    mask: Union[None, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    im_y, im_x = image.shape
+    el_y, el_x = struct_element.shape
+    el_centre_y = (el_y - 1) // 2
+    el_centre_x = (el_x - 1) // 2
+
+    # Element windows are clipped to the image, and the clipped window is always placed at the tile origin
+    y_min = np.clip(points[:, 0] - el_centre_y, 0, im_y)
+    y_max = np.clip(points[:, 0] - el_centre_y + el_y, 0, im_y)
+    x_min = np.clip(points[:, 1] - el_centre_x, 0, im_x)
+    x_max = np.clip(points[:, 1] - el_centre_x + el_x, 0, im_x)
+
+    # Tile size includes an empty gutter, and is kept even so that every tile is labelled with the same 2x2 block
+    # alignment as a standalone window. This keeps label ordering (and so the chosen regions) identical.
+    tile_y = el_y + 2 - (el_y % 2)
+    tile_x = el_x + 2 - (el_x % 2)
+    num_tiles = len(points)
+    grid_cols = max(1, int(math.ceil(math.sqrt(num_tiles))))
+    grid_rows = int(math.ceil(num_tiles / grid_cols))
+
+    rows = y_min[:, None] + np.arange(tile_y)[None, :]
+    cols = x_min[:, None] + np.arange(tile_x)[None, :]
+    valid_rows = rows < y_max[:, None]
+    valid_cols = cols < x_max[:, None]
+    rows = np.minimum(rows, im_y - 1)
+    cols = np.minimum(cols, im_x - 1)
+    valid = valid_rows[:, :, None] & valid_cols[:, None, :]
+
+    element = np.zeros((tile_y, tile_x), dtype=bool)
+    element[0:el_y, 0:el_x] = struct_element != 0
+
+    tiles = np.zeros((grid_rows * grid_cols, tile_y, tile_x), dtype=np.uint8)
+    tiles[:num_tiles] = (image[rows[:, :, None], cols[:, None, :]] != 0) & valid & element
+
+    def to_mosaic(tile_stack: np.ndarray) -> np.ndarray:
+        return tile_stack.reshape(grid_rows, grid_cols, tile_y, tile_x).transpose(0, 2, 1, 3).reshape(
+            grid_rows * tile_y, grid_cols * tile_x)
+
+    def from_mosaic(mosaic_image: np.ndarray) -> np.ndarray:
+        return mosaic_image.reshape(grid_rows, tile_y, grid_cols, tile_x).transpose(0, 2, 1, 3).reshape(
+            grid_rows * grid_cols, tile_y, tile_x)
+
+    mosaic = to_mosaic(tiles)
+    ret, labels, stats, centroids = cv2.connectedComponentsWithStats(mosaic)
+
+    # Assign each region to its tile, keeping regions within a tile in label order
+    tile_row = stats[1:, cv2.CC_STAT_TOP] // tile_y
+    tile_col = stats[1:, cv2.CC_STAT_LEFT] // tile_x
+    region_tiles = tile_row * grid_cols + tile_col
+    order = np.argsort(region_tiles, kind="stable")
+    sorted_tiles = region_tiles[order]
+    regions_per_tile = np.bincount(region_tiles, minlength=num_tiles)
+    first_region = np.searchsorted(sorted_tiles, np.arange(num_tiles))
+
+    # If there's more than one region in a tile then a gap has been crossed
+    gap_tiles = np.nonzero(regions_per_tile[:num_tiles] > 1)[0]
+    if len(gap_tiles) == 0:
+        return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+
+    label_1 = order[first_region[gap_tiles]] + 1
+    label_2 = order[first_region[gap_tiles] + 1] + 1
+    line_starts = np.round(centroids[label_1]).astype(np.int32)
+    line_ends = np.round(centroids[label_2]).astype(np.int32)
+
+    line_mosaic = np.zeros(mosaic.shape, dtype=np.uint8)
+    cv2.polylines(line_mosaic, list(np.stack((line_starts, line_ends), axis=1)), False, 1, 1)
+    line_tiles = from_mosaic(line_mosaic)
+
+    # Reject any gap fill where the regions or line intersect with the mask
+    accepted = gap_tiles
+    if mask is not None:
+        mask_tiles = np.zeros(tiles.shape, dtype=bool)
+        mask_tiles[:num_tiles] = (mask[rows[:, :, None], cols[:, None, :]] == 1) & valid
+        intersects = np.any(((tiles[gap_tiles] != 0) | (line_tiles[gap_tiles] != 0)) & mask_tiles[gap_tiles],
+                            axis=(1, 2))
+        accepted = gap_tiles[np.logical_not(intersects)]
+
+    # Region pixels are already present in the image, so only line pixels need to be added to the output
+    tile_ids, line_rows, line_cols = np.nonzero(line_tiles[accepted])
+    return y_min[accepted][tile_ids] + line_rows, x_min[accepted][tile_ids] + line_cols
 
-    for label in range(label_count):
-        if stats[label, cv2.CC_STAT_AREA] < min_region_size:
-            labels[labels == label] = 0
 
-    return labels != 0
+def find_background(raw_image: np.ndarray, blur_sd: float, threshold: float, min_region_size=1500) -> np.ndarray:
+    return HistogramThresholder(raw_image, blur_sd).find_background(threshold, min_region_size)
@@ -1,11 +1,12 @@
 import numpy as np
 import cv2
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
 
-from Segmentation.HistogramGapFill import histogram_threshold_gap_fill, find_background
-from Segmentation.Measurement import calculate_centroid, calculate_compactness, calculate_intensity
+from Segmentation.HistogramGapFill import HistogramThresholder
+from Segmentation.Measurement import calculate_intensity, measure_regions, RegionMeasurements
 from Segmentation.SegmentationData import Segment, Segmentation
+from Preprocessing.RegionStack import read_image
 
 
 @dataclass
@@ -21,17 +22,21 @@ class SegmentationParameters:
 
 
 # Calculate segmentation of an image, using a two-level histogram-determined threshold followed by
-# successively larger border gap filling and hole identification
+# successively larger border gap filling and hole identification. Images are read from channel_image_names, unless
+# they're already in memory and given as images.
 class HistogramSegmenter:
-    def __init__(self, channel_image_names: List[str], frame_no: int, parameters: SegmentationParameters, segmentation_channel: int = 0):
+    def __init__(self, channel_image_names: List[str], frame_no: int, parameters: SegmentationParameters, segmentation_channel: int = 0,
+                 images: Optional[List[np.ndarray]] = None):
         self.frame_no = frame_no
         self.image_names = channel_image_names
-        self.images: List[np.ndarray] = [cv2.imread(name, flags=(cv2.IMREAD_GRAYSCALE + cv2.IMREAD_UNCHANGED)) for name in channel_image_names]
+        self.images: List[np.ndarray] = images if images is not None else [read_image(name) for name in channel_image_names]
 
         self.parameters: SegmentationParameters = parameters
         self.segmentation_channel_id = segmentation_channel
 
-        self.background: np.ndarray = find_background(self.images[segmentation_channel], self.parameters.blur_sd, max(self.parameters.histogram_threshold_adjustments))
+        # Contrast adjustment, blur and histogram analysis are shared by the background and all threshold adjustments
+        self.thresholder: HistogramThresholder = HistogramThresholder(self.images[segmentation_channel], self.parameters.blur_sd)
+        self.background: np.ndarray = self.thresholder.find_background(max(self.parameters.histogram_threshold_adjustments))
         self.background_intensities = [calculate_intensity(image, self.background) for image in self.images]
 
         self.segmented_images: List[List[np.ndarray]] = []
@@ -44,7 +49,7 @@ class HistogramSegmenter:
         # print("Labelling segments")
         labelled_segments = self._label_segments(self.segmented_images)
         # print("Calculating segment conflicts")
-        labelled_segments = self._calculate_conflicts(labelled_segments)
+        labelled_segments = self._calculate_conflicts(self.segmented_images, labelled_segments)
         # print("Flattening segment array")
         self.segmentations = self._flatten_segments(labelled_segments)
         # print("Segmentation complete")
@@ -54,10 +59,7 @@ class HistogramSegmenter:
         segmented_images = []
 
         for threshold in self.parameters.histogram_threshold_adjustments:
-            filled, holes = histogram_threshold_gap_fill(self.images[self.segmentation_channel_id],
-                                                         self.parameters.blur_sd,
-                                                         threshold,
-                                                         self.parameters.max_gap_fill)
+            filled, holes = self.thresholder.gap_fill(threshold, self.parameters.max_gap_fill)
             filtered_segments = []
 
             for hole_img in holes:
@@ -86,22 +88,25 @@ class HistogramSegmenter:
             for gap_id in range(self.parameters.max_gap_fill):
                 segments = segmented_images[threshold_id][gap_id]
                 num_segments = np.amax(segments)
+                measurements: RegionMeasurements = measure_regions(segments, self.images, num_segments)
                 gap_segments = []
 
                 for segment_id in range(1, num_segments + 1):
-                    segment_img = (segments == segment_id).astype(np.uint8)
+                    segment_img, segment_offset = measurements.cropped_mask(segments, segment_id)
 
                     name = "f{}_t{}_g{}_s{}".format(self.frame_no,
                                                     self.parameters.histogram_threshold_adjustments[threshold_id],
                                                     gap_id,
                                                     segment_count)
-                    area = np.count_nonzero(segment_img)
-                    compactness = calculate_compactness(segment_img)
-                    centroid = calculate_centroid(segment_img)
-                    intensities: List[float] = [calculate_intensity(image, segment_img) for image in self.images]
+                    area = int(measurements.sizes[segment_id])
+                    compactness = measurements.compactness[segment_id]
+                    centroid = measurements.centroid(segment_id)
+                    intensities: List[float] = measurements.intensities(segment_id)
 
                     new_segment = Segment(seg_id=segment_count,
                                           mask_image=segment_img,
+                                          mask_offset=segment_offset,
+                                          frame_shape=segments.shape,
                                           frame_id=self.frame_no,
                                           name=name,
                                           centroid=centroid,
@@ -116,34 +121,36 @@ class HistogramSegmenter:
             labelled_segments.append(threshold_segments)
         return labelled_segments
 
-    def _calculate_conflicts(self, labelled_segments: List[List[List[Segment]]]) -> List[List[List[Segment]]]:
-        # For every possible segmentation generated for image
-        for threshold_id in range(len(self.parameters.histogram_threshold_adjustments)):
-            for gap_id in range(self.parameters.max_gap_fill):
-                segments = labelled_segments[threshold_id][gap_id]
-                for segment in segments:
-                    # Segments conflict with themselves
-                    segment.conflicts.append(segment.seg_id)
-                    # For each threshold, including current one
-                    for other_threshold_id in range(threshold_id, len(self.parameters.histogram_threshold_adjustments)):
-                        # For each gap size larger than current one
-                        # Don't want to compare segments from the same image, or duplicate comparisons
-                        if threshold_id == other_threshold_id:
-                            gap_range = range(gap_id, self.parameters.max_gap_fill)
-                        else:
-                            gap_range = range(0, self.parameters.max_gap_fill)
-
-                        for other_gap_id in gap_range:
-                            if threshold_id != other_threshold_id or gap_id != other_gap_id:
-                                other_segments = labelled_segments[other_threshold_id][other_gap_id]
-
-                                for other_segment in other_segments:
-                                    intersect_img = np.logical_and(segment.mask_image, other_segment.mask_image)
-                                    intersect = np.any(intersect_img)
-
-                                    if intersect:
-                                        segment.conflicts.append(other_segment.seg_id)
-                                        other_segment.conflicts.append(segment.seg_id)
+    def _calculate_conflicts(self, segmented_images: List[List[np.ndarray]],
+                             labelled_segments: List[List[List[Segment]]]) -> List[List[List[Segment]]]:
+        # Flatten (threshold, gap) pairs in order, so that the images to compare against are all those that follow
+        # Don't want to compare segments from the same image, or duplicate comparisons
+        label_images: List[np.ndarray] = [image for threshold_images in segmented_images for image in threshold_images]
+        image_segments: List[List[Segment]] = [segments for threshold_segments in labelled_segments
+                                               for segments in threshold_segments]
+
+        for image_id in range(len(label_images)):
+            # Find all overlapping segment label pairs with each later image in a single pass per image
+            overlaps: List[np.ndarray] = [find_label_overlaps(label_images[image_id], label_images[other_image_id])
+                                          for other_image_id in range(image_id + 1, len(label_images))]
+
+            for segment_id in range(len(image_segments[image_id])):
+                segment = image_segments[image_id][segment_id]
+                # Segments conflict with themselves
+                segment.conflicts.append(segment.seg_id)
+
+                for other_offset in range(len(overlaps)):
+                    other_segments = image_segments[image_id + 1 + other_offset]
+                    label_pairs = overlaps[other_offset]
+
+                    # Label pairs are sorted, so overlaps for this segment form a contiguous block
+                    first = np.searchsorted(label_pairs[:, 0], segment_id + 1, side='left')
+                    last = np.searchsorted(label_pairs[:, 0], segment_id + 1, side='right')
+
+                    for other_label in label_pairs[first:last, 1]:
+                        other_segment = other_segments[other_label - 1]
+                        segment.conflicts.append(other_segment.seg_id)
+                        other_segment.conflicts.append(segment.seg_id)
         return labelled_segments
 
     def _flatten_segments(self, labelled_segments: List[List[List[Segment]]]) -> List[Segmentation]:
@@ -161,3 +168,12 @@ class HistogramSegmenter:
 
                 segmentations.append(segmentation)
         return segmentations
+
+
+# Finds every pair of non-zero labels from two label images that share at least one pixel, via label co-occurrence.
+# Returns an (N, 2) array of (label_1, label_2) pairs, sorted by label_1 then label_2.
+def find_label_overlaps(labels_1: np.ndarray, labels_2: np.ndarray) -> np.ndarray:
+    overlap = (labels_1 != 0) & (labels_2 != 0)
+    label_range = int(np.amax(labels_2)) + 1
+    pair_codes = np.unique(labels_1[overlap].astype(np.int64) * label_range + labels_2[overlap])
+    return np.stack(np.divmod(pair_codes, label_range), axis=1)
@@ -1,7 +1,9 @@
 import cv2
 import numpy as np
 import math
-from typing import Tuple, Union
+from dataclasses import dataclass
+from scipy.ndimage import find_objects
+from typing import Tuple, Union, List, Optional
 
 
 def calculate_centroid(image: np.ndarray) -> Tuple[Union[float, any], ...]:
@@ -38,3 +40,68 @@ def calculate_intensity(image: np.ndarray, region: np.ndarray) -> float:
         return intensity_per_pixel
     else:
         return 0
+
+
+# Measurements for every region of a label image, indexed by label (index 0 is the unlabelled background)
+@dataclass
+class RegionMeasurements:
+    sizes: np.ndarray
+    centroids: np.ndarray
+    compactness: np.ndarray
+    channel_intensities: np.ndarray
+    bounding_boxes: List[Optional[Tuple[slice, slice]]]
+
+    def centroid(self, label: int) -> Tuple[float, float]:
+        return tuple(self.centroids[label])
+
+    def intensities(self, label: int) -> List[float]:
+        return list(self.channel_intensities[label])
+
+    # Mask of a single region cropped to its bounding box, along with the (row, column) offset of the crop
+    def cropped_mask(self, labels: np.ndarray, label: int) -> Tuple[np.ndarray, Tuple[int, int]]:
+        bounding_box = self.bounding_boxes[label]
+        if bounding_box is None:
+            return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+        return (labels[bounding_box] == label).astype(np.uint8), (bounding_box[0].start, bounding_box[1].start)
+
+
+# Measures size, centroid, compactness and mean intensity in each channel for all regions of a label image at once.
+# Sizes, centroids and intensities are accumulated per label in a single pass over the image using bincount, while
+# compactness contours are only calculated within each region's bounding box.
+def measure_regions(labels: np.ndarray, images: List[np.ndarray], num_labels: Optional[int] = None) -> RegionMeasurements:
+    if num_labels is None:
+        num_labels = int(np.amax(labels)) if labels.size > 0 else 0
+    flat_labels = labels.ravel().astype(np.intp)
+    bin_count = num_labels + 1
+
+    sizes = np.bincount(flat_labels, minlength=bin_count)[:bin_count]
+    rows, cols = np.indices(labels.shape)
+    row_sums = np.bincount(flat_labels, weights=rows.ravel(), minlength=bin_count)[:bin_count]
+    col_sums = np.bincount(flat_labels, weights=cols.ravel(), minlength=bin_count)[:bin_count]
+    intensity_sums = [np.bincount(flat_labels, weights=image.ravel(), minlength=bin_count)[:bin_count]
+                      for image in images]
+
+    # Empty regions are given zero centroid and intensity, matching the single-region functions
+    present = sizes > 0
+    divisor = np.where(present, sizes, 1)
+    centroids = np.zeros((bin_count, 2))
+    centroids[present, 0] = row_sums[present] / divisor[present]
+    centroids[present, 1] = col_sums[present] / divisor[present]
+
+    channel_intensities = np.zeros((bin_count, len(images)))
+    for channel_id in range(len(images)):
+        channel_intensities[present, channel_id] = intensity_sums[channel_id][present] / divisor[present]
+
+    # Pad each bounding box by a pixel so that contours are identical to those found in the full image
+    compactness = np.zeros(bin_count)
+    height, width = labels.shape
+    bounding_boxes = [None] + find_objects(labels, max_label=num_labels)
+    for label_id, bounding_box in enumerate(bounding_boxes[1:], start=1):
+        if bounding_box is not None:
+            y_slice, x_slice = bounding_box
+            crop = labels[max(0, y_slice.start - 1):min(height, y_slice.stop + 1),
+                          max(0, x_slice.start - 1):min(width, x_slice.stop + 1)]
+            compactness[label_id] = calculate_compactness((crop == label_id).astype(np.uint8))
+
+    return RegionMeasurements(sizes=sizes, centroids=centroids, compactness=compactness,
+                              channel_intensities=channel_intensities, bounding_boxes=bounding_boxes)
@@ -0,0 +1,299 @@
+import threading
+import queue
+from dataclasses import dataclass
+from multiprocessing import Process, Queue
+from multiprocessing.connection import Connection
+from typing import List, Tuple, Optional, Dict, Callable, Any, Union
+import numpy as np
+from Preprocessing.ND2Frames import ND2Frames
+from Preprocessing.ImageCropper import ImageCropper, CropParameters
+from Preprocessing.CropRunner import prepare_drift_trajectories, CROP_PROCESSES
+from Preprocessing.RegionStack import RegionStack, create_region_stack, image_name
+from Preprocessing.ZReduction import ZReduction, reduce_zstack
+from Segmentation.HistogramSegmenter import HistogramSegmenter, SegmentationParameters
+from Segmentation.SegmentationData import ProcessedFrame, save_segmentation
+
+# Streaming pipeline from an ND2 file to segmented trapping regions, without cropped images making a round trip through
+# the disk. Each frame of each FOV is cropped, z-selected and segmented by a chain of stages, each with its own pool of
+# worker processes, connected by bounded queues so that a slow stage holds back the stages before it rather than
+# letting region frames pile up in memory. Only the final outputs are saved, by the main process: each region's
+# z-selected planes, as a region stack with one z position, and its segmentation once every frame has been segmented.
+#
+# Region frames are passed between stages as RegionFrames, holding a (channel, z, y, x) array after cropping and a
+# (channel, y, x) array after z-selection. An error in any stage is passed down the pipeline as a string, and stops it.
+# Progress is reported with the RunningDialog protocol: (completed, total) region frames, or a string on error.
+
+QUEUE_SIZE = 16
+CROP_WORKERS = 1
+Z_WORKERS = 1
+SEGMENTATION_WORKERS = max(1, CROP_PROCESSES - CROP_WORKERS - Z_WORKERS)
+
+# Seconds between checks for workers that have died, while waiting for region frames
+WORKER_CHECK_INTERVAL = 1.0
+
+PipelineItem = Union["RegionFrame", str]
+
+
+@dataclass
+class RegionFrame:
+    fov_id: int
+    region_id: int
+    frame_id: int
+    images: np.ndarray
+    frame: Optional[ProcessedFrame] = None
+
+
+# Settings passed to the segmentation stage, which needs each region's output path for the saved image names
+@dataclass
+class PipelineSegmentation:
+    parameters: SegmentationParameters
+    segmentation_channel: int
+    fov_paths: Dict[int, str]
+
+
+# Each crop worker opens its own reader for the ND2 file, as readers can't be shared between processes
+_worker_cropper: Optional[ImageCropper] = None
+_worker_ignored_regions: Dict[int, List[int]] = {}
+_worker_planes: Optional[np.ndarray] = None
+
+
+def _init_crop_worker(filename: str, parameters: CropParameters, trajectories: Dict[int, List[Tuple[float, float]]],
+                      ignored_regions: Dict[int, List[int]]) -> None:
+    global _worker_cropper, _worker_ignored_regions
+    _worker_cropper = ImageCropper(ND2Frames(filename), parameters)
+    _worker_cropper.drift_trajectories.update(trajectories)
+    _worker_ignored_regions = ignored_regions
+
+
+def _crop_stage(task: Tuple[int, int]) -> List[PipelineItem]:
+    global _worker_planes
+    fov_id, frame_id = task
+    for region_id, region in enumerate(_worker_cropper.crop_regions):
+        region.ignored = region_id in _worker_ignored_regions[fov_id]
+
+    # All planes of a frame are read into one buffer reused for every frame, as the crops are copies
+    _worker_planes = _worker_cropper.frames.read_planes(frame_id, fov_id, out=_worker_planes)
+    region_planes = _worker_cropper.crop_frame_regions(fov_id, frame_id, _worker_planes)
+    return [RegionFrame(fov_id, region_id, frame_id, planes) for region_id, planes in region_planes.items()]
+
+
+# Regions cropped without a z reduction are reduced to their best focused z position, as segmentation uses one z position
+def _z_select_stage(item: RegionFrame, parameters: CropParameters) -> List[PipelineItem]:
+    reduction: ZReduction = parameters.z_reduction if parameters.z_reduction != ZReduction.NONE else ZReduction.BEST_FOCUS
+    item.images = np.ascontiguousarray(reduce_zstack(item.images, reduction, parameters.focus_metric, parameters.focus_channel))
+    return [item]
+
+
+# Segmentation includes measuring each segment's size, shape and channel intensities
+def _segment_stage(item: RegionFrame, segmentation: PipelineSegmentation) -> List[PipelineItem]:
+    region_path: str = segmentation.fov_paths[item.fov_id] + "/region_{}".format(item.region_id)
+    image_names: List[str] = ["{}/{}".format(region_path, image_name(item.frame_id, 0, channel_id)) for channel_id in range(len(item.images))]
+
+    segmenter = HistogramSegmenter(image_names, item.frame_id, segmentation.parameters, segmentation.segmentation_channel,
+                                   images=list(item.images))
+    segmenter.run_segmentation()
+    item.frame = ProcessedFrame(region_path, item.frame_id, image_names, item.images.shape[1:], segmenter.segmentations)
+    return [item]
+
+
+def _stage_name(stage: Callable[..., List[PipelineItem]]) -> str:
+    return stage.__name__.strip("_").replace("_", " ")
+
+
+# Workers that have died, e.g. killed by a signal, as descriptions with their exit codes. A stage that loses all its
+# workers without reporting an error would otherwise hold up the whole pipeline, or leave region frames unsegmented.
+def _failed_workers(stages: List[List[Process]]) -> List[str]:
+    return ["{} worker exit code {}".format(_stage_name(stage), worker.exitcode)
+            for stage, workers in zip((_crop_stage, _z_select_stage, _segment_stage), stages)
+            for worker in workers if worker.exitcode not in (None, 0)]
+
+
+def _describe_item(item: Any) -> str:
+    if isinstance(item, RegionFrame):
+        return "FOV {} region {} frame {}".format(item.fov_id, item.region_id, item.frame_id)
+    return "FOV {} frame {}".format(*item)
+
+
+# Worker process loop for a stage. None on the input queue stops the worker, errors from earlier stages are passed
+# straight on, and an exception in the stage, or in setting up the worker, is passed on as an error.
+def _run_stage(stage: Callable[..., List[PipelineItem]], stage_args: Tuple, input_queue: Queue, output_queue: Queue,
+               initializer: Optional[Callable[..., None]] = None, initargs: Tuple = ()) -> None:
+    try:
+        if initializer is not None:
+            initializer(*initargs)
+    except Exception as error:
+        output_queue.put("Error starting {}: {}".format(_stage_name(stage), error))
+        return
+
+    while True:
+        item = input_queue.get()
+        if item is None:
+            return
+        if isinstance(item, str):
+            output_queue.put(item)
+            continue
+
+        try:
+            results: List[PipelineItem] = stage(item, *stage_args)
+        except Exception as error:
+            results = ["Error in {} for {}: {}".format(_stage_name(stage), _describe_item(item), error)]
+        for result in results:
+            output_queue.put(result)
+
+
+# Put tasks on the first queue, followed by a None for each worker of the first stage
+def _feed_tasks(tasks: List[Tuple[int, int]], task_queue: Queue, num_workers: int) -> None:
+    for task in tasks:
+        task_queue.put(task)
+    for _ in range(num_workers):
+        task_queue.put(None)
+
+
+# Once all workers of a stage have stopped, stop the workers of the next stage, which then can't receive any more items.
+# The final stage's None on the output queue tells the main process the pipeline has finished.
+def _stop_stages(stages: List[List[Process]], queues: List[Queue]) -> None:
+    for stage_id, workers in enumerate(stages):
+        for worker in workers:
+            worker.join()
+        next_workers: int = len(stages[stage_id + 1]) if stage_id + 1 < len(stages) else 1
+        for _ in range(next_workers):
+            queues[stage_id + 1].put(None)
+
+
+# Allocate a stack for the z-selected planes of each region that isn't ignored. Returns an error message on failure.
+def _prepare_pipeline_output(cropper: ImageCropper, fov_ids: List[int], fov_paths: Dict[int, str],
+                             ignored_regions: Dict[int, List[int]]) -> Optional[str]:
+    frames: ND2Frames = cropper.frames
+    dtype: np.dtype = frames[frames.calculate_position(0, fov_ids[0], 0, 0)].dtype
+    for fov_id in fov_ids:
+        for region_id, region in enumerate(cropper.crop_regions):
+            if region_id in ignored_regions[fov_id]:
+                continue
+
+            region_path: str = fov_paths[fov_id] + "/region_{}".format(region_id)
+            try:
+                create_region_stack(region_path, (frames.num_frames, 1, frames.num_channels, region.height, region.width), dtype,
+                                    cropper.parameters.output_codec)
+            except FileExistsError:
+                return "Can't save images: {} already exists".format(region_path)
+            except OSError:
+                return "Can't create pipeline output: {}".format(region_path)
+    return None
+
+
+# Crop, z-select and segment every frame of each FOV in fov_ids, using the cropper's parameters and any drift
+# trajectories it has already calculated. Regions to ignore can be given for each FOV, otherwise the cropper's ignored
+# regions are used for all FOVs. Region frames are segmented from each region's z-selected planes, which are saved in
+# <output_path>/<nd2 name>/fov_<fov_id>/region_<region_id> along with the region's segmentation,
+# fov_<fov_id>_region_<region_id>.seg.
+def run_pipeline(cropper: ImageCropper, fov_ids: List[int], output_path: str, segmentation_parameters: SegmentationParameters,
+                 progress_callback: Connection, segmentation_channel: int = 0, ignored_regions: Optional[Dict[int, List[int]]] = None,
+                 crop_workers: int = CROP_WORKERS, z_workers: int = Z_WORKERS, segmentation_workers: int = SEGMENTATION_WORKERS,
+                 queue_size: int = QUEUE_SIZE) -> None:
+    frames: ND2Frames = cropper.frames
+    if min(crop_workers, z_workers, segmentation_workers, queue_size) < 1:
+        progress_callback.send("Pipeline needs at least one worker for each stage, and a queue size of at least one")
+        return
+    if ignored_regions is None:
+        cropper_ignored: List[int] = [region_id for region_id, region in enumerate(cropper.crop_regions) if region.ignored]
+        ignored_regions = {fov_id: cropper_ignored for fov_id in fov_ids}
+    fov_paths: Dict[int, str] = {fov_id: cropper.fov_output_path(output_path, fov_id) for fov_id in fov_ids}
+
+    region_ids: Dict[int, List[int]] = {fov_id: [region_id for region_id in range(len(cropper.crop_regions)) if region_id not in ignored_regions[fov_id]]
+                                        for fov_id in fov_ids}
+    total_frames: int = frames.num_frames * sum(len(regions) for regions in region_ids.values())
+    frames_completed: int = 0
+
+    trajectories, error = prepare_drift_trajectories(cropper, fov_ids, fov_paths, crop_workers)
+    if error is None:
+        error = _prepare_pipeline_output(cropper, fov_ids, fov_paths, ignored_regions)
+    if error is not None:
+        progress_callback.send(error)
+        return
+
+    # Queues into and out of each stage. Items left unread when the pipeline is stopped early don't hold up the main
+    # process's exit.
+    queues: List[Queue] = [Queue(maxsize=queue_size) for _ in range(4)]
+    for stage_queue in queues:
+        stage_queue.cancel_join_thread()
+
+    segmentation = PipelineSegmentation(segmentation_parameters, segmentation_channel, fov_paths)
+    stages: List[List[Process]] = [
+        [Process(target=_run_stage, args=(_crop_stage, (), queues[0], queues[1], _init_crop_worker,
+                                          (frames.filename, cropper.parameters, trajectories, ignored_regions)))
+         for _ in range(crop_workers)],
+        [Process(target=_run_stage, args=(_z_select_stage, (cropper.parameters,), queues[1], queues[2])) for _ in range(z_workers)],
+        [Process(target=_run_stage, args=(_segment_stage, (segmentation,), queues[2], queues[3])) for _ in range(segmentation_workers)]]
+    for workers in stages:
+        for worker in workers:
+            worker.start()
+
+    # Frames are cropped in order within each FOV, so regions complete, and their segmentations are saved, FOV by FOV
+    tasks: List[Tuple[int, int]] = [(fov_id, frame_id) for fov_id in fov_ids for frame_id in range(frames.num_frames)]
+    threading.Thread(target=_feed_tasks, args=(tasks, queues[0], crop_workers), daemon=True).start()
+    threading.Thread(target=_stop_stages, args=(stages, queues), daemon=True).start()
+
+    stacks: Dict[Tuple[int, int], RegionStack] = {}
+    region_frames: Dict[Tuple[int, int], List[ProcessedFrame]] = {}
+    try:
+        while True:
+            try:
+                item: Optional[PipelineItem] = queues[3].get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                failed: List[str] = _failed_workers(stages)
+                if len(failed) > 0:
+                    progress_callback.send("Pipeline stopped after {} of {} region frames: {}".format(
+                        frames_completed, total_frames, ", ".join(failed)))
+                    return
+                continue
+            if item is None:
+                break
+            if isinstance(item, str):
+                progress_callback.send(item)
+                return
+
+            error = _save_region_frame(item, fov_paths[item.fov_id], frames.num_frames, stacks, region_frames)
+            if error is not None:
+                progress_callback.send(error)
+                return
+
+            frames_completed += 1
+            progress_callback.send((frames_completed, total_frames))
+
+        # Every worker has stopped by the time the final None arrives
+        failed = _failed_workers(stages)
+        if len(failed) > 0 or frames_completed != total_frames:
+            progress_callback.send("Pipeline stopped after {} of {} region frames ({})".format(
+                frames_completed, total_frames, ", ".join(failed) if len(failed) > 0 else "no worker errors"))
+    finally:
+        for workers in stages:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+
+
+# Save a region frame's z-selected planes, and the region's segmentation once all its frames have been segmented.
+# Returns an error message on failure.
+def _save_region_frame(item: RegionFrame, fov_path: str, num_frames: int, stacks: Dict[Tuple[int, int], RegionStack],
+                       region_frames: Dict[Tuple[int, int], List[ProcessedFrame]]) -> Optional[str]:
+    key: Tuple[int, int] = (item.fov_id, item.region_id)
+    region_path: str = fov_path + "/region_{}".format(item.region_id)
+    try:
+        if key not in stacks:
+            stacks[key] = RegionStack(region_path, writable=True)
+        for channel_id, image in enumerate(item.images):
+            stacks[key].write_plane(item.frame_id, 0, channel_id, image)
+    except OSError:
+        return "Error saving image: {}".format(region_path)
+
+    region_frames.setdefault(key, []).append(item.frame)
+    if len(region_frames[key]) < num_frames:
+        return None
+
+    segmentation: List[ProcessedFrame] = sorted(region_frames.pop(key), key=lambda frame: frame.frame_no)
+    try:
+        stacks.pop(key).flush()
+        save_segmentation(segmentation, region_path + "/fov_{}_region_{}".format(item.fov_id, item.region_id))
+    except OSError:
+        return "Error saving segmentation: {}".format(region_path)
+    return None
@@ -27,9 +27,10 @@ class SegmentFrameImage:
         for segmentation in self.frame_segmentations[self.frame_id].segmentations:
             for segment in segmentation.segments:
                 # Set hue to seg colour, saturation and value to 1, in area of segment
-                self.frame_image[:, :, 0] += (segment.mask_image * colour_vals[seg_count]) * 255
-                self.frame_image[:, :, 1] += segment.mask_image * 255
-                self.frame_image[:, :, 2] += segment.mask_image * 255
+                rows, cols = segment.mask_slices()
+                self.frame_image[rows, cols, 0] += (segment.mask_image * colour_vals[seg_count]) * 255
+                self.frame_image[rows, cols, 1] += segment.mask_image * 255
+                self.frame_image[rows, cols, 2] += segment.mask_image * 255
                 seg_count += 1
 
         if show_background:
@@ -46,7 +47,7 @@ class SegmentFrameImage:
 
         for segmentation in self.frame_segmentations[self.frame_id].segmentations:
             for segment in segmentation.segments:
-                if segment.mask_image[point] != 0:
+                if segment.contains_point(point):
                     segs_at_point.append(segment)
 
         return segs_at_point
@@ -1,13 +1,106 @@
 import numpy as np
-from typing import List, Tuple, Any, Dict
+from typing import List, Tuple, Any, Dict, Optional, Union
 import json
 import dataclasses
 import copy
 import os
+import struct
+import zlib
+import mmap
+from collections import OrderedDict
+
+# Segmentation results can be stored as json, or in a binary container of compressed mask blobs:
+#   magic (4 bytes), format version (uint16), header length (uint64), json metadata header, mask blobs
+# The header holds the metadata for every frame, segmentation and segment, with each mask replaced by a reference to
+# its zlib compressed blob, given as an offset from the start of the blob section
+SEGMENTATION_JSON_EXTENSION = ".json"
+SEGMENTATION_BINARY_EXTENSION = ".seg"
+BINARY_MAGIC = b"SEGB"
+BINARY_VERSION = 1
+BINARY_PREAMBLE = struct.Struct("<4sHQ")
+MASK_COMPRESSION_LEVEL = 3
+# Upper limit on the memory used by masks decoded from lazily loaded binary files
+MASK_CACHE_BYTES = 64 * 1024 * 1024
+
+
+# Memory maps the blob section of a binary segmentation file, decoding masks on request. Decoded masks are kept in a
+# least recently used cache of limited size, and are read-only as changes would be lost on eviction.
+class MaskStore:
+    def __init__(self, filename: str, blob_offset: int, cache_bytes: int = MASK_CACHE_BYTES) -> None:
+        with open(filename, 'rb') as handle:
+            self.data: mmap.mmap = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.blob_offset: int = blob_offset
+        self.cache_bytes: int = cache_bytes
+        self.cached_bytes: int = 0
+        self.cache: OrderedDict = OrderedDict()
+
+    def blob(self, reference: Dict) -> bytes:
+        start = self.blob_offset + reference["offset"]
+        return self.data[start:start + reference["length"]]
+
+    def load(self, reference: Dict) -> np.ndarray:
+        key = reference["offset"]
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        mask = decode_mask(self.blob(reference), reference["shape"])
+        mask.flags.writeable = False
+        self.cache[key] = mask
+        self.cached_bytes += mask.nbytes
+        while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= evicted.nbytes
+        return mask
+
+
+@dataclasses.dataclass
+class LazyMask:
+    store: MaskStore
+    reference: Dict
+
+    def load(self) -> np.ndarray:
+        return self.store.load(self.reference)
+
+
+# Mask fields given a LazyMask are decoded from its store whenever they are read, until the field is assigned a new
+# array. The LazyMask is kept under "_lazy_<field name>", leaving the field itself unset so that __getattr__ is used.
+class LazyMaskFields:
+    def _defer_lazy_mask(self, name: str) -> bool:
+        value = self.__dict__.get(name)
+        if isinstance(value, LazyMask):
+            self.__dict__["_lazy_" + name] = value
+            del self.__dict__[name]
+            return True
+        return False
+
+    # Returns the LazyMask still backing a field, or None if the field has been loaded eagerly or replaced
+    def _lazy_mask(self, name: str) -> Optional[LazyMask]:
+        if name in self.__dict__:
+            return None
+        return self.__dict__.get("_lazy_" + name)
+
+    def __getattr__(self, name: str) -> Any:
+        lazy_mask = self.__dict__.get("_lazy_" + name)
+        if lazy_mask is None:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        return lazy_mask.load()
+
+    # Memory maps can't be pickled, so lazy fields are decoded into the state
+    def __getstate__(self) -> Dict:
+        state = {}
+        for entry in self.__dict__:
+            if entry.startswith("_lazy_"):
+                name = entry[len("_lazy_"):]
+                if name not in self.__dict__:
+                    state[name] = np.array(self.__dict__[entry].load())
+            else:
+                state[entry] = self.__dict__[entry]
+        return state
 
 
 @dataclasses.dataclass
-class Segment:
+class Segment(LazyMaskFields):
     seg_id: int
     frame_id: int
     mask_image: np.ndarray
@@ -20,12 +113,75 @@ class Segment:
     manually_chosen: bool = False
     incoming_assignments: List[Any] = dataclasses.field(default_factory=list)
     outgoing_assignments: List[Any] = dataclasses.field(default_factory=list)
+    # Masks are cropped to the segment's bounding box, mask_offset gives the (row, column) position of the crop within
+    # a frame of size frame_shape
+    mask_offset: Tuple[int, int] = (0, 0)
+    frame_shape: Optional[Tuple[int, int]] = None
+
+    def __post_init__(self) -> None:
+        # Segments from a lazily loaded binary file always have a frame shape, and their masks are left undecoded
+        if self._defer_lazy_mask("mask_image"):
+            self.mask_offset = tuple(int(i) for i in self.mask_offset)
+            self.frame_shape = tuple(int(i) for i in self.frame_shape[0:2])
+            return
+
+        self.mask_image = np.asarray(self.mask_image, dtype=np.uint8)
+        # Empty crops are stored as an empty list, which loses the array dimensions
+        if self.mask_image.ndim != 2:
+            self.mask_image = self.mask_image.reshape((0, 0))
+        self.mask_offset = tuple(int(i) for i in self.mask_offset)
+
+        # Full frame masks, e.g. from older segmentation files, are cropped to their bounding box
+        if self.frame_shape is None:
+            self.set_full_mask(self.mask_image)
+        else:
+            self.frame_shape = tuple(int(i) for i in self.frame_shape[0:2])
+
+    def mask_slices(self) -> Tuple[slice, slice]:
+        return (slice(self.mask_offset[0], self.mask_offset[0] + self.mask_image.shape[0]),
+                slice(self.mask_offset[1], self.mask_offset[1] + self.mask_image.shape[1]))
+
+    def full_mask(self) -> np.ndarray:
+        full_mask = np.zeros(self.frame_shape, dtype=np.uint8)
+        full_mask[self.mask_slices()] = self.mask_image
+        return full_mask
+
+    def set_full_mask(self, mask: np.ndarray) -> None:
+        self.frame_shape = tuple(mask.shape[0:2])
+        self.mask_image, self.mask_offset = crop_mask(mask)
+
+    # Returns the mask padded by up to padding pixels of zeros on each side (clipped to the frame edges), along with
+    # the frame slices covered by the padded mask. Used where operations such as borders extend beyond the crop.
+    def padded_mask(self, padding: int) -> Tuple[np.ndarray, Tuple[slice, slice]]:
+        rows, cols = self.mask_slices()
+        top = max(0, rows.start - padding)
+        bottom = min(self.frame_shape[0], rows.stop + padding)
+        left = max(0, cols.start - padding)
+        right = min(self.frame_shape[1], cols.stop + padding)
+
+        padded = np.zeros((bottom - top, right - left), dtype=np.uint8)
+        padded[rows.start - top:rows.stop - top, cols.start - left:cols.stop - left] = self.mask_image
+        return padded, (slice(top, bottom), slice(left, right))
+
+    def contains_point(self, point: Tuple[int, int]) -> bool:
+        row = point[0] - self.mask_offset[0]
+        col = point[1] - self.mask_offset[1]
+        return 0 <= row < self.mask_image.shape[0] and 0 <= col < self.mask_image.shape[1] and self.mask_image[row, col] != 0
+
+    def touches_frame_edge(self) -> bool:
+        if self.mask_image.size == 0:
+            return False
+        rows, cols = self.mask_slices()
+        return bool((rows.start == 0 and np.any(self.mask_image[0, :])) or
+                    (rows.stop == self.frame_shape[0] and np.any(self.mask_image[-1, :])) or
+                    (cols.start == 0 and np.any(self.mask_image[:, 0])) or
+                    (cols.stop == self.frame_shape[1] and np.any(self.mask_image[:, -1])))
 
     def to_json(self) -> Dict:
         # dataclasses.asdict doesn't work, as assignments are unpickleable and it doesn't seem to use __getstate__
         dict_class = {}
         for entry in self.__dict__:
-            if entry != "mask_image" and entry != "centroid" and entry != "incoming_assignments" and entry != "outgoing_assignments":
+            if entry != "mask_image" and entry != "centroid" and entry != "incoming_assignments" and entry != "outgoing_assignments" and not entry.startswith("_lazy_"):
                 dict_class[entry] = copy.deepcopy(self.__dict__[entry])
         dict_class["mask_image"] = self.mask_image.tolist()
         dict_class["centroid"] = list(self.centroid)
@@ -36,26 +192,40 @@ class Segment:
     @classmethod
     def from_json(cls: "Segment", data: Dict) -> "Segment":
         seg: Segment = cls(**data)
-        seg.mask_image = np.array(data["mask_image"]).astype(np.uint8)
         seg.centroid = tuple(seg.centroid)
         return seg
 
     # Clear incoming/outgoing assignment lists to allow pickling
     def __getstate__(self) -> Dict:
-        state = self.__dict__.copy()
+        state = super().__getstate__()
         state["incoming_assignments"] = []
         state["outgoing_assignments"] = []
         return state
 
 
+# Crops a mask to the bounding box of its non-zero pixels, returning the cropped mask and its (row, column) offset
+def crop_mask(mask: np.ndarray) -> Tuple[np.ndarray, Tuple[int, int]]:
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    cols = np.flatnonzero(np.any(mask, axis=0))
+
+    if len(rows) == 0:
+        return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+
+    cropped = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].astype(np.uint8)
+    return cropped, (int(rows[0]), int(cols[0]))
+
+
 @dataclasses.dataclass
-class Segmentation:
+class Segmentation(LazyMaskFields):
     name: str
     segmentation_channel_id: int
     background_mask: np.ndarray
     background_intensities: List[float]
     segments: List[Segment]
 
+    def __post_init__(self) -> None:
+        self._defer_lazy_mask("background_mask")
+
 
 @dataclasses.dataclass
 class ProcessedFrame:
@@ -66,7 +236,60 @@ class ProcessedFrame:
     segmentations: List[Segmentation]
 
 
-def save_segmentation(segmentations: List[ProcessedFrame], filename: str) -> None:
+# Scalar fields of a segment, without its mask, for analysis over whole datasets
+@dataclasses.dataclass
+class SegmentMetadata:
+    seg_id: int
+    frame_id: int
+    name: str
+    centroid: tuple
+    size: int
+    compactness: float
+    channel_intensities: List[float]
+    conflicts: List[int]
+    manually_chosen: bool = False
+
+    @classmethod
+    def from_json(cls: "SegmentMetadata", data: Dict) -> "SegmentMetadata":
+        return cls(**{field.name: data[field.name] for field in dataclasses.fields(cls) if field.name in data})
+
+    def __post_init__(self) -> None:
+        self.centroid = tuple(self.centroid)
+
+
+@dataclasses.dataclass
+class SegmentationMetadata:
+    name: str
+    segmentation_channel_id: int
+    background_intensities: List[float]
+    segments: List[SegmentMetadata]
+
+
+@dataclasses.dataclass
+class FrameMetadata:
+    root_directory: str
+    frame_no: int
+    image_names: List[str]
+    frame_shape: Tuple
+    segmentations: List[SegmentationMetadata]
+
+
+# Saves in the format given by the filename's extension, defaulting to the binary format when there is no extension.
+# Returns the path of the saved file.
+def save_segmentation(segmentations: List[ProcessedFrame], filename: str) -> str:
+    extension = os.path.splitext(filename)[1]
+    if extension not in (SEGMENTATION_JSON_EXTENSION, SEGMENTATION_BINARY_EXTENSION):
+        extension = SEGMENTATION_BINARY_EXTENSION
+        filename = filename + extension
+
+    if extension == SEGMENTATION_BINARY_EXTENSION:
+        save_segmentation_binary(segmentations, filename)
+    else:
+        save_segmentation_json(segmentations, filename)
+    return filename
+
+
+def save_segmentation_json(segmentations: List[ProcessedFrame], filename: str) -> None:
     class SegmentationEncoder(json.JSONEncoder):
         def default(self, obj: Any) -> Any:
             if dataclasses.is_dataclass(obj):
@@ -80,12 +303,27 @@ def save_segmentation(segmentations: List[ProcessedFrame], filename: str) -> Non
 
             return super().default(obj)
 
-    with open(filename + ".json", 'w') as handle:
+    with open(filename, 'w') as handle:
         datastr = json.dumps(segmentations, cls=SegmentationEncoder)
         handle.write(datastr)
 
 
-def load_segmentation(filename: str) -> List[ProcessedFrame]:
+# Loads either format, detected from the start of the file. With lazy set, masks in binary files are only decoded when
+# accessed; json files are always loaded in full.
+def load_segmentation(filename: str, lazy: bool = False) -> List[ProcessedFrame]:
+    if is_binary_segmentation(filename):
+        loaded_segmentations = load_segmentation_binary(filename, lazy)
+    else:
+        loaded_segmentations = load_segmentation_json(filename)
+
+    # File structure: <nd2_name>/<fov_no>/<region_no>/segmentation.json
+    root_directory: str = os.path.split(filename)[0]
+    for segmentation in loaded_segmentations:
+        segmentation.root_directory = root_directory
+    return loaded_segmentations
+
+
+def load_segmentation_json(filename: str) -> List[ProcessedFrame]:
     def decode_segmentation(dict_class: dict):
         if "dataclass_type" in dict_class:
             if dict_class["dataclass_type"] == "ProcessedFrame":
@@ -101,7 +339,6 @@ def load_segmentation(filename: str) -> List[ProcessedFrame]:
                     segments = []
                     for dict_segment in segmentation.segments:
                         segment = Segment(**dict_segment) # noqa, suppress type error as dict_segment will be dict not Segment due to json decoding
-                        segment.mask_image = np.array(segment.mask_image).astype(np.uint8)
                         segments.append(segment)
                     segmentation.segments = segments
 
@@ -116,7 +353,6 @@ def load_segmentation(filename: str) -> List[ProcessedFrame]:
                 segments = []
                 for dict_segment in dict_class["segments"]:
                     segment = Segment(**dict_segment)
-                    segment.mask_image = np.array(segment.mask_image).astype(np.uint8)
                     segments.append(segment)
 
                 output.segments = segments
@@ -127,9 +363,166 @@ def load_segmentation(filename: str) -> List[ProcessedFrame]:
 
     with open(filename, 'r') as handle:
         loaded_segmentations: List[ProcessedFrame] = json.load(handle, object_hook=decode_segmentation)
+    return loaded_segmentations
 
-    # File structure: <nd2_name>/<fov_no>/<region_no>/segmentation.json
-    root_directory: str = os.path.split(filename)[0]
-    for segmentation in loaded_segmentations:
-        segmentation.root_directory = root_directory
+
+def is_binary_segmentation(filename: str) -> bool:
+    with open(filename, 'rb') as handle:
+        return handle.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def save_segmentation_binary(segmentations: List[ProcessedFrame], filename: str) -> None:
+    blobs: List[bytes] = []
+    blob_offset = 0
+
+    # Compress a mask into the list of blobs, returning the reference stored in the header. Masks that haven't been
+    # decoded from a lazily loaded file are copied across still compressed.
+    def add_mask(owner: LazyMaskFields, name: str) -> Dict:
+        nonlocal blob_offset
+        lazy_mask = owner._lazy_mask(name)
+        if lazy_mask is not None:
+            blob = lazy_mask.store.blob(lazy_mask.reference)
+            shape = list(lazy_mask.reference["shape"])
+        else:
+            mask = np.ascontiguousarray(getattr(owner, name), dtype=np.uint8)
+            blob = zlib.compress(mask.tobytes(), MASK_COMPRESSION_LEVEL)
+            shape = list(mask.shape)
+        reference = {"offset": blob_offset, "length": len(blob), "shape": shape}
+        blobs.append(blob)
+        blob_offset += len(blob)
+        return reference
+
+    frames = []
+    for frame in segmentations:
+        frame_header = {"root_directory": frame.root_directory,
+                        "frame_no": frame.frame_no,
+                        "image_names": frame.image_names,
+                        "frame_shape": frame.frame_shape,
+                        "segmentations": []}
+
+        for segmentation in frame.segmentations:
+            segmentation_header = {"name": segmentation.name,
+                                   "segmentation_channel_id": segmentation.segmentation_channel_id,
+                                   "background_mask": add_mask(segmentation, "background_mask"),
+                                   "background_intensities": segmentation.background_intensities,
+                                   "segments": []}
+
+            for segment in segmentation.segments:
+                segment_header = segment.to_json()
+                segment_header["mask_image"] = add_mask(segment, "mask_image")
+                segmentation_header["segments"].append(segment_header)
+
+            frame_header["segmentations"].append(segmentation_header)
+        frames.append(frame_header)
+
+    # Intensities and ids may be numpy scalars
+    def encode_scalar(obj: Any) -> Any:
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+    header = json.dumps({"frames": frames}, default=encode_scalar).encode("utf-8")
+
+    # Write to a temporary file and then replace, so that a file which is still memory mapped by a lazy load is never
+    # modified in place
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, 'wb') as handle:
+        handle.write(BINARY_PREAMBLE.pack(BINARY_MAGIC, BINARY_VERSION, len(header)))
+        handle.write(header)
+        for blob in blobs:
+            handle.write(blob)
+    os.replace(temp_filename, filename)
+
+
+# Reads the preamble and metadata header of a binary file, leaving the handle at the start of the blob section.
+# Returns the header and the offset of the blob section.
+def read_binary_header(handle: Any, filename: str) -> Tuple[Dict, int]:
+    magic, version, header_length = BINARY_PREAMBLE.unpack(handle.read(BINARY_PREAMBLE.size))
+    if magic != BINARY_MAGIC:
+        raise ValueError("{} is not a binary segmentation file".format(filename))
+    if version > BINARY_VERSION:
+        raise ValueError("{} uses segmentation format version {}, newer than supported version {}".format(filename, version, BINARY_VERSION))
+
+    header = json.loads(handle.read(header_length).decode("utf-8"))
+    return header, BINARY_PREAMBLE.size + header_length
+
+
+def load_segmentation_binary(filename: str, lazy: bool = False) -> List[ProcessedFrame]:
+    with open(filename, 'rb') as handle:
+        header, blob_offset = read_binary_header(handle, filename)
+        blob_data = handle.read() if not lazy else None
+
+    if lazy:
+        store = MaskStore(filename, blob_offset)
+
+    def read_mask(reference: Dict) -> Union[np.ndarray, LazyMask]:
+        if lazy:
+            return LazyMask(store, reference)
+        return decode_mask(blob_data[reference["offset"]:reference["offset"] + reference["length"]], reference["shape"])
+
+    loaded_segmentations: List[ProcessedFrame] = []
+    for frame_header in header["frames"]:
+        segmentations = []
+        for segmentation_header in frame_header["segmentations"]:
+            segments = []
+            for segment_header in segmentation_header["segments"]:
+                segment_header["mask_image"] = read_mask(segment_header["mask_image"])
+                segments.append(Segment.from_json(segment_header))
+
+            segmentations.append(Segmentation(name=segmentation_header["name"],
+                                              segmentation_channel_id=segmentation_header["segmentation_channel_id"],
+                                              background_mask=read_mask(segmentation_header["background_mask"]),
+                                              background_intensities=segmentation_header["background_intensities"],
+                                              segments=segments))
+
+        loaded_segmentations.append(ProcessedFrame(root_directory=frame_header["root_directory"],
+                                                   frame_no=frame_header["frame_no"],
+                                                   image_names=frame_header["image_names"],
+                                                   frame_shape=frame_header["frame_shape"],
+                                                   segmentations=segmentations))
     return loaded_segmentations
+
+
+# Loads the scalar fields of every frame, segmentation and segment, without decoding any masks. Binary files only have
+# their header read; json files are parsed without building any objects for the masks.
+def load_segmentation_metadata(filename: str) -> List[FrameMetadata]:
+    if is_binary_segmentation(filename):
+        with open(filename, 'rb') as handle:
+            frames, _ = read_binary_header(handle, filename)
+        frames = frames["frames"]
+    else:
+        with open(filename, 'r') as handle:
+            frames = json.load(handle)
+
+    # Both formats share the same layout of frame, segmentation and segment dictionaries
+    root_directory: str = os.path.split(filename)[0]
+    return [FrameMetadata(root_directory=root_directory,
+                          frame_no=frame["frame_no"],
+                          image_names=frame["image_names"],
+                          frame_shape=tuple(frame["frame_shape"]),
+                          segmentations=[SegmentationMetadata(name=segmentation["name"],
+                                                              segmentation_channel_id=segmentation["segmentation_channel_id"],
+                                                              background_intensities=segmentation["background_intensities"],
+                                                              segments=[SegmentMetadata.from_json(segment) for segment in segmentation["segments"]])
+                                         for segmentation in frame["segmentations"]])
+            for frame in frames]
+
+
+def decode_mask(blob: bytes, shape: List[int]) -> np.ndarray:
+    return np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(shape).copy()
+
+
+# Converts a json segmentation file to the binary format, saved alongside the original. Returns the new file's path.
+def convert_segmentation(filename: str) -> str:
+    segmentations = load_segmentation_json(filename)
+    output_filename = os.path.splitext(filename)[0] + SEGMENTATION_BINARY_EXTENSION
+    save_segmentation_binary(segmentations, output_filename)
+    return output_filename
+
+
+# Where a segmentation file has been converted to the binary format, drop the original json copy from a list of names
+def preferred_segmentation_files(filenames: List[str]) -> List[str]:
+    binary_names = set(os.path.splitext(name)[0] for name in filenames
+                       if os.path.splitext(name)[1] == SEGMENTATION_BINARY_EXTENSION)
+    return [name for name in filenames if not (os.path.splitext(name)[1] == SEGMENTATION_JSON_EXTENSION and
+                                               os.path.splitext(name)[0] in binary_names)]
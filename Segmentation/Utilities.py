@@ -41,9 +41,9 @@ def find_segmented_background(image: np.ndarray, segments: Union[List[Segment],
     if isinstance(segments, np.ndarray):
         segmented_image = segments
     else:
-        segmented_image = np.zeros(frame_shape)
+        segmented_image = np.zeros(image.shape[0:2])
         for seg in segments:
-            segmented_image += seg.mask_image
+            segmented_image[seg.mask_slices()] += seg.mask_image
 
     median_background = find_background(image)
     segment_background = segmented_image == 0
@@ -109,3 +109,36 @@ def rotate_image(image: np.ndarray, angle: float):
     rot_mat = cv2.getRotationMatrix2D(image_center, angle, 1.0)
     result = cv2.warpAffine(image, rot_mat, image.shape[1::-1], flags=cv2.INTER_LINEAR)
     return result
+
+
+# Region of an image as it would be after rotate_image, i.e. crop_plane of the rotated image, without rotating the rest
+# of the image. The rotation and the region's offset are combined into a single warp into a region-sized output.
+def rotate_crop(image: np.ndarray, angle: float, x: int, y: int, width: int, height: int) -> np.ndarray:
+    if angle == 0:
+        return crop_plane(image, x, y, width, height)
+
+    image_center = tuple(np.array(image.shape[1::-1]) / 2)
+    rot_mat = cv2.getRotationMatrix2D(image_center, angle, 1.0)
+    rot_mat[:, 2] -= (x, y)
+    output: np.ndarray = cv2.warpAffine(image, rot_mat, (width, height), flags=cv2.INTER_LINEAR)
+
+    # Parts of the region outside the rotated image's borders are zero, as with crop_plane
+    x_start, y_start = min(max(-x, 0), width), min(max(-y, 0), height)
+    x_end, y_end = max(min(image.shape[1] - x, width), x_start), max(min(image.shape[0] - y, height), y_start)
+    output[:y_start] = 0
+    output[y_end:] = 0
+    output[:, :x_start] = 0
+    output[:, x_end:] = 0
+    return output
+
+
+# Section of an image covered by a region, zero-padded where drift has moved the region past the image border, so that
+# every plane of a region has the same shape
+def crop_plane(image: np.ndarray, x: int, y: int, width: int, height: int) -> np.ndarray:
+    output: np.ndarray = np.zeros((height, width), dtype=image.dtype)
+    x_start, y_start = max(x, 0), max(y, 0)
+    x_end, y_end = min(x + width, image.shape[1]), min(y + height, image.shape[0])
+
+    if x_end > x_start and y_end > y_start:
+        output[y_start - y:y_end - y, x_start - x:x_end - x] = image[y_start:y_end, x_start:x_end]
+    return output
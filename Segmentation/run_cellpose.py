@@ -1,49 +1,97 @@
-import argparse
-from contextlib import contextmanager
 import sys
 import os
-import pickle
-import io as py_io
+import json
+import struct
+from typing import BinaryIO, List, Optional
+import numpy as np
 
 import logging
 # Prevent cellpose logging info when installed as package
 logging.disable(logging.INFO)
 
-from cellpose import models, io
-
 # CellPose requires a different python version, so can't be run from within the venv for this project
-# Instead we run it through a subprocess, using this script which is copied to CellPose's location
-
-
-# Used to suppress STDOUT output from CellPose, code taken from here:
-# https://thesmithfam.org/blog/2012/10/25/temporarily-suppress-console-output-in-python/
-@contextmanager
-def suppress_stdout() -> None:
-    with open(os.devnull, "w") as devnull:
-        old_stdout = sys.stdout
-        sys.stdout = devnull
-        old_sterr = sys.stderr
-        sys.stderr = devnull
+# Instead we run it through a subprocess, using this script which is copied to CellPose's location.
+# The subprocess is a long-lived worker, which loads the model once and then segments batches of images sent over its
+# STDIN, returning masks over its STDOUT, with CellPose's own output discarded:
+#   request: a json line, either {"paths": [...]} or {"arrays": n} followed by n arrays
+#   response: a json line, either {"count": n} followed by n mask arrays, or {"error": "..."}
+# Each array is sent as a header giving its dtype and shape, followed by its raw data.
+# This file is also imported by CellPoseSegmenter for the array encoding, so cellpose is only imported when run.
+
+ARRAY_HEADER = struct.Struct("<8sII")
+
+CHANNELS = [0, 0]
+DIAMETER = 25
+MODEL_TYPE = 'cyto'
+
+
+def write_array(stream: BinaryIO, array: np.ndarray) -> None:
+    array = np.ascontiguousarray(array)
+    stream.write(ARRAY_HEADER.pack(array.dtype.str.encode("ascii"), array.shape[0], array.shape[1]))
+    stream.write(array.tobytes())
+
+
+def read_exactly(stream: BinaryIO, length: int) -> bytes:
+    data = stream.read(length)
+    if len(data) != length:
+        raise EOFError("Stream closed after {} of {} bytes".format(len(data), length))
+    return data
+
+
+def read_array(stream: BinaryIO) -> np.ndarray:
+    dtype, height, width = ARRAY_HEADER.unpack(read_exactly(stream, ARRAY_HEADER.size))
+    dtype = np.dtype(dtype.rstrip(b"\0").decode("ascii"))
+    return np.frombuffer(read_exactly(stream, height * width * dtype.itemsize), dtype=dtype).reshape((height, width))
+
+
+def write_message(stream: BinaryIO, message: dict) -> None:
+    stream.write((json.dumps(message) + "\n").encode("utf-8"))
+
+
+def read_message(stream: BinaryIO) -> Optional[dict]:
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode("utf-8"))
+
+
+def run_worker(stdin: BinaryIO, stdout: BinaryIO) -> None:
+    from cellpose import models, io
+
+    model = models.Cellpose(gpu=False, model_type=MODEL_TYPE)
+
+    while True:
+        request = read_message(stdin)
+        if request is None:
+            break
+
+        # Arrays are read before anything can fail, so that the stream stays in step with the client
+        images: List[np.ndarray] = [read_array(stdin) for _ in range(request.get("arrays", 0))]
+
         try:
-            yield
-        finally:
-            sys.stdout = old_stdout
-            sys.stderr = old_sterr
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('filenames', type=str, nargs='+')
-args = parser.parse_args()
-image_filenames = args.filenames
-channels = [0, 0]
-imgs = [io.imread(file) for file in image_filenames]
-
-with suppress_stdout():
-    model = models.Cellpose(gpu=False, model_type='cyto')
-    masks, flows, styles, diams = model.eval(imgs, diameter=25, channels=channels)
-
-# Return pickled data over STDOUT, encoded following info here
-# https://stackoverflow.com/questions/26218944/transmitting-a-pickled-object-output-between-python-scripts-through-a-subprocess
-mask_str = pickle.dumps(masks, 0)
-sys.stdout = py_io.TextIOWrapper(sys.stdout.detach(), encoding='latin-1')
-print(mask_str.decode('latin-1'), end='', flush=True)
+            if "paths" in request:
+                images = [io.imread(file) for file in request["paths"]]
+
+            masks, flows, styles, diams = model.eval(images, diameter=DIAMETER, channels=CHANNELS)
+        except Exception as error:
+            write_message(stdout, {"error": repr(error)})
+            stdout.flush()
+            continue
+
+        write_message(stdout, {"count": len(masks)})
+        for mask in masks:
+            write_array(stdout, mask)
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    # Responses are sent on a duplicate of STDOUT's file descriptor, which is then pointed at devnull, so that output
+    # from CellPose, torch or C extensions writing to file descriptor 1 can't corrupt them. STDERR is left alone, so
+    # that crashes can be diagnosed from the client's terminal.
+    sys.stdout.flush()
+    response_stream = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+    run_worker(sys.stdin.buffer, response_stream)
@@ -1,7 +1,7 @@
 from enum import Enum, unique, auto
 from typing import List, Optional, Dict
 import copy
-from Segmentation.SegmentationData import Segment
+from Segmentation.SegmentationData import Segment, SegmentMetadata
 import dataclasses
 
 
@@ -85,3 +85,23 @@ class Cell(object):
 
     def check_exists(self, frame_id: int) -> bool:
         return self.first_frame <= frame_id < self.first_frame + self.lifespan
+
+
+# Scalar fields and lineage of a cell, with segment metadata in place of full segments
+@dataclasses.dataclass
+class CellMetadata:
+    cell_id: int
+    parent_id: Optional[int]
+    assignments: List[SegmentAssignment] = dataclasses.field(default_factory=list)
+    segments: List[SegmentMetadata] = dataclasses.field(default_factory=list)
+    first_frame: int = 0
+    lifespan: int = 0
+
+    @classmethod
+    def from_json(cls: "CellMetadata", data: Dict) -> "CellMetadata":
+        return cls(cell_id=data["cell_id"],
+                   parent_id=data["parent_id"],
+                   assignments=[SegmentAssignment.from_json(assignment) for assignment in data["assignments"]],
+                   segments=[SegmentMetadata.from_json(seg) for seg in data["segments"]],
+                   first_frame=data["first_frame"],
+                   lifespan=data["lifespan"])
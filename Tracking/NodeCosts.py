@@ -127,14 +127,27 @@ def find_midpoint(min_val, max_val, slope, x, y) -> float:
 
 
 def calculate_pixel_separation(segment_1: Segment, segment_2: Segment) -> float:
-    combined_image = segment_1.mask_image + segment_2.mask_image
+    # Both masks are pasted into the union of their bounding boxes; the distance from segment 1 to the nearest pixel of
+    # segment 2 is the same as in the full frame, as the closest path never leaves the box
+    top = min(segment_1.mask_offset[0], segment_2.mask_offset[0])
+    left = min(segment_1.mask_offset[1], segment_2.mask_offset[1])
+    bottom = max(segment_1.mask_offset[0] + segment_1.mask_image.shape[0], segment_2.mask_offset[0] + segment_2.mask_image.shape[0])
+    right = max(segment_1.mask_offset[1] + segment_1.mask_image.shape[1], segment_2.mask_offset[1] + segment_2.mask_image.shape[1])
+
+    mask_1 = np.zeros((bottom - top, right - left), dtype=np.uint8)
+    mask_2 = np.zeros((bottom - top, right - left), dtype=np.uint8)
+    for segment, mask in ((segment_1, mask_1), (segment_2, mask_2)):
+        row, col = segment.mask_offset[0] - top, segment.mask_offset[1] - left
+        mask[row:row + segment.mask_image.shape[0], col:col + segment.mask_image.shape[1]] = segment.mask_image
+
+    combined_image = mask_1 + mask_2
     if np.amax(combined_image) < 2:
         inverted_combined = np.logical_not(combined_image)
-        seg_2_zeroed = inverted_combined + 2 * segment_1.mask_image
+        seg_2_zeroed = inverted_combined + 2 * mask_1
         dist_transformed = cv2.distanceTransform(seg_2_zeroed, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
 
         # Adjust separation by 1 so that it is zero when objects have no gap between them
-        min_dist = np.amin(dist_transformed[segment_1.mask_image != 0]) - 1
+        min_dist = np.amin(dist_transformed[mask_1 != 0]) - 1
         return min_dist
     else:
         return 0
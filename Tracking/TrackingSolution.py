@@ -4,7 +4,7 @@ import json
 import copy
 import os
 
-from Tracking.Cell import Cell
+from Tracking.Cell import Cell, CellMetadata
 
 
 @dataclasses.dataclass
@@ -30,6 +30,15 @@ class TrackingSolution:
         return solution
 
 
+# Tracking solution with cell metadata in place of full cells, for analysis over whole datasets
+@dataclasses.dataclass
+class TrackingSolutionMetadata:
+    total_frames: int
+    root_directory: str
+    image_filenames: List[List[str]]
+    cells: List[CellMetadata]
+
+
 def save_tracking_solution(solution: TrackingSolution, filename: str) -> None:
     with open(filename + ".json", 'w') as handle:
         solution_json: dict = solution.to_json()
@@ -47,3 +56,13 @@ def load_tracking_solution(filename: str) -> TrackingSolution:
     solution.root_directory = root_directory
 
     return solution
+
+
+def load_tracking_solution_metadata(filename: str) -> TrackingSolutionMetadata:
+    with open(filename, 'r') as handle:
+        solution_json: dict = json.load(handle)
+
+    return TrackingSolutionMetadata(total_frames=solution_json["total_frames"],
+                                    root_directory=os.path.split(filename)[0],
+                                    image_filenames=solution_json["image_filenames"],
+                                    cells=[CellMetadata.from_json(cell) for cell in solution_json["cells"]])
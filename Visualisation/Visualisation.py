@@ -6,6 +6,7 @@ from typing import List, Tuple
 import cv2
 
 from Tracking.Cell import Cell
+from Segmentation.SegmentationData import Segment
 
 
 # Convert a binary image into a coloured area with a coloured border
@@ -20,6 +21,21 @@ def colourise_binary_mask(image: np.ndarray, area_colour: Tuple, border_colour:
     return image_rgb
 
 
+# Colourise a segment's cropped mask, returning the coloured crop and its (rows, columns) slices within the full frame.
+# The crop is padded so that the border is found in the same way as for a full frame mask.
+def colourise_segment_crop(segment: Segment, area_colour: Tuple, border_colour: Tuple) -> Tuple[np.ndarray, Tuple[slice, slice]]:
+    padded_mask, slices = segment.padded_mask(1)
+    return colourise_binary_mask(padded_mask, area_colour, border_colour), slices
+
+
+# Colourise a segment's cropped mask, returning an image the size of the full frame
+def colourise_segment(segment: Segment, area_colour: Tuple, border_colour: Tuple) -> np.ndarray:
+    image_rgb = np.zeros(tuple(segment.frame_shape) + (3,), dtype=int)
+    crop_rgb, slices = colourise_segment_crop(segment, area_colour, border_colour)
+    image_rgb[slices] = crop_rgb
+    return image_rgb
+
+
 def generate_border_mask(image: np.ndarray, thickness: int) -> np.ndarray:
     border = cv2.findContours(image.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
     border_image = np.zeros(image.shape).astype(np.uint8)
@@ -33,16 +49,17 @@ def plot_frame(cell_data: List[Cell], frame_id: int, label_cells: bool = True):
     frame_cell_list = [cell for cell in cell_data if
                        cell.first_frame <= frame_id < cell.lifespan + cell.first_frame]
 
-    frame_shape = cell_data[0].segments[0].mask_image.shape
+    frame_shape = cell_data[0].segments[0].frame_shape
     frame_image = np.full(frame_shape[0:2] + (3,), 0.0)
 
     for cell in frame_cell_list:
         segment = cell.segments[frame_id - cell.first_frame]
 
         # Set hue to seg colour, saturation and value to 1, in area of segment
-        frame_image[:, :, 0] += (segment.mask_image * colour_vals[cell.cell_id])
-        frame_image[:, :, 1] += segment.mask_image
-        frame_image[:, :, 2] += segment.mask_image
+        rows, cols = segment.mask_slices()
+        frame_image[rows, cols, 0] += (segment.mask_image * colour_vals[cell.cell_id])
+        frame_image[rows, cols, 1] += segment.mask_image
+        frame_image[rows, cols, 2] += segment.mask_image
 
     fig, ax = plt.subplots()
     ax.imshow(hsv_to_rgb(frame_image), cmap='rainbow')
@@ -65,16 +82,17 @@ def generate_gif(cell_data: List[Cell], first_frame: int, num_frames: int, outpu
         frame_cell_list = [cell for cell in cell_data if
                            cell.first_frame <= frame < cell.lifespan + cell.first_frame]
 
-        frame_shape = cell_data[0].segments[0].mask_image.shape
+        frame_shape = cell_data[0].segments[0].frame_shape
         frame_image = np.full(frame_shape[0:2] + (3,), 0.0)
 
         for cell in frame_cell_list:
             segment = cell.segments[frame - cell.first_frame]
 
             # Set hue to seg colour, saturation and value to 1, in area of segment
-            frame_image[:, :, 0] += (segment.mask_image * colour_vals[cell.cell_id])
-            frame_image[:, :, 1] += segment.mask_image
-            frame_image[:, :, 2] += segment.mask_image
+            rows, cols = segment.mask_slices()
+            frame_image[rows, cols, 0] += (segment.mask_image * colour_vals[cell.cell_id])
+            frame_image[rows, cols, 1] += segment.mask_image
+            frame_image[rows, cols, 2] += segment.mask_image
 
         plt.figure()
         fig, ax = plt.subplots()
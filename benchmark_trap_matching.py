@@ -0,0 +1,81 @@
+"""Micro-benchmark of trap matching for drift correction, comparing ImageCropper's vectorised calculate_xy_offset with
+the original loop-based matching on synthetic trap grids"""
+
+import timeit
+from dataclasses import dataclass
+from typing import List, Tuple
+import numpy as np
+from Preprocessing.ImageCropper import calculate_xy_offset
+
+# 40x FOVs contain around 90 traps
+GRID_SIZES = [(6, 5), (12, 8), (20, 15)]
+TRAP_SPACING = (197, 161)
+POSITION_NOISE = 1.5
+MISSING_FRACTION = 0.05
+REPEATS = 20
+
+
+def loop_xy_offset(image_1_trap_centroids: List[Tuple[float, float]], image_2_trap_centroids: List[Tuple[float, float]]) -> Tuple[float, float]:
+    @dataclass
+    class TrapMapping:
+        id_1: int
+        id_2: int
+        distance: float
+
+        def __lt__(self, other) -> bool:
+            return self.distance < other.distance
+    trap_mappings: List[TrapMapping] = []
+
+    if len(image_1_trap_centroids) == 0 or len(image_2_trap_centroids) == 0:
+        return 0, 0
+
+    for id_1 in range(len(image_1_trap_centroids)):
+        point_1 = image_1_trap_centroids[id_1]
+        distances: List[float] = []
+
+        for id_2 in range(len(image_2_trap_centroids)):
+            point_2 = image_2_trap_centroids[id_2]
+            distances.append((point_1[0] - point_2[0]) ** 2. + (point_1[1] - point_2[1]) ** 2.)
+
+        trap_mappings.append(TrapMapping(id_1, int(np.argmin(distances)), np.min(distances)))
+
+    final_maps = []
+    for id_2 in range(len(image_2_trap_centroids)):
+        img_2_trap_maps = [mapping for mapping in trap_mappings if mapping.id_2 == id_2]
+        if len(img_2_trap_maps) > 0:
+            final_maps.append(min(img_2_trap_maps))
+
+    average_distance: float = np.average([mapping.distance for mapping in final_maps])
+    sd_distance: float = float(np.std([mapping.distance for mapping in final_maps]))
+    xy_shifts: List[Tuple[float, float]] = []
+
+    for mapping in final_maps:
+        if average_distance - sd_distance <= mapping.distance <= average_distance + sd_distance:
+            point_1 = image_1_trap_centroids[mapping.id_1]
+            point_2 = image_2_trap_centroids[mapping.id_2]
+            xy_shifts.append((point_2[0] - point_1[0], point_2[1] - point_1[1]))
+
+    return tuple(np.average(xy_shifts, axis=0))
+
+
+# Trap centroids on a grid, shifted by drift, with noise in each position and a few traps not detected
+def generate_trap_grid(rng: np.random.Generator, columns: int, rows: int, drift: Tuple[float, float]) -> List[Tuple[float, float]]:
+    x, y = np.meshgrid(np.arange(columns) * TRAP_SPACING[0], np.arange(rows) * TRAP_SPACING[1])
+    points = np.stack((x.ravel(), y.ravel()), axis=1) + drift + rng.normal(0, POSITION_NOISE, (columns * rows, 2))
+    detected = rng.random(len(points)) > MISSING_FRACTION
+    return [tuple(point) for point in points[detected]]
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+
+    for columns, rows in GRID_SIZES:
+        traps_1 = generate_trap_grid(rng, columns, rows, (0, 0))
+        traps_2 = generate_trap_grid(rng, columns, rows, (6.5, -3.0))
+
+        assert np.allclose(loop_xy_offset(traps_1, traps_2), calculate_xy_offset(traps_1, traps_2), rtol=0, atol=1e-9)
+
+        loop_time = min(timeit.repeat(lambda: loop_xy_offset(traps_1, traps_2), number=1, repeat=REPEATS))
+        vectorised_time = min(timeit.repeat(lambda: calculate_xy_offset(traps_1, traps_2), number=1, repeat=REPEATS))
+        print("{} x {} grid ({} / {} traps): loop {:.3f}ms, vectorised {:.3f}ms, {:.0f}x faster".format(
+            columns, rows, len(traps_1), len(traps_2), loop_time * 1000, vectorised_time * 1000, loop_time / vectorised_time))
@@ -0,0 +1,27 @@
+"""Script for building the overview pyramid of an ND2 file, a set of downsampled copies of every plane which the image
+viewer and cropping tool show in place of full resolution planes, so that stepping through frames is fast. The pyramid
+is saved next to the ND2 file, in a folder with the same name and the extension .overview."""
+
+import argparse
+import time
+from Preprocessing.ND2Frames import ND2Frames
+from Preprocessing.OverviewPyramid import build_overview_pyramid, overview_path, OVERVIEW_MAX_SIZE
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the overview pyramid of an ND2 file")
+    parser.add_argument("input", help="ND2 file to build the overview of")
+    parser.add_argument("--max-size", type=int, default=OVERVIEW_MAX_SIZE,
+                        help="largest width or height of the overview's largest level")
+    args = parser.parse_args()
+    if args.max_size < 1:
+        parser.error("--max-size must be at least 1")
+
+    start_time = time.monotonic()
+
+    def print_progress(completed: int, total: int) -> None:
+        print("\rBuilt {}/{} frames and FOVs ({:.1f}s)".format(completed, total, time.monotonic() - start_time), end="", flush=True)
+
+    with ND2Frames(args.input) as frames:
+        build_overview_pyramid(frames, overview_path(args.input), args.max_size, print_progress)
+    print("\nSaved overview to {}".format(overview_path(args.input)))
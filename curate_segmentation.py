@@ -6,7 +6,7 @@ import re
 import shutil
 import time
 from GUI.SegmentationCurator import run_viewer
-from Segmentation.SegmentationData import load_segmentation, ProcessedFrame
+from Segmentation.SegmentationData import load_segmentation, ProcessedFrame, preferred_segmentation_files
 
 input_path = "/ramdisk/2022-01-25_wafer9_lo_fluo_3out_1h30cycle_air_edf"  # 5'UTR 1
 # input_path = "/ramdisk/2022-02-09_wafer9_lo_fluo_3out_1h30mcycle_air_edf"  # 5'UTR 2
@@ -21,7 +21,7 @@ second_output_path = os.path.join("/smalldata", os.path.split(input_path)[1])
 FOV_REGEX = "^fov_[0-9]+$"
 REGION_REGEX = "^region_[0-9]+$"
 IMAGE_REGEX = "^frame_[0-9]+_z_[0-9]+_channel_[0-9]+\.tif$"
-SEG_REGEX = "^fov_[0-9]+_region_[0-9]+\.json$"
+SEG_REGEX = "^fov_[0-9]+_region_[0-9]+\.(json|seg)$"
 
 # Data positions within filenames
 FRAME_POS = 1
@@ -49,7 +49,7 @@ for fov_folder in sorted(fov_folders, key=sort_folders):
 
     for region_folder in sorted(region_folders, key=sort_folders):
         region_path: str = fov_path + region_folder + '/'
-        seg_files: List[str] = [file for file in os.listdir(region_path) if re.search(SEG_REGEX, file) is not None]
+        seg_files: List[str] = preferred_segmentation_files([file for file in os.listdir(region_path) if re.search(SEG_REGEX, file) is not None])
         if len(seg_files) == 1:
             region_count += 1
 
@@ -67,8 +67,11 @@ for fov_folder in sorted(fov_folders, key=sort_folders):
     for region_folder in sorted(region_folders, key=sort_folders):
         region_id = int(region_folder.split('_')[1])
 
-        curated_filename = "_".join([fov_folder, region_folder, "curated.json"])
-        curated_filepath = os.path.join(input_path, fov_folder, region_folder, curated_filename)
+        # The curator saves in the binary format, but regions may have been curated to json previously
+        curated_filepath = os.path.join(input_path, fov_folder, region_folder, "_".join([fov_folder, region_folder, "curated.seg"]))
+        json_filepath = os.path.join(input_path, fov_folder, region_folder, "_".join([fov_folder, region_folder, "curated.json"]))
+        if not os.path.exists(curated_filepath) and os.path.exists(json_filepath):
+            curated_filepath = json_filepath
         print(curated_filepath)
         if os.path.exists(curated_filepath):
             print("FOV {} Region {} already curated".format(fov_folder.split('_')[1], region_folder.split('_')[1]))
@@ -77,14 +80,14 @@ for fov_folder in sorted(fov_folders, key=sort_folders):
             continue
         else:
             region_path: str = fov_path + region_folder + '/'
-            seg_files: List[str] = [file for file in os.listdir(region_path) if re.search(SEG_REGEX, file) is not None]
+            seg_files: List[str] = preferred_segmentation_files([file for file in os.listdir(region_path) if re.search(SEG_REGEX, file) is not None])
 
             if len(seg_files) == 1:
                 print("FOV {} Region {}".format(fov_folder.split('_')[1], region_folder.split('_')[1]))
                 pre_curate: float = time.time()
 
                 segmentation_filepath = region_path + seg_files[0]
-                segmentations: List[ProcessedFrame] = load_segmentation(segmentation_filepath)
+                segmentations: List[ProcessedFrame] = load_segmentation(segmentation_filepath, lazy=True)
                 run_viewer(segmentations)
 
                 # Copy file out of RAM after curation completed
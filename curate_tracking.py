@@ -6,6 +6,7 @@ import re
 import time
 import shutil
 from GUI.TrackingEditor import run_editor
+from Segmentation.SegmentationData import preferred_segmentation_files
 
 input_path = "/smalldata/2022-01-25_wafer9_lo_fluo_3out_1h30cycle_air_edf"  # 5'UTR 1
 # input_path = "/ramdisk/2022-02-09_wafer9_lo_fluo_3out_1h30mcycle_air_edf"  # 5'UTR 2
@@ -20,8 +21,8 @@ second_output_path = os.path.join("/smalldata", os.path.split(input_path)[1])
 FOV_REGEX = "^fov_[0-9]+$"
 REGION_REGEX = "^region_[0-9]+$"
 IMAGE_REGEX = "^frame_[0-9]+_z_[0-9]+_channel_[0-9]+\.tif$"
-SEG_REGEX = "^fov_[0-9]+_region_[0-9]+\.json$"
-CURATED_REGEX = "^fov_[0-9]+_region_[0-9]+_curated\.json$"
+SEG_REGEX = "^fov_[0-9]+_region_[0-9]+\.(json|seg)$"
+CURATED_REGEX = "^fov_[0-9]+_region_[0-9]+_curated\.(json|seg)$"
 
 # Data positions within filenames
 FRAME_POS = 1
@@ -50,7 +51,7 @@ for fov_folder in sorted(fov_folders, key=sort_folders):
 
     for region_folder in sorted(region_folders, key=sort_folders):
         region_path: str = fov_path + region_folder + '/'
-        seg_files: List[str] = [file for file in os.listdir(region_path) if re.search(CURATED_REGEX, file) is not None]
+        seg_files: List[str] = preferred_segmentation_files([file for file in os.listdir(region_path) if re.search(CURATED_REGEX, file) is not None])
         if len(seg_files) == 1:
             segmentation_filepath = os.path.join(region_path, seg_files[0])
             curated_seg_filepaths.append(segmentation_filepath)
@@ -81,7 +82,7 @@ for fov_folder in sorted(fov_folders, key=sort_folders):
             continue
         else:
             region_path: str = fov_path + region_folder + '/'
-            seg_files: List[str] = [file for file in os.listdir(region_path) if re.search(CURATED_REGEX, file) is not None]
+            seg_files: List[str] = preferred_segmentation_files([file for file in os.listdir(region_path) if re.search(CURATED_REGEX, file) is not None])
 
             if len(seg_files) == 1:
                 print("FOV {} Region {}".format(fov_folder.split('_')[1], region_folder.split('_')[1]))
@@ -0,0 +1,80 @@
+"""Script for cropping every FOV of an ND2 file into trapping regions without the GUI, using crop parameters saved from
+the cropping tool. Progress is printed as one JSON object per line, e.g.
+    {"event": "progress", "completed": 120, "total": 4800, "elapsed": 31.2}
+Interrupted crops can be resumed by running the script again with the same arguments."""
+
+import argparse
+import json
+import sys
+import time
+from typing import Dict, List, Union, Tuple
+from Preprocessing.ND2Frames import ND2Frames
+from Preprocessing.ImageCropper import ImageCropper, load_crop_parameters
+from Preprocessing.CropRunner import run_crop, CROP_PROCESSES, FRAMES_PER_TASK
+
+
+# Prints messages from run_crop as JSON lines, in place of the pipe to the GUI's RunningDialog
+class ProgressPrinter:
+    def __init__(self) -> None:
+        self.start_time: float = time.monotonic()
+        self.error: bool = False
+
+    def send(self, message: Union[Tuple[int, int], str]) -> None:
+        if isinstance(message, str):
+            self.error = True
+            self.print_event("error", message=message)
+        else:
+            self.print_event("progress", completed=message[0], total=message[1])
+
+    def print_event(self, event: str, **values) -> None:
+        print(json.dumps({"event": event, **values, "elapsed": round(time.monotonic() - self.start_time, 1)}), flush=True)
+
+
+# Ignored regions given as FOV:REGION,REGION,...
+def parse_ignored_regions(arguments: List[str]) -> Dict[int, List[int]]:
+    ignored_regions: Dict[int, List[int]] = {}
+    for argument in arguments:
+        fov, regions = argument.split(":")
+        ignored_regions.setdefault(int(fov), []).extend(int(region) for region in regions.split(",") if region != "")
+    return ignored_regions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Crop all FOVs of an ND2 file into trapping regions")
+    parser.add_argument("input", help="ND2 file to crop")
+    parser.add_argument("parameters", help="crop parameters file, saved from the cropping tool")
+    parser.add_argument("output", help="output folder, within which a folder named after the ND2 file is created")
+    parser.add_argument("--fovs", type=int, nargs="+", help="FOVs to crop (default: all)")
+    parser.add_argument("--ignore", action="append", default=[], metavar="FOV:REGIONS",
+                        help="comma-separated regions to ignore in a FOV, e.g. 3:0,7,12 (can be repeated)")
+    parser.add_argument("--processes", type=int, default=CROP_PROCESSES, help="number of cropping processes")
+    parser.add_argument("--frames-per-task", type=int, default=FRAMES_PER_TASK, help="frames cropped by each task")
+    args = parser.parse_args()
+    if min(args.processes, args.frames_per_task) < 1:
+        parser.error("--processes and --frames-per-task must be at least 1")
+
+    progress = ProgressPrinter()
+    try:
+        parameters = load_crop_parameters(args.parameters)
+        ignored = parse_ignored_regions(args.ignore)
+    except (OSError, ValueError) as error:
+        progress.print_event("error", message=str(error))
+        sys.exit(2)
+
+    with ND2Frames(args.input) as frames:
+        cropper = ImageCropper(frames, parameters)
+        fov_ids: List[int] = args.fovs if args.fovs is not None else list(range(frames.num_fovs))
+
+        invalid = [fov_id for fov_id in fov_ids + list(ignored) if not 0 <= fov_id < frames.num_fovs] + \
+                  [region_id for region_ids in ignored.values() for region_id in region_ids if not 0 <= region_id < len(cropper.crop_regions)]
+        if len(invalid) > 0:
+            progress.print_event("error", message="FOV or region out of range: {}".format(", ".join(str(value) for value in invalid)))
+            sys.exit(2)
+
+        progress.print_event("start", input=args.input, fovs=fov_ids, regions=len(cropper.crop_regions), processes=args.processes)
+        run_crop(cropper, fov_ids, args.output, progress, processes=args.processes, frames_per_task=args.frames_per_task,
+                 ignored_regions={fov_id: ignored.get(fov_id, []) for fov_id in fov_ids})
+
+    if progress.error:
+        sys.exit(1)
+    progress.print_event("finished")
@@ -0,0 +1,71 @@
+"""Script for cropping and segmenting every FOV of an ND2 file in one pass, without saving the full cropped z-stacks,
+using crop parameters saved from the cropping tool. Each region's z-selected planes are saved as a region stack, along
+with its segmentation. Progress is printed as JSON lines, in the same way as run_crop.py."""
+
+import argparse
+import json
+import sys
+from typing import List
+from Preprocessing.ND2Frames import ND2Frames
+from Preprocessing.ImageCropper import ImageCropper, load_crop_parameters
+from Segmentation.HistogramSegmenter import SegmentationParameters
+from Segmentation.PipelineRunner import run_pipeline, CROP_WORKERS, Z_WORKERS, SEGMENTATION_WORKERS, QUEUE_SIZE
+from run_crop import ProgressPrinter, parse_ignored_regions
+
+DEFAULT_SEGMENTATION_PARAMETERS = SegmentationParameters(2, [-1, -0.5, 0, 0.15, 0.3, 0.5], 10)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Crop all FOVs of an ND2 file into trapping regions and segment them")
+    parser.add_argument("input", help="ND2 file to crop")
+    parser.add_argument("parameters", help="crop parameters file, saved from the cropping tool")
+    parser.add_argument("output", help="output folder, within which a folder named after the ND2 file is created")
+    parser.add_argument("--fovs", type=int, nargs="+", help="FOVs to crop (default: all)")
+    parser.add_argument("--ignore", action="append", default=[], metavar="FOV:REGIONS",
+                        help="comma-separated regions to ignore in a FOV, e.g. 3:0,7,12 (can be repeated)")
+    parser.add_argument("--segmentation-channel", type=int, default=0, help="channel to segment")
+    parser.add_argument("--segmentation-parameters", metavar="JSON",
+                        help="segmentation parameters as a JSON object of SegmentationParameters fields, "
+                             "e.g. '{\"blur_sd\": 2, \"histogram_threshold_adjustments\": [-1, 0, 0.5], \"max_gap_fill\": 10}'")
+    parser.add_argument("--crop-workers", type=int, default=CROP_WORKERS, help="number of cropping processes")
+    parser.add_argument("--z-workers", type=int, default=Z_WORKERS, help="number of z-selection processes")
+    parser.add_argument("--segmentation-workers", type=int, default=SEGMENTATION_WORKERS, help="number of segmentation processes")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help="region frames held between each pair of stages")
+    args = parser.parse_args()
+    if min(args.crop_workers, args.z_workers, args.segmentation_workers, args.queue_size) < 1:
+        parser.error("worker counts and queue size must be at least 1")
+
+    progress = ProgressPrinter()
+    try:
+        parameters = load_crop_parameters(args.parameters)
+        ignored = parse_ignored_regions(args.ignore)
+        segmentation_parameters = DEFAULT_SEGMENTATION_PARAMETERS
+        if args.segmentation_parameters is not None:
+            segmentation_parameters = SegmentationParameters(**json.loads(args.segmentation_parameters))
+    except (OSError, ValueError, TypeError) as error:
+        progress.print_event("error", message=str(error))
+        sys.exit(2)
+
+    with ND2Frames(args.input) as frames:
+        cropper = ImageCropper(frames, parameters)
+        fov_ids: List[int] = args.fovs if args.fovs is not None else list(range(frames.num_fovs))
+
+        invalid = [fov_id for fov_id in fov_ids + list(ignored) if not 0 <= fov_id < frames.num_fovs] + \
+                  [region_id for region_ids in ignored.values() for region_id in region_ids if not 0 <= region_id < len(cropper.crop_regions)]
+        if not 0 <= args.segmentation_channel < frames.num_channels:
+            invalid.append(args.segmentation_channel)
+        if len(invalid) > 0:
+            progress.print_event("error", message="FOV, region or channel out of range: {}".format(", ".join(str(value) for value in invalid)))
+            sys.exit(2)
+
+        progress.print_event("start", input=args.input, fovs=fov_ids, regions=len(cropper.crop_regions),
+                             workers=[args.crop_workers, args.z_workers, args.segmentation_workers])
+        run_pipeline(cropper, fov_ids, args.output, segmentation_parameters, progress,
+                     segmentation_channel=args.segmentation_channel,
+                     ignored_regions={fov_id: ignored.get(fov_id, []) for fov_id in fov_ids},
+                     crop_workers=args.crop_workers, z_workers=args.z_workers, segmentation_workers=args.segmentation_workers,
+                     queue_size=args.queue_size)
+
+    if progress.error:
+        sys.exit(1)
+    progress.print_event("finished")
@@ -1,31 +1,39 @@
 from Segmentation.HistogramSegmenter import *
 from Segmentation.SegmentationData import save_segmentation, ProcessedFrame
+from Preprocessing.RegionStack import read_image, image_name, open_region
 import multiprocessing
 import os
 import psutil
 import time
-import cv2
-import numpy as np
 from typing import List
+import numpy as np
 
 NUM_WORKERS = 4
 
 
-# Returns the z index of the image with the lowest standard deviation, as a rough estimate of the best focus
+# Returns the z index of the image with the lowest standard deviation, as a rough estimate of the best focus.
+# Region stacks and virtual crops are read as a single (z, y, x) block, rather than one image at a time. Regions whose
+# z-stacks were reduced when cropping only have z position 0, and TIFFs missing from an interrupted crop are skipped.
 def pick_z_image(image_path: str, frame_no, num_zstack: int, segmentation_channel: int) -> int:
-    image_names = ["{}/frame_{}_z_{}_channel_{}.tif".format(image_path, frame_no, zstack_id, segmentation_channel) for zstack_id in range(num_zstack)]
-
-    image_stds: List[float] = []
-    for zstack_id in range(num_zstack):
-        image = cv2.imread("{}/frame_{}_z_{}_channel_{}.tif".format(image_path, frame_no, zstack_id, segmentation_channel))
-        image_stds.append(float(np.std(image)))
-
-    return image_stds.index(min(image_stds))
+    region = open_region(image_path)
+    if region is not None:
+        zstack: np.ndarray = region.read_zstack(frame_no, segmentation_channel)[0:num_zstack]
+        zstack_ids: List[int] = list(range(len(zstack)))
+    else:
+        # z positions are kept alongside their images, so the chosen index is a z position even when some are missing
+        zstack_paths = {zstack_id: "{}/{}".format(image_path, image_name(frame_no, zstack_id, segmentation_channel)) for zstack_id in range(num_zstack)}
+        zstack_ids: List[int] = [zstack_id for zstack_id, path in zstack_paths.items() if os.path.isfile(path)]
+        if len(zstack_ids) == 0:
+            raise FileNotFoundError("No z positions of frame {} channel {} in {}".format(frame_no, segmentation_channel, image_path))
+        zstack: np.ndarray = np.stack([read_image(zstack_paths[zstack_id]) for zstack_id in zstack_ids])
+
+    image_stds: np.ndarray = np.std(zstack.reshape((len(zstack), -1)), axis=1)
+    return zstack_ids[int(np.argmin(image_stds))]
 
 
 def run_frame(image_path: str, image_no: int, num_channels: int, num_zstack: int, seg_channel: int, parameters: SegmentationParameters):
     z_index = pick_z_image(image_path, image_no, num_zstack, seg_channel)
-    image_names = ["{}/frame_{}_z_{}_channel_{}.tif".format(image_path, image_no, z_index, chan) for chan in range(num_channels)]
+    image_names = ["{}/{}".format(image_path, image_name(image_no, z_index, chan)) for chan in range(num_channels)]
     segmenter = HistogramSegmenter(image_names, image_no, parameters)
     segmenter.run_segmentation()
 
@@ -0,0 +1,76 @@
+import math
+from typing import List, Optional
+import numpy as np
+import cv2
+import pytest
+from Segmentation.HistogramGapFill import gap_fill_mask
+
+
+# Original per-pixel gap fill, labelling one structuring element window at a time, kept as a reference for the
+# batched implementation
+def reference_gap_fill_mask(image: np.ndarray, struct_elements: List[np.ndarray], mask: Optional[np.ndarray] = None) -> np.ndarray:
+    contours, hierarchy = cv2.findContours(image, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    output_images = np.zeros((len(struct_elements),) + image.shape)
+
+    for contour_id in range(len(hierarchy[0])):
+        contour_img = cv2.drawContours(np.zeros(image.shape), contours, contour_id, 1)
+        for point in np.transpose(np.nonzero(contour_img)):
+            for element_id, element in enumerate(struct_elements):
+                im_y, im_x = image.shape
+                el_y, el_x = element.shape
+                el_centre_x = math.floor((el_x - 1) / 2)
+                el_centre_y = math.floor((el_y - 1) / 2)
+
+                y_min = max(0, min(point[0] - el_centre_y, im_y))
+                y_max = max(0, min(point[0] - el_centre_y + el_y, im_y))
+                x_min = max(0, min(point[1] - el_centre_x, im_x))
+                x_max = max(0, min(point[1] - el_centre_x + el_x, im_x))
+
+                and_img = np.logical_and(element[0:y_max - y_min, 0:x_max - x_min], image[y_min:y_max, x_min:x_max])
+                ret, labels, stats, centroids = cv2.connectedComponentsWithStats(and_img.astype(np.uint8))
+
+                if ret > 2:
+                    cv2.line(labels, tuple(np.round(centroids[1]).astype(int)), tuple(np.round(centroids[2]).astype(int)), 1, 1)
+                    if mask is None or not np.any(labels[mask[y_min:y_max, x_min:x_max] == 1]):
+                        output_images[element_id][y_min:y_max, x_min:x_max] = np.logical_or(
+                            output_images[element_id][y_min:y_max, x_min:x_max], labels)
+
+    return np.logical_or(output_images, image)
+
+
+# Broken rings of varying thickness, with scattered noise pixels
+def ring_image(rng: np.random.Generator, height: int = 97, width: int = 113) -> np.ndarray:
+    image = np.zeros((height, width), dtype=np.uint8)
+    for _ in range(12):
+        centre = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(image, centre, int(rng.integers(4, 16)), 1, int(rng.integers(1, 3)))
+    for _ in range(30):
+        centre = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(image, centre, int(rng.integers(1, 4)), 0, -1)
+    image[rng.random(image.shape) < 0.01] = 1
+    return image
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("use_mask", [False, True])
+def test_gap_fill_matches_reference(seed: int, use_mask: bool) -> None:
+    rng = np.random.default_rng(seed)
+    image = ring_image(rng)
+    mask = (rng.random(image.shape) < 0.02).astype(np.uint8) if use_mask else None
+    elements = [np.ones((2 * gap + 1, 2 * gap + 1)) for gap in (0, 1, 3, 5)] + \
+               [np.ones((4, 7)), np.ones((6, 3)), cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9, 5))]
+
+    expected = reference_gap_fill_mask(image, elements, mask)
+    result = gap_fill_mask(image, elements, mask)
+    assert result.dtype == expected.dtype
+    assert np.array_equal(result, expected)
+
+
+def test_gap_fill_of_noise_matches_reference() -> None:
+    rng = np.random.default_rng(10)
+    image = (rng.random((64, 80)) < 0.2).astype(np.uint8)
+    mask = (rng.random(image.shape) < 0.05).astype(np.uint8)
+    elements = [np.ones((3, 3)), np.ones((5, 2)), np.ones((2, 6))]
+
+    for element_mask in (None, mask):
+        assert np.array_equal(gap_fill_mask(image, elements, element_mask), reference_gap_fill_mask(image, elements, element_mask))
@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+from typing import List
+import numpy as np
+import cv2
+import pytest
+from Segmentation.HistogramSegmenter import HistogramSegmenter, SegmentationParameters
+
+
+# Random overlapping blobs, labelled as separate segments
+def random_label_image(rng: np.random.Generator, height: int = 60, width: int = 70) -> np.ndarray:
+    image = np.zeros((height, width), dtype=np.uint8)
+    for _ in range(int(rng.integers(3, 12))):
+        centre = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(2, 12)), int(rng.integers(2, 12)))
+        cv2.ellipse(image, centre, axes, float(rng.integers(0, 180)), 0, 360, 1, -1)
+    # Split blobs along random lines, so that neighbouring segments are separated by gaps of varying width
+    for _ in range(4):
+        start = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        end = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.line(image, start, end, 0, int(rng.integers(1, 3)))
+    return cv2.connectedComponents(image, connectivity=4)[1]
+
+
+# Stand-in segments with full frame masks, holding only the fields conflict calculation uses
+def label_segments(label_images: List[List[np.ndarray]]) -> List[List[List[SimpleNamespace]]]:
+    segment_count = 0
+    labelled_segments = []
+    for threshold_images in label_images:
+        threshold_segments = []
+        for labels in threshold_images:
+            segments = []
+            for label in range(1, int(np.amax(labels)) + 1):
+                segments.append(SimpleNamespace(seg_id=segment_count, mask_image=labels == label, conflicts=[]))
+                segment_count += 1
+            threshold_segments.append(segments)
+        labelled_segments.append(threshold_segments)
+    return labelled_segments
+
+
+# Original pairwise conflict calculation, comparing every pair of segment masks, kept as a reference for the label
+# co-occurrence implementation
+def reference_conflicts(labelled_segments: List[List[List[SimpleNamespace]]], num_thresholds: int, max_gap_fill: int) -> None:
+    for threshold_id in range(num_thresholds):
+        for gap_id in range(max_gap_fill):
+            for segment in labelled_segments[threshold_id][gap_id]:
+                segment.conflicts.append(segment.seg_id)
+                for other_threshold_id in range(threshold_id, num_thresholds):
+                    gap_range = range(gap_id, max_gap_fill) if threshold_id == other_threshold_id else range(0, max_gap_fill)
+                    for other_gap_id in gap_range:
+                        if threshold_id != other_threshold_id or gap_id != other_gap_id:
+                            for other_segment in labelled_segments[other_threshold_id][other_gap_id]:
+                                if np.any(np.logical_and(segment.mask_image, other_segment.mask_image)):
+                                    segment.conflicts.append(other_segment.seg_id)
+                                    other_segment.conflicts.append(segment.seg_id)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_conflicts_match_pairwise_reference(seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    num_thresholds, max_gap_fill = 3, 4
+    label_images = [[random_label_image(rng) for _ in range(max_gap_fill)] for _ in range(num_thresholds)]
+
+    segmenter = HistogramSegmenter.__new__(HistogramSegmenter)
+    segmenter.parameters = SegmentationParameters(0, [0.0] * num_thresholds, max_gap_fill)
+    segments = segmenter._calculate_conflicts(label_images, label_segments(label_images))
+
+    expected = label_segments(label_images)
+    reference_conflicts(expected, num_thresholds, max_gap_fill)
+
+    conflicts = [segment.conflicts for images in segments for image_segments in images for segment in image_segments]
+    expected_conflicts = [segment.conflicts for images in expected for image_segments in images for segment in image_segments]
+    assert conflicts == expected_conflicts
+    assert sum(len(segment_conflicts) for segment_conflicts in conflicts) > len(conflicts)